@@ -0,0 +1,44 @@
+import torch
+
+
+def checkpointed(i, checkpoint_every): 
+    # activation checkpointing for layer i: its activations are recomputed in the backward pass
+    # instead of being kept, checkpoint_every=1 does every layer, k every k-th layer
+    return bool(checkpoint_every) and i % checkpoint_every == 0 and torch.is_grad_enabled()
+
+def saved_activation_bytes(forward): 
+    # bytes of the activations autograd keeps for the backward pass of forward(), the parameters and
+    # the inputs that checkpointed layers hold on to are not counted; the tensors are kept until the
+    # graph returned by forward is freed
+    seen, total = set(), 0 
+    def pack(t): 
+        nonlocal total 
+        if not (t.is_leaf and t.requires_grad): 
+            storage = t.untyped_storage()
+            if storage.data_ptr() not in seen: 
+                seen.add(storage.data_ptr())
+                total += storage.nbytes()
+        return t 
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t): 
+        out = forward()
+    return total, out 
+
+def activation_memory_report(model, forward): 
+    # runs forward (without a backward pass) with and without activation checkpointing, the second
+    # run keeps every activation once, so it needs the memory that checkpointing saves
+    checkpointing, _ = saved_activation_bytes(forward)
+    checkpoint_every = set_activation_checkpointing(model, 0)
+    full, _ = saved_activation_bytes(forward)
+    set_activation_checkpointing(model, checkpoint_every)
+    print(f"Activations kept for backward: {checkpointing / 2**20:.1f} MB with checkpointing "
+          f"(every {checkpoint_every} layer(s)), {full / 2**20:.1f} MB without, "
+          f"{(full - checkpointing) / 2**20:.1f} MB saved")
+
+def set_activation_checkpointing(model, checkpoint_every): 
+    # sets checkpoint_every on every module that supports it and returns the previous value
+    previous = 0 
+    for module in model.modules(): 
+        if hasattr(module, "checkpoint_every"): 
+            previous = module.checkpoint_every or previous
+            module.checkpoint_every = checkpoint_every
+    return previous
@@ -0,0 +1,35 @@
+import warnings
+
+import torch
+
+
+def compile_or_none(fn, **compile_kwargs):
+    # torch.compile only exists from torch 2.0 on, and backends can refuse the model
+    if not hasattr(torch, 'compile'):
+        warnings.warn('torch.compile is not available, running eagerly')
+        return None
+    try:
+        return torch.compile(fn, **compile_kwargs)
+    except Exception as e:
+        warnings.warn(f'torch.compile failed, running eagerly: {e}')
+        return None
+
+def raise_recompile_limit(limit):
+    # dynamo compiles at most recompile_limit (cache_size_limit before torch 2.6) graphs of a function,
+    # shared by every instance of the model, and runs it eagerly afterwards; set once by the modules
+    # that compile a graph per input shape
+    config = getattr(getattr(torch, '_dynamo', None), 'config', None)
+    for name in ('recompile_limit', 'cache_size_limit'):
+        if hasattr(config, name):
+            setattr(config, name, max(getattr(config, name), limit))
+            return
+
+def mark_shapes(tensor, dynamic_dims=()):
+    # one graph covers every size of the dynamic_dims, every other dimension gets a graph per size;
+    # marked explicitly, dynamo would otherwise specialize on the first sizes it sees and make a
+    # dimension dynamic only after it changed once
+    for dim in range(tensor.dim()):
+        if dim in dynamic_dims:
+            torch._dynamo.maybe_mark_dynamic(tensor, dim)
+        else:
+            torch._dynamo.mark_static(tensor, dim)
@@ -0,0 +1,57 @@
+import builtins
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+
+
+def setup_distributed(backend='gloo'): 
+    # Data parallel training when started by torchrun (e.g. torchrun --nproc_per_node=4 train.py, with
+    # --nnodes/--rdzv_endpoint for several hosts), which sets RANK, WORLD_SIZE and MASTER_ADDR/PORT.
+    # Returns (rank, world_size), (0, 1) for a plain single process run.
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1: 
+        return 0, 1 
+    dist.init_process_group(backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    # the cores of the host are split between its ranks instead of every rank using all of them,
+    # pin the ranks to NUMA nodes from the outside (numactl, torchrun --numa-binding) to keep memory local
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    if rank != 0: 
+        # only rank 0 prints, print(..., force=True) still works everywhere
+        builtin_print = builtins.print
+        def print(*args, force=False, **kwargs): 
+            if force: 
+                builtin_print(*args, **kwargs)
+        builtins.print = print
+    return rank, world_size
+
+def is_main_process(): 
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+@contextmanager
+def main_process_first(): 
+    # for downloads and caches: rank 0 creates them while the other ranks wait, then they read them
+    if dist.is_initialized() and not is_main_process(): 
+        dist.barrier()
+    yield 
+    if dist.is_initialized() and is_main_process(): 
+        dist.barrier()
+
+def barrier(): 
+    # waits for every rank, e.g. for the ranks that skip the validation of rank 0
+    if dist.is_initialized(): 
+        dist.barrier()
+
+def all_reduce_sum(value): 
+    # sum of a python number over all ranks
+    if not dist.is_initialized(): 
+        return value 
+    tensor = torch.tensor(value, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+def cleanup_distributed(): 
+    if dist.is_initialized(): 
+        dist.destroy_process_group()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+
+def file_sha256(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class RaggedArrays:
+
+    # Rows of different lengths, stored flat on disk with an offsets index per array:
+    # row i of array name is <name>.bin[offsets[i]:offsets[i + 1]], read through np.memmap.
+    # Used for the token ids of the translation model, the GPT texts and the cached hidden states.
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.meta = json.loads((self.folder / 'meta.json').read_text())
+        self._arrays = None
+
+    @staticmethod
+    def exists(folder):
+        # meta.json is written last, a folder without it (or from an older layout) is rebuilt
+        meta_path = Path(folder) / 'meta.json'
+        return meta_path.exists() and 'arrays' in json.loads(meta_path.read_text())
+
+    def _open(self):
+        # memory mapped lazily so that pickling into DataLoader workers copies nothing
+        if self._arrays is None:
+            self._arrays = {
+                name: (
+                    np.memmap(self.folder / f'{name}.bin', dtype=info['dtype'], mode='r').reshape(-1, *info['row_shape']),
+                    np.load(self.folder / f'{name}_offsets.npy', mmap_mode='r'),
+                )
+                for name, info in self.meta['arrays'].items()
+            }
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def get(self, name, idx):
+        data, offsets = self._open()[name]
+        return data[offsets[idx]:offsets[idx + 1]]
+
+    def lengths(self, name):
+        _, offsets = self._open()[name]
+        return np.diff(offsets)
+
+    def path(self, name):
+        return self.folder / f'{name}.bin'
+
+class RaggedArraysWriter:
+
+    # Writes a RaggedArrays folder: rows are appended per array, close() adds the offsets and meta.json.
+    # Everything goes to a temporary folder that is renamed at the end, so an interrupted run never
+    # leaves a partial folder behind.
+    def __init__(self, folder, dtypes, meta=None):
+        self.folder = Path(folder)
+        self.tmp_folder = self.folder.with_name(self.folder.name + '.tmp')
+        shutil.rmtree(self.tmp_folder, ignore_errors=True)
+        self.tmp_folder.mkdir(parents=True)
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.meta = meta or {}
+        self.files = {name: open(self.tmp_folder / f'{name}.bin', 'wb') for name in dtypes}
+        self.offsets = {name: [0] for name in dtypes}
+        self.row_shapes = {name: [] for name in dtypes}
+
+    def append(self, name, row):
+        row = np.asarray(row, dtype=self.dtypes[name])
+        self.files[name].write(row.tobytes())
+        self.offsets[name].append(self.offsets[name][-1] + len(row))
+        self.row_shapes[name] = list(row.shape[1:])
+
+    def close(self):
+        arrays = {}
+        for name, f in self.files.items():
+            f.close()
+            np.save(self.tmp_folder / f'{name}_offsets.npy', np.asarray(self.offsets[name], dtype=np.int64))
+            arrays[name] = {'dtype': self.dtypes[name].name, 'row_shape': self.row_shapes[name]}
+        num_rows = {len(offsets) - 1 for offsets in self.offsets.values()}
+        if len(num_rows) != 1:
+            raise ValueError(f'Arrays with different numbers of rows: {num_rows}')
+        meta = {**self.meta, 'num_rows': num_rows.pop(), 'arrays': arrays}
+        (self.tmp_folder / 'meta.json').write_text(json.dumps(meta))
+        # a folder of an older layout is replaced
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.replace(self.tmp_folder, self.folder)
+        return RaggedArrays(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for f in self.files.values():
+                f.close()
+            shutil.rmtree(self.tmp_folder, ignore_errors=True)
+        return False
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+
+def to_cpu(obj):
+    # copy of a (nested) state dict with every tensor on the CPU, later training steps cannot change it
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+def best_checkpoint(checkpoints):
+    # path of the checkpoint with the lowest metric
+    scored = [c for c in checkpoints if c['metric'] is not None]
+    return min(scored, key=lambda c: c['metric'])['path'] if scored else None
+
+class CheckpointManager:
+
+    # Writes checkpoints in a background thread: save() only copies the state to CPU memory, the
+    # serialization to disk happens while training goes on. Keeps the last keep_last checkpoints plus
+    # the one with the lowest metric, the others are deleted. Only a resumed run picks up the index of
+    # the earlier runs, a new one starts an empty index and leaves their files alone.
+    def __init__(self, folder, keep_last=3, every_steps=None, every_seconds=None, resume=True) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.keep_last = keep_last
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.last_save_step = None
+        self.last_save_time = time.monotonic()
+
+        # the checkpoints written so far, by this run and the runs it resumes
+        self.manifest_path = self.folder / 'checkpoints.json'
+        if resume and self.manifest_path.exists():
+            self.checkpoints = json.loads(self.manifest_path.read_text())
+        else:
+            self.checkpoints = []
+        # the writer thread replaces self.checkpoints while latest() and best() read it
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+
+    def should_save(self, global_step):
+        # interval checkpoints within an epoch, every_steps optimizer steps or every_seconds seconds
+        if self.last_save_step == global_step:
+            return False
+        if self.every_steps is not None and global_step % self.every_steps == 0:
+            return True
+        return self.every_seconds is not None and time.monotonic() - self.last_save_time >= self.every_seconds
+
+    def save(self, state, path, metric=None):
+        # the previous checkpoint has to be on disk before the next one is queued, so at most one
+        # snapshot is held in memory
+        self.wait()
+        snapshot = to_cpu(state)
+        self.last_save_step = state.get('global_step')
+        self.last_save_time = time.monotonic()
+        self._thread = threading.Thread(target=self._write, args=(snapshot, Path(path), metric), daemon=True)
+        self._thread.start()
+
+    def _write(self, snapshot, path, metric):
+        try:
+            # write to a temporary file and rename it so that a crash never leaves a broken checkpoint
+            tmp_path = path.with_name(path.name + '.tmp')
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, path)
+            with self._lock:
+                checkpoints = [c for c in self.checkpoints if c['path'] != str(path)]
+            checkpoints.append({'path': str(path), 'global_step': snapshot.get('global_step'), 'metric': metric})
+            self._rotate(checkpoints)
+        except Exception as e:
+            self._error = e
+
+    def _rotate(self, checkpoints):
+        keep = {c['path'] for c in checkpoints[-self.keep_last:]}
+        best = best_checkpoint(checkpoints)
+        if best is not None:
+            keep.add(best)
+        kept = [c for c in checkpoints if c['path'] in keep]
+        # the new list is complete before the readers see it
+        with self._lock:
+            self.checkpoints = kept
+        for c in checkpoints:
+            if c['path'] not in keep:
+                Path(c['path']).unlink(missing_ok=True)
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        tmp_path.write_text(json.dumps(kept, indent=2))
+        os.replace(tmp_path, self.manifest_path)
+
+    def wait(self):
+        # blocks until the last checkpoint is written, errors of the writer thread show up here
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def latest(self):
+        with self._lock:
+            return self.checkpoints[-1]['path'] if self.checkpoints else None
+
+    def best(self):
+        with self._lock:
+            return best_checkpoint(self.checkpoints)
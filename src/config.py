@@ -3,16 +3,39 @@ from pathlib import Path
 def get_config(): 
     return {
         'batch_size': 8, 
+        # when set, training batches hold as many sentences as fit into this many (padded) tokens instead of batch_size
+        'max_tokens_per_batch': None, 
+        # gradient accumulation: optimizer step once the micro-batches add up to this many target tokens
+        'tokens_per_step': None, 
         'num_epochs': 20, 
         'lr': 10**-4, 
         'seq_len': 350, 
         'd_model': 512, 
+        'beam_size': 1, 
+        'fused_attention': False, 
+        # recompute the activations of every k-th encoder/decoder layer in the backward pass instead of keeping them, 0 is off
+        'activation_checkpointing': 0, 
+        # print the activation memory kept for backward with and without checkpointing for the first batch
+        'report_activation_memory': False, 
+        # data parallel training (launched by torchrun): gradients are all-reduced in buckets of this many MB while backward runs
+        'ddp_bucket_cap_mb': 25, 
+        # 'bf16' runs the forward pass and the loss under bfloat16 autocast, the weights stay float32
+        'mixed_precision': None, 
+        # translate the validation examples with the torch.compile'd encoder/decoder (see inference.py), eager if compiling fails
+        'compile_inference': False, 
         'lang_src': "en", 
         'lang_tgt': 'it', 
         'model_folder': 'weights', 
         'model_basename': 'tmodel_', 
+        # None, 'latest', 'best', an epoch like '05' or the path of a checkpoint
         'preload': None, 
+        # checkpoints are written in the background, the last ones and the best (validation loss) are kept
+        'checkpoint_keep_last': 3, 
+        # extra checkpoints within an epoch, every so many optimizer steps or minutes
+        'checkpoint_every_steps': None, 
+        'checkpoint_every_minutes': None, 
         'tokenizer_file': 'tokenizer_{0}.json', 
+        'token_store_folder': 'token_store', 
         'experiment_name': 'runs/tmodel'
     }
     
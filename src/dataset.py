@@ -1,12 +1,18 @@
+import random 
+
+import numpy as np
 import torch 
 import torch.nn as nn 
-from torch.utils.data import Dataset 
+from torch.utils.data import Dataset, Sampler, Subset 
 
 class BilingualDataset(Dataset): 
     
-    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len) -> None: 
+    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len, token_store=None) -> None: 
         super().__init__() 
         self.ds = ds 
+        # pre-tokenized ids of the full dataset, indexed like the raw dataset behind the split
+        self.token_store = token_store 
+        self.store_indices = ds.indices if isinstance(ds, Subset) else range(len(ds))
         self.tokenizer_src = tokenizer_src
         self.tokenizer_tgt = tokenizer_tgt
         self.src_lang = src_lang
@@ -21,28 +27,47 @@ class BilingualDataset(Dataset):
     def __len__(self): 
         return len(self.ds)
     
-    def __getitem__(self, idx): 
-        
+    def encode(self, idx): 
         src_target_pair = self.ds[idx]
         src_text = src_target_pair['translation'][self.src_lang]
         tgt_text = src_target_pair['translation'][self.tgt_lang]
         
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
+        if self.token_store is not None: 
+            store_idx = self.store_indices[idx]
+            enc_input_tokens = self.token_store.get('src', store_idx)
+            dec_input_tokens = self.token_store.get('tgt', store_idx)
+        else: 
+            enc_input_tokens = self.tokenizer_src.encode(src_text).ids
+            dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
+        return src_text, tgt_text, enc_input_tokens, dec_input_tokens
+    
+    def token_lengths(self): 
+        # padded length each example needs (the longer of encoder and decoder side), used for bucketing
+        if self.token_store is not None: 
+            store_indices = list(self.store_indices)
+            src_lengths = self.token_store.lengths('src')[store_indices] + 2
+            tgt_lengths = self.token_store.lengths('tgt')[store_indices] + 1
+            return [int(length) for length in np.maximum(src_lengths, tgt_lengths)]
+        lengths = []
+        for idx in range(len(self)): 
+            _, _, enc_input_tokens, dec_input_tokens = self.encode(idx)
+            lengths.append(max(len(enc_input_tokens) + 2, len(dec_input_tokens) + 1))
+        return lengths
+    
+    def __getitem__(self, idx): 
         
-        enc_num_padding_tokens = self.seq_len - len(enc_input_tokens) - 2 
-        dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) - 1
+        src_text, tgt_text, enc_input_tokens, dec_input_tokens = self.encode(idx)
         
-        if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
+        # the sequences are only padded later in collate, up to the longest one of the batch
+        if len(enc_input_tokens) + 2 > self.seq_len or len(dec_input_tokens) + 1 > self.seq_len:
             raise ValueError("The sequence length is too small to fit the tokens")
         
         # add SOS and EOS to the source text
         encoder_input = torch.cat(
             [
                 self.sos_token, 
-                torch.tensor(enc_input_tokens, dtype=torch.int64), 
+                torch.from_numpy(np.array(enc_input_tokens, dtype=np.int64)), 
                 self.eos_token, 
-                torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64)
             ]
         )
         
@@ -50,33 +75,106 @@ class BilingualDataset(Dataset):
         decoder_input = torch.cat(
             [
                 self.sos_token, 
-                torch.tensor(dec_input_tokens, dtype=torch.int64), 
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64)
+                torch.from_numpy(np.array(dec_input_tokens, dtype=np.int64)), 
             ]
         )
         
         # add EOS to the label (what we epect as output from the decoder)
         label = torch.cat(
             [
-                torch.tensor(dec_input_tokens, dtype=torch.int64), 
+                torch.from_numpy(np.array(dec_input_tokens, dtype=np.int64)), 
                 self.eos_token, 
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64)
             ]
         )
         
-        assert encoder_input.size(0) == self.seq_len 
-        assert decoder_input.size(0) == self.seq_len 
-        assert label.size(0) == self.seq_len
-        
         return {
-            'encoder_input': encoder_input,  # (seq_len) 
-            'decoder_input': decoder_input,  # (seq_len) 
-            'encoder_mask': (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(),  # (1, 1, seq_len)
-            'decoder_mask': (decoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int() & causal_mask(decoder_input.size(0)),  # (1, seq_len) & (1, seq_len, seq_len) 
-            'label': label, # (seq_len)
+            'encoder_input': encoder_input,  # (enc_len) 
+            'decoder_input': decoder_input,  # (dec_len) 
+            'label': label, # (dec_len)
             'src_text': src_text, 
             'tgt_text': tgt_text, 
         }
+    
+    def collate(self, batch): 
+        # pad to the longest sequence of the batch instead of seq_len, the masks are built by the model from the lengths
+        pad_id = self.pad_token.item()
+        encoder_input = nn.utils.rnn.pad_sequence([item['encoder_input'] for item in batch], batch_first=True, padding_value=pad_id)
+        decoder_input = nn.utils.rnn.pad_sequence([item['decoder_input'] for item in batch], batch_first=True, padding_value=pad_id)
+        label = nn.utils.rnn.pad_sequence([item['label'] for item in batch], batch_first=True, padding_value=pad_id)
+        
+        return {
+            'encoder_input': encoder_input,  # (batch, enc_len) 
+            'decoder_input': decoder_input,  # (batch, dec_len) 
+            'encoder_len': torch.tensor([len(item['encoder_input']) for item in batch]),  # (batch)
+            'decoder_len': torch.tensor([len(item['decoder_input']) for item in batch]),  # (batch)
+            'label': label, # (batch, dec_len)
+            'src_text': [item['src_text'] for item in batch], 
+            'tgt_text': [item['tgt_text'] for item in batch], 
+        }
+        
+class BucketBatchSampler(Sampler): 
+    
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=True, bucket_size=100, seed=0, num_replicas=1, rank=0) -> None: 
+        super().__init__()
+        assert (batch_size is None) != (max_tokens is None), "either batch_size or max_tokens must be set"
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        # number of batches worth of examples that are sorted together
+        self.bucket_size = bucket_size
+        self.seed = seed
+        # data parallel training: every rank builds the same batches from the seed and takes its share
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0 
+        self._batches = None
+        
+    def set_epoch(self, epoch): 
+        self.epoch = epoch 
+        self._batches = None
+    
+    def _fits(self, batch_len, max_len): 
+        if self.max_tokens is not None: 
+            # a batch costs its number of rows times the padded length
+            return batch_len == 0 or (batch_len + 1) * max_len <= self.max_tokens
+        return batch_len < self.batch_size
+    
+    def batches(self): 
+        if self._batches is not None: 
+            return self._batches
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle: 
+            rng.shuffle(indices)
+        
+        # sort chunks of the (shuffled) indices by length so that batches hold similar lengths
+        chunk_size = self.bucket_size * (self.batch_size or max(1, self.max_tokens // max(self.lengths)))
+        batches = []
+        for start in range(0, len(indices), chunk_size): 
+            chunk = sorted(indices[start:start + chunk_size], key=lambda i: self.lengths[i])
+            batch, max_len = [], 0 
+            for i in chunk: 
+                if not self._fits(len(batch), max(max_len, self.lengths[i])): 
+                    batches.append(batch)
+                    batch, max_len = [], 0 
+                batch.append(i)
+                max_len = max(max_len, self.lengths[i])
+            if batch: 
+                batches.append(batch)
+        
+        if self.shuffle: 
+            rng.shuffle(batches)
+        # every rank gets the same number of batches, the few that do not divide evenly are dropped
+        num_batches = len(batches) - len(batches) % self.num_replicas
+        self._batches = batches[self.rank:num_batches:self.num_replicas]
+        return self._batches
+    
+    def __iter__(self): 
+        return iter(self.batches())
+    
+    def __len__(self): 
+        return len(self.batches())
         
 def causal_mask(size): 
     mask = torch.triu(torch.ones(size, size), diagonal=1).type(torch.int) 
@@ -0,0 +1,123 @@
+import torch
+
+
+def batched_greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    batch_size = source.size(0)
+
+    encoder_output = model.encode(source, source_mask) # (batch, seq_len, d_model)
+    cache = model.init_decoder_cache(encoder_output)
+
+    # every row starts with the sos token, rows that never emit eos keep max_len tokens
+    tokens = torch.full((batch_size, max_len), sos_idx, dtype=source.dtype, device=device)
+    lengths = torch.full((batch_size,), max_len, dtype=torch.long, device=device)
+    # original batch index of the rows that are still being decoded
+    active = torch.arange(batch_size, device=device)
+    next_input = tokens[:, :1]
+
+    for step in range(1, max_len):
+        out = model.decode_step(encoder_output, source_mask, next_input, cache)
+        prob = model.project(out[:, -1]) # (active, tgt_vocab_size)
+        next_word = prob.argmax(dim=-1)
+        tokens[active, step] = next_word
+
+        finished = next_word == eos_idx
+        lengths[active[finished]] = step + 1
+        keep = (~finished).nonzero().squeeze(1)
+        if keep.numel() == 0:
+            break
+        if keep.numel() < active.numel():
+            # drop the finished rows so the following steps only compute the ones still running
+            active = active[keep]
+            next_word = next_word[keep]
+            encoder_output = encoder_output.index_select(0, keep)
+            source_mask = source_mask.index_select(0, keep)
+            cache = model.reorder_decoder_cache(cache, keep)
+        next_input = next_word.unsqueeze(1)
+
+    lengths = lengths.tolist()
+    return [tokens[i, :lengths[i]] for i in range(batch_size)]
+
+def beam_search_decode(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size=4, length_penalty=1.0):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    batch_size = source.size(0)
+
+    encoder_output = model.encode(source, source_mask)
+    # every sentence gets beam_size rows: (batch * beam_size, ...)
+    expand = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+    encoder_output = encoder_output.index_select(0, expand)
+    source_mask = source_mask.index_select(0, expand)
+    cache = model.init_decoder_cache(encoder_output)
+
+    sequences = torch.full((batch_size * beam_size, 1), sos_idx, dtype=source.dtype, device=device)
+    # only the first beam is alive at the start, otherwise all beams would pick the same tokens
+    scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    # original batch index of the sentences that are still being searched
+    active = list(range(batch_size))
+    finished = [[] for _ in range(batch_size)] # (normalized score, tokens) per sentence
+
+    for step in range(1, max_len):
+        out = model.decode_step(encoder_output, source_mask, sequences[:, -1:], cache)
+        log_probs = model.project(out[:, -1]) # (active * beam_size, tgt_vocab_size)
+        vocab_size = log_probs.size(-1)
+
+        candidates = (scores.view(-1, 1) + log_probs).view(len(active), beam_size * vocab_size)
+        # twice the beam size so that enough candidates survive when some of them end with eos
+        top_scores, top_idx = candidates.topk(2 * beam_size, dim=-1)
+        top_beam = (top_idx // vocab_size).tolist()
+        top_token = (top_idx % vocab_size).tolist()
+        top_scores_list = top_scores.tolist()
+
+        rows, next_tokens, next_scores, still_active = [], [], [], []
+        for g, sentence in enumerate(active):
+            group_rows, group_tokens, group_scores = [], [], []
+            for rank in range(2 * beam_size):
+                row = g * beam_size + top_beam[g][rank]
+                score = top_scores_list[g][rank]
+                if top_token[g][rank] == eos_idx:
+                    # only hypotheses that would have made it into the beam count as finished
+                    if rank < beam_size:
+                        hyp = torch.cat([sequences[row], sequences.new_tensor([eos_idx])])
+                        finished[sentence].append((score / (step ** length_penalty), hyp))
+                else:
+                    group_rows.append(row)
+                    group_tokens.append(top_token[g][rank])
+                    group_scores.append(score)
+                if len(group_rows) == beam_size:
+                    break
+
+            if len(finished[sentence]) >= beam_size:
+                continue
+            if step == max_len - 1:
+                # out of room, the running beams are the final hypotheses
+                for row, token, score in zip(group_rows, group_tokens, group_scores):
+                    hyp = torch.cat([sequences[row], sequences.new_tensor([token])])
+                    finished[sentence].append((score / (step ** length_penalty), hyp))
+                continue
+            rows.extend(group_rows)
+            next_tokens.extend(group_tokens)
+            next_scores.append(group_scores)
+            still_active.append(sentence)
+
+        if not still_active:
+            break
+
+        # follow the selected beams and drop the sentences that are done
+        rows = torch.tensor(rows, device=device)
+        sequences = torch.cat([sequences.index_select(0, rows), torch.tensor(next_tokens, dtype=sequences.dtype, device=device).unsqueeze(1)], dim=1)
+        scores = torch.tensor(next_scores, device=device)
+        encoder_output = encoder_output.index_select(0, rows)
+        source_mask = source_mask.index_select(0, rows)
+        cache = model.reorder_decoder_cache(cache, rows)
+        active = still_active
+
+    return [max(hyps, key=lambda h: h[0])[1] if hyps else sequences.new_tensor([sos_idx]) for hyps in finished]
+
+def translate(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size=1):
+    # greedy search is the special case of a single beam, but it is much cheaper without the beam bookkeeping
+    if beam_size == 1:
+        return batched_greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device)
+    return beam_search_decode(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size)
@@ -0,0 +1,127 @@
+import time
+import warnings
+
+import torch
+
+import shared  # noqa: F401, makes the common package importable
+from common.compile import compile_or_none, mark_shapes, raise_recompile_limit
+from decode import translate
+
+
+# a graph per batch size and padded source length for encode
+raise_recompile_limit(64)
+
+class CompiledTransformer:
+
+    # Inference wrapper around a Transformer whose encode, decode_step and project run through
+    # torch.compile, so it can be passed to translate() in place of the model. encode gets a graph per
+    # shape: the sources are padded to a multiple of pad_multiple, so the few padded lengths are
+    # compiled by warmup. decode_step and project mark the dimensions that change during a translation
+    # as dynamic (the rows, as finished sentences leave the batch, the source length and the growing
+    # cache), so one graph serves all steps. If compiling fails, here or for a new shape on its first
+    # call, that method goes back to the eager model.
+    def __init__(self, model, backend='inductor', mode=None, pad_multiple=64):
+        self.model = model.eval()
+        self.pad_multiple = pad_multiple
+        self.compiled = {
+            'encode': compile_or_none(model.encode, backend=backend, mode=mode),
+            'decode_step': compile_or_none(model.decode_step, backend=backend, mode=mode),
+            'project': compile_or_none(model.project, backend=backend, mode=mode),
+        }
+
+    def _call(self, name, *args):
+        compiled = self.compiled[name]
+        if compiled is not None:
+            try:
+                return compiled(*args)
+            except Exception as e:
+                warnings.warn(f'compiled {name} failed, falling back to eager mode: {e}')
+                self.compiled[name] = None
+        return getattr(self.model, name)(*args)
+
+    def padded_length(self, length):
+        # never beyond the positions of the model
+        return min(-(-length // self.pad_multiple) * self.pad_multiple, self.model.src_pos.pe.shape[1])
+
+    def encode(self, src, src_mask):
+        length = src.shape[1]
+        if self.compiled['encode'] is not None:
+            # the padding is masked, so the real positions come out the same
+            extra = self.padded_length(length) - length
+            src = torch.cat([src, src.new_zeros(src.shape[0], extra)], dim=1).contiguous()
+            src_mask = torch.cat([src_mask, src_mask.new_zeros(*src_mask.shape[:-1], extra)], dim=-1)
+            mark_shapes(src)
+            mark_shapes(src_mask)
+        # contiguous, a slice of the padded output would have other strides in decode_step
+        return self._call('encode', src, src_mask)[:, :length].contiguous()
+
+    def init_decoder_cache(self, encoder_output):
+        cache = self.model.init_decoder_cache(encoder_output)
+        if self.compiled['decode_step'] is not None:
+            # the cross attention keys and values in the layout reorder_decoder_cache leaves them in,
+            # another layout would be another graph
+            for layer_cache in cache:
+                for name in ('key', 'value'):
+                    layer_cache['cross'][name] = layer_cache['cross'][name].contiguous()
+        return cache
+
+    def decode_step(self, encoder_output, src_mask, tgt, cache):
+        if self.compiled['decode_step'] is not None:
+            # the first tokens are a slice of the output buffer, the later ones are contiguous
+            tgt = tgt.contiguous()
+            mark_shapes(encoder_output, dynamic_dims=(0, 1))
+            mark_shapes(src_mask, dynamic_dims=(0, 3))
+            mark_shapes(tgt, dynamic_dims=(0,))
+            for layer_cache in cache:
+                for name in ('key', 'value'):
+                    for part in ('self', 'cross'):
+                        if name in layer_cache[part]:
+                            mark_shapes(layer_cache[part][name], dynamic_dims=(0, 2))
+        return self._call('decode_step', encoder_output, src_mask, tgt, cache)
+
+    def project(self, x):
+        if self.compiled['project'] is not None:
+            mark_shapes(x, dynamic_dims=(0,))
+        return self._call('project', x)
+
+    def __getattr__(self, name):
+        # init_decoder_cache, reorder_decoder_cache, ... of the wrapped model
+        return getattr(self.model, name)
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def warmup(self, tokenizer_tgt, batch_sizes, max_len, device, beam_size=1, source_lengths=None):
+        # compiles the graphs of the expected shapes at startup: one translation of random tokens
+        # (decoded for the full max_len) per batch size and padded source length, by default every
+        # padded length the model has positions for
+        vocab_size = self.model.src_embed.vocab_size
+        max_positions = self.model.src_pos.pe.shape[1]
+        if source_lengths is None:
+            source_lengths = range(self.pad_multiple, max_positions + self.pad_multiple, self.pad_multiple)
+        padded_lengths = sorted({self.padded_length(length) for length in source_lengths})
+        start = time.perf_counter()
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                for length in padded_lengths:
+                    source = torch.randint(0, vocab_size, (batch_size, length), device=device)
+                    source_mask = torch.ones(batch_size, 1, 1, length, dtype=torch.bool, device=device)
+                    translate(self, source, source_mask, tokenizer_tgt, max_len, device, beam_size)
+        compiled = all(c is not None for c in self.compiled.values())
+        print(f'Warmup done in {time.perf_counter() - start:.1f}s ({"compiled" if compiled else "eager"})')
+
+def benchmark_translate(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size=1, num_runs=5, backend='inductor'):
+    # eager against compiled translation of the same batch, the compilation is not part of the timing
+    compiled = CompiledTransformer(model, backend=backend)
+    times = {}
+    for name, m in [('eager', model), ('compiled', compiled)]:
+        with torch.no_grad():
+            translate(m, source, source_mask, tokenizer_tgt, max_len, device, beam_size)
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                translate(m, source, source_mask, tokenizer_tgt, max_len, device, beam_size)
+        times[name] = (time.perf_counter() - start) / num_runs
+    print(f'translate {tuple(source.shape)}: eager {times["eager"] * 1000:.1f} ms, '
+          f'compiled {times["compiled"] * 1000:.1f} ms ({times["eager"] / times["compiled"]:.2f}x)')
+    return times
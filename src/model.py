@@ -1,6 +1,11 @@
 import torch
 import torch.nn as nn 
+import torch.nn.functional as F
 import math
+from torch.utils.checkpoint import checkpoint
+
+import shared  # noqa: F401, makes the common package importable
+from common.activation import checkpointed
 
 class InputEmbeddings(nn.Module): 
     
@@ -34,8 +39,8 @@ class PositionalEncoding(nn.Module):
         
         self.register_buffer('pe', pe)
         
-    def forward(self, x): 
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False)
+    def forward(self, x, start_pos: int = 0): 
+        x = x + (self.pe[:, start_pos:start_pos + x.shape[1], :]).requires_grad_(False)
         return self.dropout(x)
     
 class LayerNormalization(nn.Module): 
@@ -47,9 +52,11 @@ class LayerNormalization(nn.Module):
         self.bias = nn.Parameter(torch.zeros(features)) # added 
         
     def forward(self, x): 
-        mean = x.mean(dim=-1, keepdim=True)
-        std = x.std(dim=-1, keepdim=True)
-        return self.alpha * (x - mean) / (std + self.eps) + self.bias
+        # the statistics are computed in float32 even for bfloat16 inputs (autocast or bf16 weights)
+        x_float = x.float()
+        mean = x_float.mean(dim=-1, keepdim=True)
+        std = x_float.std(dim=-1, keepdim=True)
+        return (self.alpha * (x_float - mean) / (std + self.eps) + self.bias).to(x.dtype)
     
 class FeedForwardBlock(nn.Module): 
     
@@ -65,10 +72,16 @@ class FeedForwardBlock(nn.Module):
     
 class MultiHeadAttentionBlock(nn.Module): 
     
-    def __init__(self, d_model: int, h: int, dropout: float) -> None: 
+    def __init__(self, d_model: int, h: int, dropout: float, fused: bool = False, cache_packed: bool = False) -> None: 
         super().__init__() 
         self.d_mdoel = d_model 
         self.h = h 
+        # fused: packed projections and torch's scaled_dot_product_attention, which never materializes the scores
+        self.fused = fused 
+        # cache_packed: keep the concatenated projection weights between inference calls instead of
+        # concatenating them every call, faster decoding for a second copy of the q/k/v weights in memory
+        self.cache_packed = cache_packed 
+        self.packed = {}
         assert d_model % h == 0, f"d_model is not divisible by h"
         self.d_k = d_model // h 
         self.w_q = nn.Linear(d_model, d_model) # W_q 
@@ -85,24 +98,67 @@ class MultiHeadAttentionBlock(nn.Module):
         # (batch, h, seq_len, d_k) -> (batch, h, seq_len, seq_len)
         attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
         if mask is not None: 
-            attention_scores.masked_fill(mask == 0, -1e9)
+            attention_scores.masked_fill_(mask.logical_not(), -1e9)
         attention_scores = attention_scores.softmax(dim = -1) # (batch, h, seq_len, seq_len)
         if dropout is not None: 
             attention_scores = dropout(attention_scores)
             
         return (attention_scores @ value), attention_scores 
     
-    def forward(self, q, k, v, mask): 
-        query = self.w_q(q) # (batch, seq_len, d_model) -> (batch, seql_len, d_model)
-        key = self.w_k(k) # (batch, seq_len, d_model) -> (batch, seql_len, d_model)
-        value = self.w_v(v) # (batch, seq_len, d_model) -> (batch, seql_len, d_model)
-        
+    def split_heads(self, x): 
         # (batch, seq_len, d_model) -> (batch, seq_len, h, d_k) -> (batch, h, seq_len, d_k)
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return x.view(x.shape[0], x.shape[1], self.h, self.d_k).transpose(1, 2)
+    
+    def packed_projection(self, x, names): 
+        # run several of the projections as one matmul over their concatenated weights
+        layers = [getattr(self, name) for name in names]
+        params = [p for layer in layers for p in (layer.weight, layer.bias)]
+        if torch.is_grad_enabled() or not self.cache_packed: 
+            weight = torch.cat([layer.weight for layer in layers])
+            bias = torch.cat([layer.bias for layer in layers])
+        else: 
+            # the packed copy is kept until the weights change or move
+            version = tuple((p.data_ptr(), p._version) for p in params)
+            if names not in self.packed or self.packed[names][0] != version: 
+                self.packed[names] = (version, torch.cat([layer.weight for layer in layers]), torch.cat([layer.bias for layer in layers]))
+            _, weight, bias = self.packed[names]
+        return [self.split_heads(t) for t in F.linear(x, weight, bias).chunk(len(names), dim=-1)]
+    
+    def project_kv(self, k, v): 
+        if self.fused and k is v: 
+            return self.packed_projection(k, ('w_k', 'w_v'))
+        return self.split_heads(self.w_k(k)), self.split_heads(self.w_v(v))
+    
+    def forward(self, q, k, v, mask, cache=None): 
+        # cross attention: the keys and values of the encoder output never change
+        static = cache is not None and cache.get('static')
+        
+        if self.fused and not static and q is k and k is v: 
+            # self attention: (batch, seq_len, d_model) -> 3 x (batch, h, seq_len, d_k) in a single matmul
+            query, key, value = self.packed_projection(q, ('w_q', 'w_k', 'w_v'))
+        else: 
+            query = self.split_heads(self.w_q(q)) # (batch, seq_len, d_model) -> (batch, h, seq_len, d_k)
+            if not static: 
+                key, value = self.project_kv(k, v) # (batch, seq_len, d_model) -> (batch, h, seq_len, d_k)
         
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if static: 
+            key, value = cache['key'], cache['value']
+        elif cache is not None: 
+            # self attention: append the new positions to the ones from earlier steps
+            if 'key' in cache: 
+                key = torch.cat([cache['key'], key], dim=2)
+                value = torch.cat([cache['value'], value], dim=2)
+            cache['key'], cache['value'] = key, value
+        
+        if self.fused: 
+            x = F.scaled_dot_product_attention(
+                query, key, value, 
+                attn_mask=None if mask is None else mask.bool(), 
+                dropout_p=self.dropout.p if self.training else 0.0, 
+            )
+            self.attention_scores = None
+        else: 
+            x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
         
         # (batch, h, seq_len, d_k) -> (batch, seq_len, h, d_k) -> (batch, seq_len, d_model)
         x = x.transpose(1, 2).contiguous().view(x.shape[0], -1, self.h * self.d_k)
@@ -135,14 +191,19 @@ class EncoderBlock(nn.Module):
     
 class Encoder(nn.Module): 
     
-    def __init__(self, features: int, layers: nn.ModuleList) -> None: 
+    def __init__(self, features: int, layers: nn.ModuleList, checkpoint_every: int = 0) -> None: 
         super().__init__() 
         self.layers = layers 
         self.norm = LayerNormalization(features) 
+        self.checkpoint_every = checkpoint_every
     
     def forward(self, x, mask): 
-        for layer in self.layers: 
-            x = layer(x, mask) 
+        for i, layer in enumerate(self.layers): 
+            if checkpointed(i, self.checkpoint_every): 
+                # the RNG state is saved as well, so the recomputation uses the same dropout masks
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            else: 
+                x = layer(x, mask) 
         return self.norm(x) 
     
 class DecoderBlock(nn.Module): 
@@ -156,22 +217,32 @@ class DecoderBlock(nn.Module):
         self.feed_forward_block = feed_forward_block
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
         
-    def forward(self, x, encoder_output, src_mask, tgt_mask): 
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None): 
+        self_cache = None if cache is None else cache['self']
+        cross_cache = None if cache is None else cache['cross']
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask, self_cache))
+        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask, cross_cache))
         x = self.residual_connections[2](x, self.feed_forward_block)
         return x 
     
+    def init_cache(self, encoder_output): 
+        key, value = self.cross_attention_block.project_kv(encoder_output, encoder_output)
+        return {'self': {}, 'cross': {'static': True, 'key': key, 'value': value}}
+    
 class Decoder(nn.Module): 
     
-    def __init__(self, features: int, layers: nn.ModuleList) -> None: 
+    def __init__(self, features: int, layers: nn.ModuleList, checkpoint_every: int = 0) -> None: 
         super().__init__() 
         self.layers = layers 
         self.norm = LayerNormalization(features) 
+        self.checkpoint_every = checkpoint_every
         
-    def forward(self, x, encoder_output, src_mask, tgt_mask): 
-        for layer in self.layers: 
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None): 
+        for i, layer in enumerate(self.layers): 
+            if cache is None and checkpointed(i, self.checkpoint_every): 
+                x = checkpoint(layer, x, encoder_output, src_mask, tgt_mask, use_reentrant=False)
+            else: 
+                x = layer(x, encoder_output, src_mask, tgt_mask, None if cache is None else cache[i])
         return self.norm(x)
     
 class ProjectionLayer(nn.Module): 
@@ -182,7 +253,12 @@ class ProjectionLayer(nn.Module):
         
     def forward(self, x): 
         #(batch, seq_len, d_model) -> (batch, seq_len, vocab_size)
-        return torch.log_softmax(self.proj(x), dim=-1)
+        # log probabilities in float32, bfloat16 is too coarse for them under autocast
+        return torch.log_softmax(self.proj(x).float(), dim=-1)
+
+def padding_mask(lengths, size: int): 
+    # (batch) -> (batch, 1, 1, size), True for the real tokens, built directly on the device of lengths
+    return (torch.arange(size, device=lengths.device) < lengths.unsqueeze(1)).unsqueeze(1).unsqueeze(1)
 
 class Transformer(nn.Module): 
     
@@ -196,22 +272,64 @@ class Transformer(nn.Module):
         self.src_pos = src_pos 
         self.tgt_pos = tgt_pos 
         self.projection_layer = proj_layer
+        # lower triangular mask, grown on demand and sliced for every decode call 
+        self.register_buffer('causal', torch.ones(0, 0, dtype=torch.bool), persistent=False)
+        
+    def causal_mask(self, size: int): 
+        if self.causal.size(0) < size: 
+            self.causal = torch.tril(torch.ones(size, size, dtype=torch.bool, device=self.causal.device))
+        return self.causal[:size, :size]
         
     def encode(self, src, src_mask): 
         src = self.src_embed(src) 
         src = self.src_pos(src)
         return self.encoder(src, src_mask) 
     
-    def decode(self, encoder_output, src_mask, tgt, tgt_mask): 
+    def decode(self, encoder_output, src_mask, tgt, tgt_mask=None): 
+        # tgt_mask only has to mask the padding (batch, 1, 1, seq_len), the causal part is added here
+        causal = self.causal_mask(tgt.size(1))
+        tgt_mask = causal if tgt_mask is None else tgt_mask.bool() & causal
         tgt = self.tgt_embed(tgt) 
         tgt = self.tgt_pos(tgt) 
         return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
     
+    def init_decoder_cache(self, encoder_output): 
+        # one cache per decoder block, the cross attention keys and values are computed here once per source
+        return [layer.init_cache(encoder_output) for layer in self.decoder.layers]
+    
+    @staticmethod
+    def reorder_decoder_cache(cache, index): 
+        # keep (and possibly repeat) the batch rows selected by index, used to drop finished rows or follow beams
+        return [
+            {
+                'self': {name: t.index_select(0, index) for name, t in layer_cache['self'].items()}, 
+                'cross': {name: t.index_select(0, index) if torch.is_tensor(t) else t for name, t in layer_cache['cross'].items()}, 
+            }
+            for layer_cache in cache
+        ]
+    
+    def decode_step(self, encoder_output, src_mask, tgt, cache): 
+        # tgt only holds the new tokens (batch, n), earlier positions come from the cache
+        start_pos = cache[0]['self']['key'].shape[2] if 'key' in cache[0]['self'] else 0
+        tgt = self.tgt_embed(tgt) 
+        tgt = self.tgt_pos(tgt, start_pos) 
+        # the new tokens may attend to every cached position and causally among themselves
+        tgt_mask = None 
+        if tgt.shape[1] > 1: 
+            tgt_mask = self.causal_mask(start_pos + tgt.shape[1])[start_pos:]
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache)
+    
     def project(self, x): 
         return self.projection_layer(x)
     
+    def forward(self, src, src_mask, tgt, tgt_mask): 
+        # the whole training forward pass, DistributedDataParallel only synchronizes the gradients of
+        # what runs through forward
+        return self.project(self.decode(self.encode(src, src_mask), src_mask, tgt, tgt_mask))
+    
 def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, 
-                      d_model: int = 512, N: int = 6, h: int = 8, dropout: float = 0.1, d_ff: int = 2048) -> None: 
+                      d_model: int = 512, N: int = 6, h: int = 8, dropout: float = 0.1, d_ff: int = 2048, 
+                      fused_attention: bool = False, checkpoint_every: int = 0, cache_packed_weights: bool = False) -> None: 
     # create the embedding layers
     src_embed = InputEmbeddings(d_model, src_vocab_size) 
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
@@ -223,7 +341,7 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # create the encoder blocks 
     encoder_blocks = []
     for _ in range(N): 
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout) 
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, fused_attention, cache_packed_weights) 
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         encoder_block = EncoderBlock(d_model, encoder_self_attention_block , feed_forward_block, dropout)
         encoder_blocks.append(encoder_block) 
@@ -231,15 +349,15 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # create the decoder blocks
     decoder_blocks = [] 
     for _ in range(N): 
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout) 
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, fused_attention, cache_packed_weights)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, fused_attention, cache_packed_weights) 
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout) 
         decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout)
         decoder_blocks.append(decoder_block)
         
     # create the encoder and decoder
-    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks))
-    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks))
+    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks), checkpoint_every)
+    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks), checkpoint_every)
     
     # create the projection layer
     projection_layer = ProjectionLayer(d_model, tgt_vocab_size)
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the modules of src/ import each other by their flat names; src/ and src2/ both have a model.py,
+# so their tests run separately: python -m pytest src/tests, python -m pytest src2/tests
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from dataset import causal_mask
+from model import MultiHeadAttentionBlock, build_transformer, padding_mask
+
+
+def attention_pair(cache_packed=False, d_model=32, h=4):
+    torch.manual_seed(0)
+    eager = MultiHeadAttentionBlock(d_model, h, dropout=0.0)
+    fused = MultiHeadAttentionBlock(d_model, h, dropout=0.0, fused=True, cache_packed=cache_packed)
+    fused.load_state_dict(eager.state_dict())
+    return eager.eval(), fused.eval()
+
+def self_attention_mask(lengths, size):
+    # padding of the keys and the causal mask of the decoder, no row is masked completely
+    return padding_mask(lengths, size) & causal_mask(size)
+
+@pytest.mark.parametrize('cache_packed', [False, True])
+def test_self_attention_matches_eager(cache_packed):
+    eager, fused = attention_pair(cache_packed)
+    x = torch.randn(3, 7, 32)
+    mask = self_attention_mask(torch.tensor([7, 5, 2]), 7)
+    with torch.no_grad():
+        torch.testing.assert_close(fused(x, x, x, mask), eager(x, x, x, mask), atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(fused(x, x, x, None), eager(x, x, x, None), atol=1e-5, rtol=1e-5)
+
+def test_cross_attention_matches_eager():
+    eager, fused = attention_pair()
+    x, encoder_output = torch.randn(3, 4, 32), torch.randn(3, 9, 32)
+    mask = padding_mask(torch.tensor([9, 6, 1]), 9)
+    with torch.no_grad():
+        expected = eager(x, encoder_output, encoder_output, mask)
+        torch.testing.assert_close(fused(x, encoder_output, encoder_output, mask), expected, atol=1e-5, rtol=1e-5)
+
+def test_training_gradients_match_eager():
+    eager, fused = attention_pair()
+    x = torch.randn(2, 5, 32, requires_grad=True)
+    mask = self_attention_mask(torch.tensor([5, 3]), 5)
+    eager(x, x, x, mask).square().sum().backward()
+    eager_grads = [p.grad.clone() for p in eager.parameters()]
+    fused(x, x, x, mask).square().sum().backward()
+    for grad, p in zip(eager_grads, fused.parameters()):
+        torch.testing.assert_close(p.grad, grad, atol=1e-4, rtol=1e-4)
+
+@pytest.mark.parametrize('cache_packed', [False, True])
+def test_cached_decoding_matches_eager(cache_packed):
+    # the decoder step by step with self attention and static cross attention caches
+    torch.manual_seed(0)
+    eager = build_transformer(50, 60, 12, 12, d_model=32, N=2, h=4, dropout=0.0).eval()
+    fused = build_transformer(50, 60, 12, 12, d_model=32, N=2, h=4, dropout=0.0, fused_attention=True,
+                              cache_packed_weights=cache_packed).eval()
+    fused.load_state_dict(eager.state_dict())
+
+    src = torch.randint(0, 50, (2, 8))
+    src_mask = padding_mask(torch.tensor([8, 5]), 8)
+    tgt = torch.randint(0, 60, (2, 6))
+    with torch.no_grad():
+        outputs = []
+        for model in (eager, fused):
+            encoder_output = model.encode(src, src_mask)
+            cache = model.init_decoder_cache(encoder_output)
+            steps = [model.decode_step(encoder_output, src_mask, tgt[:, i:i + 1], cache) for i in range(tgt.shape[1])]
+            outputs.append(torch.cat(steps, dim=1))
+        torch.testing.assert_close(outputs[1], outputs[0], atol=1e-5, rtol=1e-5)
+        # and the same as the uncached decoder over the whole target
+        full = eager.decode(eager.encode(src, src_mask), src_mask, tgt)
+        torch.testing.assert_close(outputs[1], full, atol=1e-5, rtol=1e-5)
+
+def test_packed_weights_are_only_cached_when_asked():
+    for cache_packed in (False, True):
+        _, fused = attention_pair(cache_packed)
+        x = torch.randn(1, 3, 32)
+        with torch.no_grad():
+            fused(x, x, x, None)
+        assert bool(fused.packed) == cache_packed
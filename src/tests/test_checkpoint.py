@@ -0,0 +1,52 @@
+import threading
+
+import torch
+
+from checkpoint import CheckpointManager
+
+
+def write_checkpoints(manager, folder, steps):
+    for step in steps:
+        manager.save({'global_step': step, 'weights': torch.zeros(2)}, folder / f'ckpt_{step}.pt')
+    manager.wait()
+
+def test_new_run_leaves_old_checkpoints_alone(tmp_path):
+    write_checkpoints(CheckpointManager(tmp_path, keep_last=2), tmp_path, [1, 2])
+
+    # a new run in the same folder neither sees nor rotates the checkpoints of the old one
+    manager = CheckpointManager(tmp_path, keep_last=2, resume=False)
+    assert manager.latest() is None
+    write_checkpoints(manager, tmp_path, [10, 20, 30])
+    assert (tmp_path / 'ckpt_1.pt').exists() and (tmp_path / 'ckpt_2.pt').exists()
+    assert not (tmp_path / 'ckpt_10.pt').exists()
+    assert [c['global_step'] for c in manager.checkpoints] == [20, 30]
+
+def test_resumed_run_continues_the_index(tmp_path):
+    write_checkpoints(CheckpointManager(tmp_path, keep_last=2), tmp_path, [1, 2])
+
+    manager = CheckpointManager(tmp_path, keep_last=2)
+    assert manager.latest() == str(tmp_path / 'ckpt_2.pt')
+    write_checkpoints(manager, tmp_path, [3])
+    assert not (tmp_path / 'ckpt_1.pt').exists()
+    assert [c['global_step'] for c in manager.checkpoints] == [2, 3]
+
+def test_index_changes_only_once_the_checkpoint_is_written(tmp_path, monkeypatch):
+    manager = CheckpointManager(tmp_path, keep_last=1)
+    write_checkpoints(manager, tmp_path, [1])
+    save = torch.save
+    started, release = threading.Event(), threading.Event()
+
+    def slow_save(obj, path):
+        started.set()
+        release.wait()
+        save(obj, path)
+    monkeypatch.setattr(torch, 'save', slow_save)
+
+    manager.save({'global_step': 2, 'weights': torch.zeros(2)}, tmp_path / 'ckpt_2.pt', metric=0.5)
+    started.wait()
+    # while the writer thread is busy the training thread reads the previous, complete index
+    assert manager.latest() == str(tmp_path / 'ckpt_1.pt') and manager.best() is None
+    release.set()
+    manager.wait()
+    assert manager.latest() == manager.best() == str(tmp_path / 'ckpt_2.pt')
+    assert not (tmp_path / 'ckpt_1.pt').exists()
@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from dataset import BucketBatchSampler
+
+
+@pytest.mark.parametrize('num_replicas', [1, 2, 3])
+@pytest.mark.parametrize('limits', [{'batch_size': 4}, {'max_tokens': 64}])
+def test_bucket_sampler_shards_batches_between_ranks(num_replicas, limits):
+    lengths = [random.Random(i).randint(1, 30) for i in range(101)]
+    samplers = [BucketBatchSampler(lengths, seed=1, num_replicas=num_replicas, rank=rank, **limits)
+                for rank in range(num_replicas)]
+    all_batches = BucketBatchSampler(lengths, seed=1, **limits).batches()
+
+    shards = [list(sampler) for sampler in samplers]
+    for sampler, shard in zip(samplers, shards):
+        # len() and iter() agree and every rank gets the same number of batches
+        assert len(sampler) == len(shard) == len(all_batches) // num_replicas
+    # the ranks split the batches of the single process run between them, without overlap
+    num_batches = len(all_batches) - len(all_batches) % num_replicas
+    assert shards == [all_batches[rank:num_batches:num_replicas] for rank in range(num_replicas)]
+
+def test_bucket_sampler_reshuffles_per_epoch():
+    lengths = list(range(1, 50))
+    sampler = BucketBatchSampler(lengths, batch_size=4, seed=0, num_replicas=2, rank=1)
+    first = list(sampler)
+    sampler.set_epoch(1)
+    assert list(sampler) != first and len(sampler) == len(first)
@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from decode import batched_greedy_decode, beam_search_decode
+from model import build_transformer, padding_mask
+
+
+class Vocabulary:
+    # the part of a tokenizers.Tokenizer that the decoders use
+    def __init__(self, eos_idx=2):
+        self.ids = {'[SOS]': 1, '[EOS]': eos_idx}
+
+    def token_to_id(self, token):
+        return self.ids[token]
+
+def tiny_transformer(fused_attention=False):
+    torch.manual_seed(0)
+    return build_transformer(30, 30, 16, 16, d_model=16, N=2, h=2, dropout=0.0, d_ff=32,
+                             fused_attention=fused_attention).eval()
+
+def greedy_decode(model, source, eos_idx, max_len):
+    # one unpadded sentence, the whole target is decoded again at every step without a cache
+    source_mask = torch.ones(1, 1, 1, source.shape[0], dtype=torch.bool)
+    encoder_output = model.encode(source[None], source_mask)
+    tokens = torch.tensor([[1]])
+    while tokens.shape[1] < max_len:
+        out = model.decode(encoder_output, source_mask, tokens)
+        next_word = model.project(out[:, -1]).argmax(dim=-1, keepdim=True)
+        tokens = torch.cat([tokens, next_word], dim=1)
+        if next_word.item() == eos_idx:
+            break
+    return tokens[0]
+
+def padded_batch(lengths):
+    # right padded with 0 like the dataset does
+    torch.manual_seed(1)
+    sentences = [torch.randint(3, 30, (length,)) for length in lengths]
+    source = torch.zeros(len(lengths), max(lengths), dtype=torch.long)
+    for row, sentence in enumerate(sentences):
+        source[row, :len(sentence)] = sentence
+    return sentences, source, padding_mask(torch.tensor(lengths), max(lengths))
+
+@torch.no_grad()
+def test_batched_greedy_matches_every_sentence_alone():
+    model = tiny_transformer()
+    sentences, source, source_mask = padded_batch([7, 3, 5, 1])
+    # an eos some rows produce early, so they leave the batch while the others go on
+    eos_idx = greedy_decode(model, sentences[1], 2, 12)[4].item()
+
+    batched = batched_greedy_decode(model, source, source_mask, Vocabulary(eos_idx), 12, 'cpu')
+    expected = [greedy_decode(model, sentence, eos_idx, 12).tolist() for sentence in sentences]
+    assert [tokens.tolist() for tokens in batched] == expected
+    assert any(len(tokens) < 12 for tokens in expected) and any(len(tokens) == 12 for tokens in expected)
+
+@torch.no_grad()
+def test_beam_search_with_one_beam_is_greedy():
+    model = tiny_transformer()
+    sentences, source, source_mask = padded_batch([7, 3, 5, 1])
+    eos_idx = greedy_decode(model, sentences[1], 2, 12)[4].item()
+
+    beam = beam_search_decode(model, source, source_mask, Vocabulary(eos_idx), 12, 'cpu', beam_size=1)
+    greedy = batched_greedy_decode(model, source, source_mask, Vocabulary(eos_idx), 12, 'cpu')
+    assert [tokens.tolist() for tokens in beam] == [tokens.tolist() for tokens in greedy]
+
+@pytest.mark.parametrize('fused_attention', [False, True])
+@torch.no_grad()
+def test_reordered_cache_matches_decoding_without_cache(fused_attention):
+    model = tiny_transformer(fused_attention)
+    _, source, source_mask = padded_batch([6, 2, 4])
+    encoder_output = model.encode(source, source_mask)
+    target = torch.randint(3, 30, (3, 5))
+
+    cache = model.init_decoder_cache(encoder_output)
+    model.decode_step(encoder_output, source_mask, target[:, :4], cache)
+    # drop a row and repeat another one, like finished sentences and beams that split
+    index = torch.tensor([2, 0, 0])
+    cache = model.reorder_decoder_cache(cache, index)
+    encoder_output, source_mask, target = encoder_output[index], source_mask[index], target[index]
+    out = model.decode_step(encoder_output, source_mask, target[:, 4:], cache)
+
+    fresh = model.init_decoder_cache(encoder_output)
+    expected = model.decode_step(encoder_output, source_mask, target, fresh)
+    torch.testing.assert_close(out[:, -1], expected[:, -1], atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(out[:, -1], model.decode(encoder_output, source_mask, target)[:, -1],
+                               atol=1e-5, rtol=1e-5)
+    for layer_cache, fresh_cache in zip(cache, fresh):
+        for part in ('self', 'cross'):
+            torch.testing.assert_close(layer_cache[part]['key'], fresh_cache[part]['key'])
+            torch.testing.assert_close(layer_cache[part]['value'], fresh_cache[part]['value'])
@@ -0,0 +1,55 @@
+import torch
+from torch._dynamo.utils import counters
+
+from decode import translate
+from inference import CompiledTransformer, benchmark_translate
+from model import build_transformer, padding_mask
+
+
+class Vocabulary:
+    # the part of a tokenizers.Tokenizer that translate() uses
+    def token_to_id(self, token):
+        return {'[SOS]': 1, '[EOS]': 2}[token]
+
+def tiny_transformer():
+    torch.manual_seed(0)
+    return build_transformer(30, 30, 16, 16, d_model=16, N=1, h=2, dropout=0.0, d_ff=32).eval()
+
+def test_compiled_translation_matches_eager():
+    # the eager backend goes through dynamo (graph capture and guards) without the slow inductor codegen
+    model = tiny_transformer()
+    compiled = CompiledTransformer(model, backend='eager')
+    compiled.warmup(Vocabulary(), batch_sizes=(2,), max_len=8, device='cpu', source_lengths=(6,))
+    assert all(c is not None for c in compiled.compiled.values())
+
+    for length in (6, 9):
+        source = torch.randint(3, 30, (2, length))
+        source_mask = padding_mask(torch.tensor([length, 3]), length)
+        for beam_size in (1, 2):
+            with torch.no_grad():
+                expected = translate(model, source, source_mask, Vocabulary(), 8, 'cpu', beam_size)
+                actual = translate(compiled, source, source_mask, Vocabulary(), 8, 'cpu', beam_size)
+            assert [t.tolist() for t in actual] == [t.tolist() for t in expected]
+
+def test_warmed_up_graphs_serve_every_source_length():
+    torch._dynamo.reset()
+    model = tiny_transformer()
+    compiled = CompiledTransformer(model, backend='eager', pad_multiple=8)
+    compiled.warmup(Vocabulary(), batch_sizes=(2,), max_len=8, device='cpu')
+    num_graphs = counters['stats']['unique_graphs']
+
+    # the sources are padded to 8 or 16, the decoding steps share their graphs whatever the length
+    for length in (3, 5, 9, 16):
+        source = torch.randint(3, 30, (2, length))
+        source_mask = padding_mask(torch.tensor([length, 2]), length)
+        with torch.no_grad():
+            expected = translate(model, source, source_mask, Vocabulary(), 8, 'cpu')
+            actual = translate(compiled, source, source_mask, Vocabulary(), 8, 'cpu')
+        assert [t.tolist() for t in actual] == [t.tolist() for t in expected]
+    assert counters['stats']['unique_graphs'] == num_graphs
+
+def test_benchmark_translate():
+    source = torch.randint(3, 30, (2, 5))
+    times = benchmark_translate(tiny_transformer(), source, padding_mask(torch.tensor([5, 4]), 5), Vocabulary(),
+                                6, 'cpu', num_runs=1, backend='eager')
+    assert set(times) == {'eager', 'compiled'} and all(t > 0 for t in times.values())
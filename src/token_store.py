@@ -0,0 +1,37 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+import shared  # noqa: F401, makes the common package importable
+from common.store import RaggedArrays, RaggedArraysWriter, file_sha256
+
+
+# The token ids of every sentence pair as int32 RaggedArrays with the arrays 'src' and 'tgt':
+# get('src', i) are the source ids of sentence i, lengths('src') the lengths of all of them.
+TokenStore = RaggedArrays
+
+def _write_side(writer, side, sentences, tokenizer, chunk_size):
+    for start in range(0, len(sentences), chunk_size):
+        # encode_batch tokenizes the chunk in parallel on the rust side
+        for encoding in tokenizer.encode_batch(sentences[start:start + chunk_size]):
+            writer.append(side, encoding.ids)
+
+def build_token_store(config, ds_raw, tokenizer_src, tokenizer_tgt, chunk_size=10_000):
+    # the store is only valid for these exact tokenizers and this dataset
+    key = hashlib.sha256()
+    for lang in (config['lang_src'], config['lang_tgt']):
+        key.update(file_sha256(config['tokenizer_file'].format(lang)).encode())
+    key.update(str(getattr(ds_raw, '_fingerprint', len(ds_raw))).encode())
+    folder = Path(config['token_store_folder']) / f'{config["lang_src"]}-{config["lang_tgt"]}-{key.hexdigest()[:16]}'
+
+    if RaggedArrays.exists(folder):
+        return TokenStore(folder)
+
+    print(f'Building token store {folder}')
+    with RaggedArraysWriter(folder, {'src': np.int32, 'tgt': np.int32}) as writer:
+        src_sentences = [item['translation'][config['lang_src']] for item in ds_raw]
+        tgt_sentences = [item['translation'][config['lang_tgt']] for item in ds_raw]
+        _write_side(writer, 'src', src_sentences, tokenizer_src, chunk_size)
+        _write_side(writer, 'tgt', tgt_sentences, tokenizer_tgt, chunk_size)
+        return writer.close()
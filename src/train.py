@@ -1,9 +1,17 @@
 import torch 
 import torch.nn as nn 
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import Dataset, DataLoader, random_split
 
-from dataset import BilingualDataset, causal_mask
-from src2.model import build_transformer
+from dataset import BilingualDataset, BucketBatchSampler
+from decode import translate
+from token_store import build_token_store
+from model import build_transformer, padding_mask
+from checkpoint import CheckpointManager
+from inference import CompiledTransformer
+import shared  # noqa: F401, makes the common package importable
+from common.activation import activation_memory_report
+from common.distributed import all_reduce_sum, barrier, cleanup_distributed, is_main_process, main_process_first, setup_distributed
 import config
 from config import get_config, get_weights_file_path
 
@@ -17,35 +25,10 @@ from torch.utils.tensorboard import SummaryWriter
 
 from pathlib import Path 
 from tqdm import tqdm
+from contextlib import nullcontext
+import time
 
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device): 
-    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
-    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
-    
-    # precompute the encoder output and reuse it for every token we get from the decoder
-    encoder_output = model.encode(source, source_mask) 
-    # initiate the decoder input with the sos token 
-    decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(device) 
-    while True: 
-        if decoder_input.size(1) == max_len: 
-            break 
-        
-        # build mask for the target (decoder input)
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-        
-        # calcualte the output of the decoder
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
-        
-        # get the next token 
-        prob = model.project(out[:, -1])
-        # select the token with the max probability because it is a greedy search
-        _, next_word = torch.max(prob, dim=1)
-        decoder_input = torch.cat([decoder_input, torch.empty(1, 1).type_as(source).fill_(next_word.item()).to(device)], dim=1)
-        if next_word == eos_idx: 
-            break 
-    return decoder_input.squeeze(0)
-
-def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, gloabl_state, writer, num_examples=2):
+def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, gloabl_state, writer, num_examples=2, beam_size=1):
     model.eval()
     count = 0 
     
@@ -58,31 +41,52 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
     
     with torch.no_grad(): 
         for batch in validation_ds: 
-            count += 1
-            encoder_input = batch['encoder_input'].to(device) 
-            encoder_mask = batch['encoder_mask'].to(device) 
-            
-            assert encoder_input.size(0) == 1, "batch size must be 1 for valiadtion"
-            
-            model_output = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
-            
-            source_text = batch['src_text'][0]
-            target_text = batch['tgt_text'][0]
-            model_out_text = tokenizer_tgt.decode(model_output.detach().cpu().numpy())
+            # only decode as many sentences of the batch as we still want to show
+            remaining = num_examples - count
+            encoder_input = batch['encoder_input'][:remaining].to(device) 
+            encoder_mask = padding_mask(batch['encoder_len'][:remaining].to(device), encoder_input.size(1)) 
             
-            # source_text.append(source_text)
-            # expected.append(target_text)
-            # predicted.append(model_out_text)
+            # all the sentences of the batch are decoded together
+            model_outputs = translate(model, encoder_input, encoder_mask, tokenizer_tgt, max_len, device, beam_size)
             
-            # print to the console
-            print_msg('-' * console_width)
-            print_msg(f'SOURCE: {source_text}')
-            print_msg(f'TARGET: {target_text}')
-            print_msg(f'PREDICTED: {model_out_text}')
+            for i, model_output in enumerate(model_outputs): 
+                count += 1
+                source_text = batch['src_text'][i]
+                target_text = batch['tgt_text'][i]
+                model_out_text = tokenizer_tgt.decode(model_output.detach().cpu().numpy())
+                
+                # source_text.append(source_text)
+                # expected.append(target_text)
+                # predicted.append(model_out_text)
+                
+                # print to the console
+                print_msg('-' * console_width)
+                print_msg(f'SOURCE: {source_text}')
+                print_msg(f'TARGET: {target_text}')
+                print_msg(f'PREDICTED: {model_out_text}')
             
             if count == num_examples:
                 break
     
+def validation_loss(model, validation_ds, loss_fn, pad_id, vocab_size, device): 
+    # mean loss per target token over the whole validation set, used to keep the best checkpoint
+    model.eval()
+    total_loss, total_tokens = 0.0, 0 
+    with torch.no_grad(): 
+        for batch in validation_ds: 
+            encoder_input = batch['encoder_input'].to(device) 
+            decoder_input = batch['decoder_input'].to(device) 
+            encoder_mask = padding_mask(batch['encoder_len'].to(device), encoder_input.size(1)) 
+            decoder_mask = padding_mask(batch['decoder_len'].to(device), decoder_input.size(1)) 
+            label = batch['label'].to(device) 
+            
+            encoder_output = model.encode(encoder_input, encoder_mask) 
+            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask) 
+            proj_output = model.project(decoder_output) 
+            total_loss += loss_fn(proj_output.view(-1, vocab_size), label.view(-1)).item()
+            total_tokens += (label != pad_id).sum().item()
+    return total_loss / max(total_tokens, 1)
+
 def get_all_sentences(ds, lang): 
     for item in ds: 
         yield item['translation'][lang]
@@ -100,114 +104,227 @@ def get_or_build_tokenizer(config, ds, lang):
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer 
 
-def get_ds(config): 
-    ds_raw = load_dataset('opus_books', f'{config["lang_src"]}-{config["lang_tgt"]}', split='train')
-    
-    # build tokenizers 
-    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
-    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+def get_ds(config, num_replicas=1, rank=0): 
+    # rank 0 downloads the dataset and builds the tokenizers and the token store, the other ranks load them
+    with main_process_first(): 
+        ds_raw = load_dataset('opus_books', f'{config["lang_src"]}-{config["lang_tgt"]}', split='train')
+        
+        # build tokenizers 
+        tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+        tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+        
+        # tokenize everything once, the datasets (and every DataLoader worker) then only slice the stored ids
+        token_store = build_token_store(config, ds_raw, tokenizer_src, tokenizer_tgt)
     
     # keep 90% for training and 10% for validation
     train_ds_size = int(0.9 * len(ds_raw)) 
     val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
+    # the same split on every rank
+    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size], generator=torch.Generator().manual_seed(0))
     
-    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_store)
+    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_store)
     
-    max_len_src = 0
-    max_len_tgt = 0 
-    
-    for item in ds_raw: 
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    max_len_src = int(token_store.lengths('src').max())
+    max_len_tgt = int(token_store.lengths('tgt').max())
     
     print(f"Max length of source sequence: {max_len_src}")
     print(f"Max length of target sequence: {max_len_tgt}")
     
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # batches of similar lengths, padded only to their longest sentence, either a fixed number of
+    # sentences or as many as fit into the token budget
+    max_tokens = config['max_tokens_per_batch']
+    train_sampler = BucketBatchSampler(train_ds.token_lengths(), batch_size=None if max_tokens else config['batch_size'], max_tokens=max_tokens, num_replicas=num_replicas, rank=rank)
+    train_dataloader = DataLoader(train_ds, batch_sampler=train_sampler, collate_fn=train_ds.collate)
+    val_dataloader = DataLoader(val_ds, batch_size=config['batch_size'], shuffle=True, collate_fn=val_ds.collate)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
+def apply_accumulated_step(model, optimizer, num_tokens): 
+    # the gradients hold the summed loss of every micro-batch of the step, dividing them by the
+    # number of target tokens gives the gradient of the mean loss over the whole effective batch
+    for p in model.parameters(): 
+        if p.grad is not None: 
+            p.grad.div_(num_tokens)
+    optimizer.step() 
+    optimizer.zero_grad() 
+
+def get_preload_path(config, checkpoints): 
+    preload = config['preload']
+    if preload in ('latest', 'best'): 
+        path = checkpoints.latest() if preload == 'latest' else checkpoints.best()
+        if path is None: 
+            raise FileNotFoundError(f"No checkpoint to preload in {config['model_folder']}")
+        return path 
+    if Path(preload).exists(): 
+        return preload 
+    return get_weights_file_path(config, preload)
+
 def get_model(config, vocab_src_len, vocab_tgt_len): 
     
-    model =build_transformer(vocab_src_len, vocab_tgt_len, config['seq_len'], config['seq_len'], config['d_model'])
+    model =build_transformer(vocab_src_len, vocab_tgt_len, config['seq_len'], config['seq_len'], config['d_model'], 
+                             fused_attention=config['fused_attention'], checkpoint_every=config['activation_checkpointing'])
     return model
     
     
-def train_model(conifig): 
-    # define the device 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu')
-    print(f'Using device {device}')
+def train_model(config): 
+    # several processes when started by torchrun, each one trains on its share of the batches
+    rank, world_size = setup_distributed()
+    distributed = world_size > 1 
+    # define the device, the gloo backend all-reduces CPU tensors
+    if distributed: 
+        device = torch.device('cpu')
+    else: 
+        device = torch.device('cuda' if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu')
+    print(f'Using device {device}' + (f' on {world_size} ranks' if distributed else ''))
     
     Path(config['model_folder']).mkdir(parents=True, exist_ok=True) 
     
-    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config) 
+    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config, world_size, rank) 
     model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
-    # tensorboard 
-    writer = SummaryWriter(config['experiment_name']) 
+    # tensorboard, only rank 0 logs
+    writer = SummaryWriter(config['experiment_name']) if is_main_process() else None 
     
     optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9)
     
+    every_minutes = config['checkpoint_every_minutes']
+    checkpoints = CheckpointManager(config['model_folder'], keep_last=config['checkpoint_keep_last'], 
+                                    every_steps=config['checkpoint_every_steps'], 
+                                    every_seconds=every_minutes * 60 if every_minutes else None, 
+                                    resume=bool(config['preload']))
+    
     initial_epoch = 0
     global_step = 0 
+    # batches of initial_epoch that were already trained on before the checkpoint
+    skip_batches = 0 
     if config['preload']: 
-        model_filename = get_weights_file_path(config, config['prelaod'])
+        model_filename = get_preload_path(config, checkpoints)
         print(f'Preloading model {model_filename}')
-        state = torch.load(model_filename)
-        initial_epoch = state['epoch'] + 1
+        state = torch.load(model_filename, map_location=device)
+        model.load_state_dict(state['model_state_dict'])
         optimizer.load_state_dict(state['optimizer_state_dict'])
-        global_step = state['global_step'] + 1
+        # global_step is saved after the increment, it already is the number of the next step
+        global_step = state['global_step']
+        if state.get('batch') is None: 
+            initial_epoch = state['epoch'] + 1
+        else: 
+            # written within the epoch, the sampler gives the same batches again so the done ones are skipped
+            initial_epoch = state['epoch']
+            skip_batches = state['batch']
+    
+    # the ranks start from the same weights (rank 0's), the gradients are all-reduced in buckets while
+    # backward is still running, model is the wrapped and raw_model the plain Transformer
+    raw_model = model 
+    if distributed: 
+        model = DistributedDataParallel(model, bucket_cap_mb=config['ddp_bucket_cap_mb'])
         
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
+    pad_id = tokenizer_src.token_to_id('[PAD]')
+    # summed so that micro-batches with different numbers of tokens can be accumulated exactly
+    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_id, label_smoothing=0.1, reduction='sum').to(device)
+    # effective batch size in target tokens, None steps after every micro-batch
+    tokens_per_step = config['tokens_per_step']
+    
+    # bf16 autocast: matmuls run in bfloat16 while the optimizer keeps updating the float32 weights
+    use_bf16 = config['mixed_precision'] == 'bf16'
+    report_memory = config['report_activation_memory']
+    # the validation translations can run through torch.compile, the compiled methods share the weights being trained
+    inference_model = CompiledTransformer(raw_model) if config['compile_inference'] else raw_model
+    if config['compile_inference'] and is_main_process(): 
+        # compiles the graphs before the first epoch instead of in the middle of its validation, the
+        # validation translates its 2 examples at once; the other ranks wait at the barrier
+        inference_model.warmup(tokenizer_tgt, batch_sizes=(min(2, config['batch_size']),), max_len=config['seq_len'], 
+                               device=device, beam_size=config['beam_size'])
+    barrier()
     
     for epoch in range(initial_epoch, config['num_epochs']): 
         model.train() 
-        batch_iterator = tqdm(train_dataloader, desc=f'Processing epoch {epoch:02d}')
-        for batch in batch_iterator: 
+        train_dataloader.batch_sampler.set_epoch(epoch)
+        batch_iterator = tqdm(train_dataloader, desc=f'Processing epoch {epoch:02d}', disable=not is_main_process())
+        step_tokens, step_loss, step_start = 0, 0.0, time.perf_counter()
+        for i, batch in enumerate(batch_iterator): 
+            if epoch == initial_epoch and i < skip_batches: 
+                continue 
             
             encoder_input = batch['encoder_input'].to(device) # (batch, seq_len) 
             decoder_input = batch['decoder_input'].to(device) # (batch, seq_len) 
-            encoder_mask = batch['encoder_mask'].to(device) # (batch, 1, 1, seq_len)
-            decoder_mask = batch['decoder_mask'].to(device) # (batch, 1, seq_len, seq_len)
-            
-            # run the tensors through the transformer
-            encoder_output = model.encode(encoder_input, encoder_mask) # (batch, seq_len , d_model)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask) # (batch, seq_len, vocab_size)
-            proj_output = model.project(decoder_output) # (batch, seq_len, tgt_vocab_size) 
+            # only the lengths travel to the device, the masks are built there
+            encoder_mask = padding_mask(batch['encoder_len'].to(device), encoder_input.size(1)) # (batch, 1, 1, seq_len)
+            decoder_mask = padding_mask(batch['decoder_len'].to(device), decoder_input.size(1)) # (batch, 1, 1, seq_len), made causal in decode
             
             label = batch['label'].to(device) # (batch, seq_len) 
             
-            # (bat, seql_len, tgt_vocab_size) -> (batch * seql_len, tgt_vocab_size)
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({f"loss": f"{loss.item():6.3f}"})
+            if report_memory: 
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16): 
+                    activation_memory_report(raw_model, lambda: raw_model(encoder_input, encoder_mask, decoder_input, decoder_mask))
+                report_memory = False 
             
-            # log the loss 
-            writer.add_scalar('train loss', loss.item(), global_step)
-            writer.flush() 
+            # target tokens of this micro-batch on all ranks, so that every rank decides the same about stepping
+            num_tokens = int(all_reduce_sum((label != pad_id).sum().item()))
+            step_tokens += num_tokens 
+            last_micro_batch = tokens_per_step is None or step_tokens >= tokens_per_step or i == len(train_dataloader) - 1 
             
-            # backpropagate the loss
-            loss.backward() 
+            # the gradients of the micro-batches before the last one of the step are only all-reduced with it
+            with model.no_sync() if distributed and not last_micro_batch else nullcontext(): 
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16): 
+                    # run the tensors through the transformer
+                    proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask) # (batch, seq_len, tgt_vocab_size) 
+                    
+                    # (bat, seql_len, tgt_vocab_size) -> (batch * seql_len, tgt_vocab_size)
+                    loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
+                batch_iterator.set_postfix({f"loss": f"{loss.item() * world_size / num_tokens:6.3f}"})
+                
+                # backpropagate the loss, the gradients add up until the step has enough tokens
+                loss.backward() 
+            step_loss += loss.item()
             
-            # update the weights 
-            optimizer.step() 
-            optimizer.zero_grad() 
-            
-            global_step += 1
+            if last_micro_batch: 
+                # update the weights, the all-reduce averaged the summed gradients over the ranks
+                apply_accumulated_step(model, optimizer, step_tokens / world_size)
+                
+                # log the loss and the throughput of the step
+                step_loss = all_reduce_sum(step_loss)
+                if writer is not None: 
+                    writer.add_scalar('train loss', step_loss / step_tokens, global_step)
+                    writer.add_scalar('train tokens/sec', step_tokens / (time.perf_counter() - step_start), global_step)
+                    writer.flush() 
+                
+                global_step += 1
+                step_tokens, step_loss, step_start = 0, 0.0, time.perf_counter()
+                
+                if checkpoints.should_save(global_step) and is_main_process(): 
+                    # only between optimizer steps, so no accumulated gradients are lost
+                    checkpoints.save({
+                        'epoch': epoch, 
+                        'batch': i + 1, 
+                        'model_state_dict': raw_model.state_dict(), 
+                        'optimizer_state_dict': optimizer.state_dict(), 
+                        'global_step': global_step, 
+                    }, get_weights_file_path(config, f'{epoch:02d}_step{global_step:07d}'))
         
-        run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer)
+        # validation and checkpoints are rank 0's, the other ranks wait for it at the barrier instead of
+        # in the first all-reduce of the next epoch, where the collective timeout could run out
+        if is_main_process(): 
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16): 
+                run_validation(inference_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer, beam_size=config['beam_size'])
+                val_loss = validation_loss(raw_model, val_dataloader, loss_fn, pad_id, tokenizer_tgt.get_vocab_size(), device)
+            writer.add_scalar('validation loss', val_loss, global_step)
+            writer.flush() 
+        barrier()
+        if not is_main_process(): 
+            continue 
             
-        # save the mode lat the end of every epoch 
+        # save the model at the end of every epoch, written in the background while the next epoch trains
         model_filename = get_weights_file_path(config, f'{epoch:02d}')
-        torch.save({
+        checkpoints.save({
             'epoch': epoch, 
-            'model_state_dict': model.state_dict(), 
+            'batch': None, 
+            'model_state_dict': raw_model.state_dict(), 
             'optimizer_state_dict': optimizer.state_dict(), 
             'global_step': global_step, 
-        }, model_filename)
+        }, model_filename, metric=val_loss)
+    
+    checkpoints.wait()
+    cleanup_distributed()
         
 if __name__ == '__main__': 
     config = get_config() 
@@ -1,5 +1,10 @@
-from gpt_download import download_and_load_gpt2 
+from gpt_weights import load_gpt2_state_dict, load_gpt_model
+from generation import GenerationStats, SpeculativeStats, next_cache_input, speculative_generate, stream_generate
+import shared  # noqa: F401, makes the common package importable
+from common.distributed import cleanup_distributed, is_main_process, main_process_first, setup_distributed
 
+import sys
+import time
 import torch 
 import torch.nn as nn 
 import torch.nn.functional as F 
@@ -11,15 +16,21 @@ import tiktoken
 
 from model import GPTModel
 
-settings, params = download_and_load_gpt2(
-    model_size='124M', models_dir='gpt2'
-)
+# data parallel fine-tuning when the script is started by torchrun, e.g. torchrun --nproc_per_node=4 "ch5&6.py",
+# downloads and caches are then created by rank 0 and only rank 0 prints and writes files
+rank, world_size = setup_distributed()
+
+# the TF checkpoint is converted to safetensors once, afterwards the weights are memory mapped without TensorFlow
+with main_process_first(): 
+    settings, state_dict = load_gpt2_state_dict(
+        model_size='124M', models_dir='gpt2'
+    )
 
 print("Setting:", settings)
-print("Parameter dictionary keys:", params.keys())
+print("State dict keys:", list(state_dict.keys())[:8], "...")
 
-print(params["wte"])
-print("Token embedding weight tensor dimensions:", params["wte"].shape)
+print(state_dict["tok_emb.weight"])
+print("Token embedding weight tensor dimensions:", state_dict["tok_emb.weight"].shape)
 
 GPT_CONFIG_124M = {
     "vocab_size": 50257, 
@@ -46,89 +57,29 @@ print(NEW_CONFIG)
 NEW_CONFIG.update({"context_length": 1024})
 NEW_CONFIG.update({"qkv_bias": True})
 
-gpt = GPTModel(NEW_CONFIG)
+# created on the meta device and assigned the (memory mapped) tensors of the state dict, so no
+# parameter memory is allocated or randomly initialized
+gpt = load_gpt_model(NEW_CONFIG, state_dict)
 gpt.eval()
-
-def assign(left, right): 
-    if left.shape != right.shape: 
-        raise ValueError(f"Shape mismatch. Left: {left.shape}, "
-                         "Right: {right.shape}")
-    
-    return torch.nn.Parameter(torch.tensor(right))
-
-def load_weights_into_gpt(gpt, params): 
-    gpt.pos_emb.weight = assign(gpt.pos_emb.weight, params['wpe'])
-    gpt.tok_emb.weight = assign(gpt.tok_emb.weight, params['wte'])
-    
-    for b in range(len(params['blocks'])): 
-        q_w, k_w, v_w = np.split(
-            (params['blocks'][b]['attn']['c_attn'])['w'], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.weight = assign(
-            gpt.trf_blocks[b].att.W_query.weight, q_w.T)
-        gpt.trf_blocks[b].att.W_key.weight = assign(
-            gpt.trf_blocks[b].att.W_key.weight, k_w.T)
-        gpt.trf_blocks[b].att.W_value.weight = assign(
-            gpt.trf_blocks[b].att.W_value.weight, v_w.T)
-        
-        q_b, k_b, v_b = np.split(
-            (params['blocks'][b]['attn']['c_attn'])['b'], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.bias = assign(
-            gpt.trf_blocks[b].att.W_query.bias, q_b)
-        gpt.trf_blocks[b].att.W_key.bias = assign(
-            gpt.trf_blocks[b].att.W_key.bias, k_b)
-        gpt.trf_blocks[b].att.W_value.bias = assign(
-            gpt.trf_blocks[b].att.W_value.bias, v_b)
-        
-        gpt.trf_blocks[b].att.out_proj.weight = assign(
-            gpt.trf_blocks[b].att.out_proj.weight,
-            params['blocks'][b]['attn']['c_proj']['w'].T)
-        gpt.trf_blocks[b].att.out_proj.bias = assign(
-        gpt.trf_blocks[b].att.out_proj.bias,
-        params["blocks"][b]["attn"]["c_proj"]["b"])
-        
-        gpt.trf_blocks[b].ff.layers[0].weight = assign(
-        gpt.trf_blocks[b].ff.layers[0].weight,
-        params["blocks"][b]["mlp"]["c_fc"]["w"].T)
-        gpt.trf_blocks[b].ff.layers[0].bias = assign(
-        gpt.trf_blocks[b].ff.layers[0].bias,
-        params["blocks"][b]["mlp"]["c_fc"]["b"])
-        gpt.trf_blocks[b].ff.layers[2].weight = assign(
-        gpt.trf_blocks[b].ff.layers[2].weight,
-        params["blocks"][b]["mlp"]["c_proj"]["w"].T)
-        gpt.trf_blocks[b].ff.layers[2].bias = assign(
-        gpt.trf_blocks[b].ff.layers[2].bias,
-        params["blocks"][b]["mlp"]["c_proj"]["b"])
-        gpt.trf_blocks[b].norm1.scale = assign(
-        gpt.trf_blocks[b].norm1.scale,
-        params["blocks"][b]["ln_1"]["g"])
-        gpt.trf_blocks[b].norm1.shift = assign(
-        gpt.trf_blocks[b].norm1.shift,
-        params["blocks"][b]["ln_1"]["b"])
-        gpt.trf_blocks[b].norm2.scale = assign(
-        gpt.trf_blocks[b].norm2.scale,
-        params["blocks"][b]["ln_2"]["g"])
-        gpt.trf_blocks[b].norm2.shift = assign(
-        gpt.trf_blocks[b].norm2.shift,
-        params["blocks"][b]["ln_2"]["b"])
-        
-    gpt.final_norm.scale = assign(gpt.final_norm.scale, params["g"])
-    gpt.final_norm.shift = assign(gpt.final_norm.shift, params["b"])
-    gpt.out_head.weight = assign(gpt.out_head.weight, params["wte"])
-    
-load_weights_into_gpt(gpt, params)
 device = torch.device('cuda' if torch.cuda.is_available() 
                       else 'mps' if torch.backends.mps.is_available() 
                       else 'cpu')
 print(device)
-gpt.to(device)
+# the model is only used for inference here, torch.bfloat16 halves the memory of the weights
+INFERENCE_DTYPE = torch.float32 
+gpt.to(device, dtype=INFERENCE_DTYPE)
 
 torch.manual_seed(123)
 def generate(model, idx, max_new_tokens, context_size, top_k, temperature): 
+    # the prompt is processed once, afterwards only the newest token goes 
+    # through the model and attends to the cached keys and values 
+    kv_caches = None 
+    idx_cond = idx[:, -context_size:]
     for _ in range(max_new_tokens): 
-        idx_cond = idx[:, -context_size:]
         with torch.no_grad(): 
-            logits = model(idx_cond) 
-        logits = logits[:, -1, :]
+            logits, kv_caches = model(idx_cond, kv_caches=kv_caches, use_cache=True) 
+        # sample in float32 even when the weights are stored in bfloat16
+        logits = logits[:, -1, :].float()
         if top_k is not None: 
             top_logits, _ = torch.topk(logits, top_k)
             min_val = top_logits[:, -1] 
@@ -144,6 +95,7 @@ def generate(model, idx, max_new_tokens, context_size, top_k, temperature):
         else:
             idx_next = torch.argmax(logits, dim=-1, keepdim=True)
         idx = torch.cat((idx, idx_next), dim=1)
+        idx_cond, kv_caches = next_cache_input(idx, idx_next, kv_caches, context_size)
     return idx
 
 def text_to_token_ids(text, tokenizer):
@@ -168,6 +120,24 @@ token_ids = generate(
 
 print("Output text:\n", token_ids_to_text(token_ids, tokenizer))
 
+# the same generation streamed token by token, stopping at <|endoftext|> or an empty line
+stats = GenerationStats()
+for _, text in stream_generate(
+    model=gpt, 
+    idx=text_to_token_ids("Every effort moves you", tokenizer).to(device), 
+    max_new_tokens=25, 
+    context_size=NEW_CONFIG["context_length"], 
+    top_k=50, 
+    temperature=1.5, 
+    tokenizer=tokenizer, 
+    stop_strings=("\n\n",), 
+    stats=stats
+): 
+    print(text, end="", flush=True)
+print(f"\nTime to first token: {stats.time_to_first_token * 1000:.1f} ms, "
+      f"mean inter-token latency: {stats.mean_inter_token_latency * 1000:.1f} ms, "
+      f"stopped by: {stats.stop_reason}")
+
 ### chapter 6 
 import urllib.request 
 import zipfile 
@@ -196,9 +166,11 @@ def download_and_unzip_spam_data(
     os.rename(original_file_path, data_file_path) 
     print(f"File downloaded and saved as {data_file_path}")
     
-download_and_unzip_spam_data(url, zip_path, extracted_path, data_file_path)
-
 import pandas as pd 
+
+with main_process_first(): 
+    download_and_unzip_spam_data(url, zip_path, extracted_path, data_file_path)
+
 df = pd.read_csv(
     data_file_path, sep="\t", header=None, names=["label", "text"]
 )
@@ -236,9 +208,10 @@ train_df, validation_df, test_df = random_split(
     balanced_df, 0.7, 0.1
 )
 
-train_df.to_csv("train.csv", index=None)
-validation_df.to_csv("validation.csv", index=None)
-test_df.to_csv("test.csv", index=None)
+if is_main_process(): 
+    train_df.to_csv("train.csv", index=None)
+    validation_df.to_csv("validation.csv", index=None)
+    test_df.to_csv("test.csv", index=None)
 
 import tiktoken
 tokenizer = tiktoken.get_encoding("gpt2")
@@ -247,85 +220,77 @@ print(tokenizer.encode("<|endoftext|>", allowed_special={"<|endoftext|>"}))
 import torch 
 from torch.utils.data import Dataset 
 
+from tokenized import cached_tokenize_csv
+
 class SpamDataset(Dataset): 
     def __init__(self, csv_file, tokenizer, max_length=None, 
                  pad_token_id=50256): 
         self.data = pd.read_csv(csv_file)
-        
-        self.encoded_texts = [
-            tokenizer.encode(text) for text in self.data['text']
-        ]
+        self.labels = torch.tensor(self.data['label'].values, dtype=torch.long)
+        # the ids of all texts in one int32 array plus offsets, cached on disk per file content
+        self.tokens = cached_tokenize_csv(csv_file, tokenizer)
+        self.pad_token_id = pad_token_id 
         
         if max_length is None: 
-            self.max_length = self._longest_encoded_length()
+            self.max_length = int(self.tokens.lengths().max())
         else: 
             self.max_length = max_length 
-            
-            self.encoded_texts = [
-                encoded_text[:self.max_length]
-                for encoded_text in self.encoded_texts
-            ]
-            
-        self.encoded_texts = [
-            encoded_text + [pad_token_id] * 
-            (self.max_length - len(encoded_text))
-            for encoded_text in self.encoded_texts
-        ]
     
     def __len__(self): 
         return len(self.data) 
     
     def __getitem__(self, index): 
-        encoded = self.encoded_texts[index]
-        label = self.data.iloc[index]['label'] 
-        return (
-            torch.tensor(encoded, dtype=torch.long), 
-            torch.tensor(label, dtype=torch.long)
-        )
-        
-    def _longest_encoded_length(self): 
-        max_length = 0 
-        for encoded_text in self.encoded_texts: 
-            encoded_length = len(encoded_text) 
-            if encoded_length > max_length: 
-                max_length = encoded_length 
-        return max_length 
+        ids = self.tokens.get(index)[:self.max_length]
+        encoded = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        encoded[:len(ids)] = torch.from_numpy(ids.astype(np.int64))
+        return encoded, self.labels[index]
     
-train_dataset = SpamDataset(
-    csv_file='train.csv', 
-    max_length=None, 
-    tokenizer=tokenizer 
-)
-print(len(train_dataset.encoded_texts))
+with main_process_first(): 
+    train_dataset = SpamDataset(
+        csv_file='train.csv', 
+        max_length=None, 
+        tokenizer=tokenizer 
+    )
+print(len(train_dataset))
 
 print(train_dataset.max_length)
 
-val_dataset = SpamDataset(
-    csv_file='validation.csv', 
-    max_length=train_dataset.max_length, 
-    tokenizer=tokenizer 
-)
-test_dataset = SpamDataset(
-    csv_file='test.csv', 
-    max_length=train_dataset.max_length, 
-    tokenizer=tokenizer 
-)
+with main_process_first(): 
+    val_dataset = SpamDataset(
+        csv_file='validation.csv', 
+        max_length=train_dataset.max_length, 
+        tokenizer=tokenizer 
+    )
+    test_dataset = SpamDataset(
+        csv_file='test.csv', 
+        max_length=train_dataset.max_length, 
+        tokenizer=tokenizer 
+    )
 
 print(val_dataset.max_length)
 print(test_dataset.max_length)
 
 from torch.utils.data import DataLoader
+from classify import classify, last_token_logits, pad_batch
 
 num_workers = 0 
 batch_size = 8
 torch.manual_seed(123)
 
+# with several ranks every rank trains on its own shard of the training set
+train_sampler = None 
+if world_size > 1: 
+    from torch.utils.data.distributed import DistributedSampler
+    train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=123, drop_last=True)
+
 train_loader = DataLoader(
     dataset=train_dataset, 
     batch_size=batch_size, 
-    shuffle=True, 
+    shuffle=train_sampler is None, 
+    sampler=train_sampler, 
     num_workers=num_workers, 
     drop_last=True, 
+    collate_fn=pad_batch, 
 )
 val_loader = DataLoader(
     dataset=val_dataset, 
@@ -333,6 +298,7 @@ val_loader = DataLoader(
     shuffle=False, 
     num_workers=num_workers, 
     drop_last=False, 
+    collate_fn=pad_batch, 
 )
 test_loader = DataLoader(
     dataset=test_dataset, 
@@ -340,6 +306,7 @@ test_loader = DataLoader(
     shuffle=False, 
     num_workers=num_workers, 
     drop_last=False,
+    collate_fn=pad_batch, 
 )
 
 for input_batch, target_batch in train_loader: 
@@ -369,25 +336,28 @@ BASE_CONFIG.update(model_configs[CHOOSE_MODEL])
 
 model_size = CHOOSE_MODEL.split(" ")[-1].lstrip("(").rstrip(")")
 print(model_size)
-settings, params = download_and_load_gpt2(
-model_size=model_size, models_dir="gpt2"
-)
+# the TF checkpoint is converted once, afterwards the weights are memory mapped without TensorFlow
+with main_process_first(): 
+    settings, state_dict = load_gpt2_state_dict(
+    model_size=model_size, models_dir="gpt2"
+    )
 
-model = GPTModel(BASE_CONFIG)
-load_weights_into_gpt(model, params)
+model = load_gpt_model(BASE_CONFIG, state_dict)
 model.eval()
 
 def generate_text_simple(model, idx, max_new_tokens, context_size): 
+    kv_caches = None 
+    idx_cond = idx[:, -context_size:]
     for _ in range(max_new_tokens): 
-        idx_cond = idx[:, -context_size:]
         
         with torch.no_grad(): 
-            logits = model(idx_cond)
+            logits, kv_caches = model(idx_cond, kv_caches=kv_caches, use_cache=True)
         
         logits = logits[:, -1, :]
         probas = torch.softmax(logits, dim=-1)
         idx_next = torch.argmax(probas, dim=-1, keepdim=True)
         idx = torch.cat((idx, idx_next), dim=1)
+        idx_cond, kv_caches = next_cache_input(idx, idx_next, kv_caches, context_size)
     
     return idx
 
@@ -413,6 +383,38 @@ token_ids = generate_text_simple(
 )
 print(token_ids_to_text(token_ids, tokenizer))
 
+# speculative decoding: the small model drafts tokens that a larger one only verifies,
+# e.g. "gpt2-large (774M)" or "gpt2-xl (1558M)"
+SPECULATIVE_TARGET = None 
+if SPECULATIVE_TARGET is not None: 
+    TARGET_CONFIG = BASE_CONFIG.copy()
+    TARGET_CONFIG.update(model_configs[SPECULATIVE_TARGET])
+    _, target_state_dict = load_gpt2_state_dict(
+        model_size=SPECULATIVE_TARGET.split(" ")[-1].lstrip("(").rstrip(")"), models_dir="gpt2"
+    )
+    target_model = load_gpt_model(TARGET_CONFIG, target_state_dict)
+
+    start = time.perf_counter()
+    token_ids = generate(target_model, text_to_token_ids(text_1, tokenizer), 50, BASE_CONFIG["context_length"], None, 0.0)
+    print(f"Target model only: {time.perf_counter() - start:.2f}s")
+    print(token_ids_to_text(token_ids, tokenizer))
+
+    spec_stats = SpeculativeStats()
+    start = time.perf_counter()
+    token_ids = speculative_generate(
+        model=target_model, 
+        draft_model=model, 
+        idx=text_to_token_ids(text_1, tokenizer), 
+        max_new_tokens=50, 
+        context_size=BASE_CONFIG["context_length"], 
+        num_draft_tokens=4, 
+        stats=spec_stats
+    )
+    print(f"Speculative: {time.perf_counter() - start:.2f}s")
+    print(token_ids_to_text(token_ids, tokenizer))
+    print(f"Acceptance rate: {spec_stats.acceptance_rate:.2f}, "
+          f"target forward passes: {spec_stats.target_calls}")
+
 for param in model.parameters(): 
     param.requires_grad = False 
 
@@ -463,7 +465,7 @@ def calc_accuracy_loader(data_loader, model, device, num_batches=None):
             target_batch = target_batch.to(device) 
             
             with torch.no_grad(): 
-                logits = model(input_batch)[:, -1, :]
+                logits = last_token_logits(model, input_batch)
             predicted_labels = torch.argmax(logits, dim=-1)
             
             num_examples += predicted_labels.shape[0]
@@ -499,7 +501,8 @@ print(f"Test accuracy: {test_accuracy * 100:.2f}%")
 def calc_loss_batch(input_batch, target_batch, model, device): 
     input_batch = input_batch.to(device)
     target_batch = target_batch.to(device)
-    logits = model(input_batch)[:, -1, :]
+    # the logits of the last real token, not of the padding after it
+    logits = last_token_logits(model, input_batch)
     # loss = torch.nn.functional.cross_entropy(logits, target_batch)
     return torch.nn.functional.cross_entropy(logits, target_batch)
 
@@ -530,17 +533,22 @@ print(f"Test loss: {test_loss:.3f}")
 
 def train_classifier_simple(
     model, train_loader, val_loader, optimizer, device, 
-    num_epochs, eval_freq, eval_iter):
+    num_epochs, eval_freq, eval_iter, use_bf16=False):
     
     train_losses, val_losses, train_accs, val_accs = [], [], [], []
     examples_seen, global_step = 0, -1 
     
     for epoch in range(num_epochs): 
         model.train() 
+        # a new shuffle of the shards every epoch in data parallel training
+        if hasattr(train_loader.sampler, "set_epoch"): 
+            train_loader.sampler.set_epoch(epoch)
         
         for input_batch, target_batch in train_loader: 
             optimizer.zero_grad() 
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
+            # bf16 autocast for the forward pass and the loss, the weights and their updates stay float32
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16): 
+                loss = calc_loss_batch(input_batch, target_batch, model, device)
             loss.backward() 
             optimizer.step() 
             
@@ -585,6 +593,9 @@ import time
 device = torch.device('cuda' if torch.cuda.is_available() 
                       else 'mps' if torch.backends.mps.is_available() 
                       else 'cpu')
+if world_size > 1: 
+    # the gloo backend all-reduces CPU tensors
+    device = torch.device('cpu')
 print(device)
 model.to(device)
 
@@ -592,18 +603,74 @@ start_time = time.time()
 torch.manual_seed(123) 
 optimizer = torch.optim.AdamW(model.parameters(), lr=5e-5, weight_decay=0.1) 
 num_epochs = 5
-
-train_losses, val_losses, train_accs, val_accs, examples_seen = \
-    train_classifier_simple(
-        model, train_loader, val_loader, optimizer, device,  
-        num_epochs=num_epochs, eval_freq=50, 
-        eval_iter=5
+# run the forward pass and the loss under bfloat16 autocast
+USE_BF16 = False 
+# run the frozen blocks once over the datasets and train only the unfrozen tail on their cached outputs
+CACHE_FROZEN_FEATURES = False 
+
+if CACHE_FROZEN_FEATURES: 
+    from feature_cache import (
+        FrozenTrunkTail, build_feature_cache, num_frozen_blocks, pad_features, train_classifier_cached
     )
+
+    num_frozen = num_frozen_blocks(model)
+    # rank 0 builds the caches, the other ranks read them
+    with main_process_first(): 
+        train_cache = build_feature_cache(model, train_dataset, "feature_cache", num_frozen, device)
+        val_cache = build_feature_cache(model, val_dataset, "feature_cache", num_frozen, device)
+    tail = FrozenTrunkTail(model, num_frozen)
+
+    # data parallel like the full model: every rank trains on its shard of the cache and the gradients
+    # of the tail are all-reduced
+    cache_sampler = None 
+    if world_size > 1: 
+        from torch.nn.parallel import DistributedDataParallel
+        from torch.utils.data.distributed import DistributedSampler
+        cache_sampler = DistributedSampler(train_cache, num_replicas=world_size, rank=rank, shuffle=True, seed=123, drop_last=True)
+        tail = DistributedDataParallel(tail)
+
+    train_losses, val_losses, train_accs, val_accs, examples_seen = \
+        train_classifier_cached(
+            tail, 
+            DataLoader(train_cache, batch_size=batch_size, shuffle=cache_sampler is None, sampler=cache_sampler, 
+                       drop_last=True, collate_fn=pad_features), 
+            DataLoader(val_cache, batch_size=batch_size, shuffle=False, collate_fn=pad_features), 
+            optimizer, device, num_epochs=num_epochs, eval_freq=50, eval_iter=5, use_bf16=USE_BF16
+        )
+else: 
+    # activation checkpointing of every k-th block while training, 0 is off
+    ACTIVATION_CHECKPOINTING = 0
+    if ACTIVATION_CHECKPOINTING:
+        from common.activation import activation_memory_report, set_activation_checkpointing
+
+        set_activation_checkpointing(model, ACTIVATION_CHECKPOINTING)
+        input_batch, _ = next(iter(train_loader))
+        model.train()
+        activation_memory_report(model, lambda: model(input_batch.to(device)))
+
+    train_model = model 
+    if world_size > 1: 
+        # the gradients of the unfrozen parameters are all-reduced in buckets while backward runs
+        from torch.nn.parallel import DistributedDataParallel
+        train_model = DistributedDataParallel(model)
+    train_losses, val_losses, train_accs, val_accs, examples_seen = \
+        train_classifier_simple(
+            train_model, train_loader, val_loader, optimizer, device,  
+            num_epochs=num_epochs, eval_freq=50, 
+            eval_iter=5, use_bf16=USE_BF16
+        )
     
 end_time = time.time() 
 execution_time_minutes = (end_time - start_time) / 60 
 print(f"Training completed in {execution_time_minutes:.2f} minutes")
 
+# the replicas hold the same weights after every step, the evaluation below goes over the full
+# loaders, so rank 0 runs it (and everything after it) alone and the other ranks are done
+if world_size > 1: 
+    cleanup_distributed()
+    if rank != 0: 
+        sys.exit(0)
+
 import matplotlib.pyplot as plt 
 
 def plot_values(
@@ -650,26 +717,11 @@ print(f"Test accuracy: {test_accuracy * 100:.2f}")
 def classify_review(
     text, model, tokenizer, device, max_length=None, 
     pad_token_id=50256): 
-    model.eval() 
-    
-    input_ids = tokenizer.encode(text) 
-    supported_context_length = model.pos_emb.weight.shape[1]
-    
-    input_ids = input_ids[:min(
-        max_length, supported_context_length
-    )]
-    
-    input_ids += [pad_token_id] * ( max_length - len(input_ids))
-    
-    input_tensor = torch.tensor(
-        input_ids, device=device
-    ).unsqueeze(0)
-    
-    with torch.no_grad(): 
-        logits = model(input_tensor)[:, -1, :]
-    predicted_label = torch.argmax(logits, dim=-1).item() 
-    
-    return "spam" if predicted_label == 1 else "not spam"
+    labels, _ = classify(
+        [text], model, tokenizer, device, max_length=max_length, 
+        pad_token_id=pad_token_id
+    )
+    return labels[0]
 
 text_1 = (
     "You are a winner you have been specially"
@@ -685,7 +737,49 @@ text_2 = (
 
 print(classify_review(text_2, model, tokenizer, device, max_length=train_dataset.max_length))
 
+# many texts at once, sorted by length into micro-batches that are only padded to their own longest text
+test_texts = test_dataset.data["text"].tolist()
+start = time.perf_counter()
+labels, probs = classify(test_texts, model, tokenizer, device, batch_size=32, max_length=train_dataset.max_length)
+elapsed = time.perf_counter() - start
+print(f"Classified {len(test_texts)} texts in {elapsed:.2f}s ({len(test_texts) / elapsed:.0f} texts/s)")
+print(f"Spam predicted for {labels.count('spam')} texts")
+
+# torch.compile for inference: the graphs of the padded classification lengths are compiled at startup,
+# compiling takes a while (minutes on the CPU), so it is off by default
+COMPILE_INFERENCE = False
+if COMPILE_INFERENCE:
+    from inference import CompiledGPT, benchmark_compiled
+
+    compiled_model = CompiledGPT(model)
+    pad_multiple = 32
+    compiled_model.warmup(
+        batch_sizes=(32, len(test_texts) % 32 or 32),
+        lengths=range(pad_multiple, train_dataset.max_length + pad_multiple, pad_multiple)
+    )
+    start = time.perf_counter()
+    labels, _ = classify(test_texts, compiled_model, tokenizer, device, batch_size=32,
+                         max_length=train_dataset.max_length, pad_multiple=pad_multiple)
+    elapsed = time.perf_counter() - start
+    print(f"Compiled: classified {len(test_texts)} texts in {elapsed:.2f}s ({len(test_texts) / elapsed:.0f} texts/s)")
+    benchmark_compiled(model, torch.tensor([tokenizer.encode(text_1)], device=device))
+
 torch.save(model.state_dict(), "review_classifier.pth")
 
 model_state_dict = torch.load("review_classifier.pth", map_location=device, weights_only=True)
-model.load_state_dict(model_state_dict)
\ No newline at end of file
+model.load_state_dict(model_state_dict)
+### int8 inference 
+from quantize import quantize_gpt, model_size_mb, benchmark_latency
+
+# the quantized kernels run on the CPU, compare both models there
+cpu = torch.device("cpu")
+model.to(cpu)
+quantized_model = quantize_gpt(model)
+
+input_batch, _ = next(iter(test_loader))
+for name, m in (("fp32", model), ("int8", quantized_model)): 
+    test_accuracy = calc_accuracy_loader(test_loader, m, cpu)
+    latency = benchmark_latency(m, input_batch)
+    print(f"{name}: test accuracy {test_accuracy * 100:.2f}%, "
+          f"{latency * 1000:.1f} ms per batch of {input_batch.shape[0]}, "
+          f"{model_size_mb(m):.0f} MB")
@@ -0,0 +1,59 @@
+import torch
+
+
+def last_token_index(input_batch, pad_token_id=50256):
+    # the texts are right padded, so the last real token sits right before the first pad token
+    lengths = (input_batch != pad_token_id).sum(dim=-1)
+    return (lengths - 1).clamp(min=0)
+
+def last_token_logits(model, input_batch, pad_token_id=50256):
+    # with causal attention the padding after the last real token cannot change its output,
+    # so this is exactly the logits of the unpadded text
+    logits = model(input_batch)
+    rows = torch.arange(input_batch.shape[0], device=input_batch.device)
+    return logits[rows, last_token_index(input_batch, pad_token_id)]
+
+def pad_batch(batch, pad_token_id=50256):
+    # collate_fn for the SpamDataset loaders: drops the padding columns that no text of the batch needs
+    input_batch = torch.stack([input_ids for input_ids, _ in batch])
+    target_batch = torch.stack([label for _, label in batch])
+    max_len = max(int(last_token_index(input_batch, pad_token_id).max()) + 1, 1)
+    return input_batch[:, :max_len], target_batch
+
+def classify_ids(encoded, model, device, pad_token_id=50256, pad_multiple=None):
+    # class probabilities of one batch of token id lists, right padded to the longest of them
+    batch_len = max(len(ids) for ids in encoded)
+    if pad_multiple:
+        # a few padded lengths instead of one per batch, every one is a graph of a compiled model
+        batch_len = min(-(-batch_len // pad_multiple) * pad_multiple, model.pos_emb.weight.shape[0])
+    input_batch = torch.full((len(encoded), batch_len), pad_token_id, dtype=torch.long)
+    lengths = torch.empty(len(encoded), dtype=torch.long)
+    for row, ids in enumerate(encoded):
+        input_batch[row, :len(ids)] = torch.tensor(ids)
+        lengths[row] = len(ids)
+
+    with torch.no_grad():
+        logits = model(input_batch.to(device))
+    logits = logits[torch.arange(len(encoded), device=device), lengths.to(device) - 1]
+    return torch.softmax(logits.float(), dim=-1).cpu()
+
+def classify(texts, model, tokenizer, device, batch_size=32, max_length=None, pad_token_id=50256,
+             class_names=("not spam", "spam"), pad_multiple=None):
+    # Classifies many texts at once: they are sorted by length so that every micro-batch is padded
+    # only to its own longest text, and the results are returned in the order of texts
+    model.eval()
+    supported_context_length = model.pos_emb.weight.shape[0]
+    if max_length is None:
+        max_length = supported_context_length
+    max_length = min(max_length, supported_context_length)
+
+    encoded = [tokenizer.encode(text)[:max_length] or [pad_token_id] for text in texts]
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+
+    probs = torch.empty(len(encoded), len(class_names))
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        probs[rows] = classify_ids([encoded[i] for i in rows], model, device, pad_token_id, pad_multiple)
+
+    labels = [class_names[i] for i in probs.argmax(dim=-1).tolist()]
+    return labels, probs
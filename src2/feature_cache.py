@@ -0,0 +1,174 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+
+import shared  # noqa: F401, makes the common package importable
+from classify import last_token_index
+from common.store import RaggedArrays, RaggedArraysWriter
+
+
+def num_frozen_blocks(model):
+    # the leading transformer blocks that are frozen together with the embeddings
+    embeddings = list(model.tok_emb.parameters()) + list(model.pos_emb.parameters())
+    if any(p.requires_grad for p in embeddings):
+        return 0
+    num_frozen = 0
+    for block in model.trf_blocks:
+        if any(p.requires_grad for p in block.parameters()):
+            break
+        num_frozen += 1
+    return num_frozen
+
+def trunk_forward(model, in_idx, num_frozen):
+    # GPTModel.forward up to the output of block num_frozen - 1
+    seq_len = in_idx.shape[1]
+    pos_embeds = model.pos_emb(torch.arange(seq_len, device=in_idx.device))
+    x = model.drop_emb(model.tok_emb(in_idx) + pos_embeds)
+    return model.trf_blocks[:num_frozen](x)
+
+class FrozenTrunkTail(nn.Module):
+
+    # the trainable rest of the model, run on the cached outputs of the frozen blocks; it shares
+    # its modules with the model, so training it trains the model
+    def __init__(self, model, num_frozen):
+        super().__init__()
+        self.trf_blocks = model.trf_blocks[num_frozen:]
+        self.final_norm = model.final_norm
+        self.out_head = model.out_head
+
+    def forward(self, hidden, lengths):
+        x = self.trf_blocks(hidden)
+        # causal attention: the zero padding after the last real token never reaches it
+        x = x[torch.arange(x.shape[0], device=x.device), lengths - 1]
+        return self.out_head(self.final_norm(x))
+
+class FeatureCache(Dataset):
+
+    # hidden states of every text as float32 RaggedArrays ('hidden', rows of emb_dim values) like the
+    # token store of the translation model, the labels are kept in meta.json
+    def __init__(self, folder):
+        self.store = RaggedArrays(folder)
+        self.labels = np.asarray(self.store.meta['labels'], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        hidden = self.store.get('hidden', index)
+        return torch.from_numpy(np.array(hidden)), torch.tensor(self.labels[index], dtype=torch.long)
+
+def pad_features(batch):
+    # collate_fn for FeatureCache: (hidden, lengths, labels) with the hidden states zero padded
+    lengths = torch.tensor([hidden.shape[0] for hidden, _ in batch])
+    hidden_batch = torch.zeros(len(batch), int(lengths.max()), batch[0][0].shape[1])
+    for row, (hidden, _) in enumerate(batch):
+        hidden_batch[row, :hidden.shape[0]] = hidden
+    return hidden_batch, lengths, torch.stack([label for _, label in batch])
+
+def cache_key(model, dataset, num_frozen):
+    # the cache is only valid for these exact frozen weights and these token ids, so a new checkpoint,
+    # a different tokenizer or a changed dataset all lead to a new cache
+    key = hashlib.sha256(f'{num_frozen}'.encode())
+    modules = [model.tok_emb, model.pos_emb] + list(model.trf_blocks[:num_frozen])
+    for module in modules:
+        for tensor in module.state_dict().values():
+            if tensor.dtype == torch.bool:
+                continue # the causal masks
+            key.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy())
+    for i in range(len(dataset)):
+        input_ids, label = dataset[i]
+        key.update(input_ids.numpy().astype(np.int64).tobytes())
+        key.update(label.numpy().astype(np.int64).tobytes())
+    return key.hexdigest()[:16]
+
+def build_feature_cache(model, dataset, cache_dir, num_frozen, device, batch_size=32, pad_token_id=50256):
+    # runs the frozen part of the model once over dataset and stores the hidden states of the real tokens
+    folder = Path(cache_dir) / cache_key(model, dataset, num_frozen)
+    if RaggedArrays.exists(folder):
+        return FeatureCache(folder)
+
+    print(f'Building feature cache {folder}')
+    was_training = model.training
+    model.eval() # no dropout, the cached states have to be deterministic
+    labels = []
+    with RaggedArraysWriter(folder, {'hidden': np.float32}) as writer, torch.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            items = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+            input_batch = torch.stack([input_ids for input_ids, _ in items]).to(device)
+            lengths = (last_token_index(input_batch, pad_token_id) + 1).tolist()
+            hidden = trunk_forward(model, input_batch[:, :max(lengths)], num_frozen).float().cpu().numpy()
+            for row, length in enumerate(lengths):
+                writer.append('hidden', hidden[row, :length])
+            labels.extend(int(label) for _, label in items)
+        writer.meta['labels'] = labels
+        writer.close()
+    model.train(was_training)
+    return FeatureCache(folder)
+
+def calc_tail_loss_batch(tail, batch, device):
+    hidden, lengths, target_batch = (t.to(device) for t in batch)
+    return torch.nn.functional.cross_entropy(tail(hidden, lengths), target_batch)
+
+def evaluate_tail(tail, data_loader, device, num_batches=None):
+    # mean loss and accuracy over the first num_batches batches
+    was_training = tail.training
+    tail.eval()
+    total_loss, correct, num_examples, num_seen = 0.0, 0, 0, 0
+    with torch.no_grad():
+        for i, batch in enumerate(data_loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            hidden, lengths, target_batch = (t.to(device) for t in batch)
+            logits = tail(hidden, lengths)
+            total_loss += torch.nn.functional.cross_entropy(logits, target_batch).item()
+            correct += (logits.argmax(dim=-1) == target_batch).sum().item()
+            num_examples += target_batch.shape[0]
+            num_seen += 1
+    tail.train(was_training)
+    return total_loss / max(num_seen, 1), correct / max(num_examples, 1)
+
+def train_classifier_cached(
+    tail, train_loader, val_loader, optimizer, device,
+    num_epochs, eval_freq, eval_iter, use_bf16=False):
+    # train_classifier_simple on the cached hidden states, only the tail runs per batch
+    train_losses, val_losses, train_accs, val_accs = [], [], [], []
+    examples_seen, global_step = 0, -1
+
+    for epoch in range(num_epochs):
+        tail.train()
+        # a new shuffle of the shards every epoch in data parallel training
+        if hasattr(train_loader.sampler, "set_epoch"):
+            train_loader.sampler.set_epoch(epoch)
+
+        for batch in train_loader:
+            optimizer.zero_grad()
+            # bf16 autocast for the forward pass and the loss, the weights and their updates stay float32
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                loss = calc_tail_loss_batch(tail, batch, device)
+            loss.backward()
+            optimizer.step()
+
+            examples_seen += batch[0].shape[0]
+            global_step += 1
+
+            if global_step % eval_freq == 0:
+                train_loss, _ = evaluate_tail(tail, train_loader, device, eval_iter)
+                val_loss, _ = evaluate_tail(tail, val_loader, device, eval_iter)
+                train_losses.append(train_loss)
+                val_losses.append(val_loss)
+                print(f"Ep {epoch+1} (Step {global_step:06d}): "
+                      f"Train loss {train_loss:.3f}, "
+                      f"Val loss {val_loss:.3f}")
+
+        _, train_accuracy = evaluate_tail(tail, train_loader, device, eval_iter)
+        _, val_accuracy = evaluate_tail(tail, val_loader, device, eval_iter)
+        print(f"Training accuracy: {train_accuracy * 100:.2f} | ", end="")
+        print(f"Validation accuracy: {val_accuracy * 100:.2f}")
+        train_accs.append(train_accuracy)
+        val_accs.append(val_accuracy)
+
+    return train_losses, val_losses, train_accs, val_accs, examples_seen
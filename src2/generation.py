@@ -0,0 +1,285 @@
+import time
+
+import torch
+
+
+def next_cache_input(idx, idx_next, kv_caches, context_size):
+    # once the window is full the positions shift, so the cache is rebuilt
+    # from the last context_size tokens like the uncached loop would do
+    if kv_caches[0][0].shape[2] < context_size:
+        return idx_next, kv_caches
+    return idx[:, -context_size:], None
+
+def _filter_top_k(logits, top_k):
+    logits = logits.float()
+    if top_k is not None:
+        top_logits, _ = torch.topk(logits, top_k)
+        min_val = top_logits[:, -1:]
+        logits = torch.where(logits < min_val, torch.full_like(logits, float('-inf')), logits)
+    return logits
+
+def sample_next_token(logits, top_k=None, temperature=0.0):
+    # same semantics as generate: keep the top_k logits, then sample with the
+    # temperature or take the argmax when the temperature is 0
+    logits = _filter_top_k(logits, top_k)
+    if temperature > 0.0:
+        probs = torch.softmax(logits / temperature, dim=-1)
+        return torch.multinomial(probs, num_samples=1)
+    return torch.argmax(logits, dim=-1, keepdim=True)
+
+def next_token_probs(logits, top_k=None, temperature=0.0):
+    # the distribution sample_next_token draws from, one-hot on the argmax when the temperature is 0
+    logits = _filter_top_k(logits, top_k)
+    if temperature > 0.0:
+        return torch.softmax(logits / temperature, dim=-1)
+    probs = torch.zeros_like(logits)
+    return probs.scatter_(-1, torch.argmax(logits, dim=-1, keepdim=True), 1.0)
+
+class GenerationStats:
+
+    def __init__(self):
+        self.start_time = None
+        self.token_times = []
+        # 'stop_token', 'stop_string' or 'length'
+        self.stop_reason = None
+
+    @property
+    def time_to_first_token(self):
+        return self.token_times[0] - self.start_time if self.token_times else None
+
+    @property
+    def inter_token_latencies(self):
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+    @property
+    def mean_inter_token_latency(self):
+        latencies = self.inter_token_latencies
+        return sum(latencies) / len(latencies) if latencies else None
+
+def _held_back(text, stop_strings):
+    # number of trailing characters that could still turn into a stop string
+    for n in range(min(len(text), max(map(len, stop_strings)) - 1), 0, -1):
+        if any(stop.startswith(text[-n:]) for stop in stop_strings):
+            return n
+    return 0
+
+def stream_generate(model, idx, max_new_tokens, context_size, top_k=None, temperature=0.0,
+                    tokenizer=None, stop_token_ids=(50256,), stop_strings=(), stats=None):
+    # yields (token_id, text) for every sampled token of the single sequence idx (1, num_tokens) as
+    # soon as it is available, text is the newly decoded text (None without a tokenizer, '' while it
+    # has to be held back), text held back until the end comes with token_id None
+    # the caller can stop early by simply not asking for the next token
+    stats = stats if stats is not None else GenerationStats()
+    stats.start_time = time.perf_counter()
+    model.eval()
+
+    kv_caches = None
+    idx_cond = idx[:, -context_size:]
+    generated = []
+    emitted = 0 # characters of the decoded text that were already yielded
+
+    for _ in range(max_new_tokens):
+        with torch.no_grad():
+            logits, kv_caches = model(idx_cond, kv_caches=kv_caches, use_cache=True)
+        idx_next = sample_next_token(logits[:, -1, :], top_k, temperature)
+        token_id = idx_next.item()
+        stats.token_times.append(time.perf_counter())
+
+        if token_id in stop_token_ids:
+            stats.stop_reason = 'stop_token'
+            break
+
+        idx = torch.cat((idx, idx_next), dim=1)
+        idx_cond, kv_caches = next_cache_input(idx, idx_next, kv_caches, context_size)
+        generated.append(token_id)
+
+        if tokenizer is None:
+            yield token_id, None
+            continue
+
+        text = tokenizer.decode(generated)
+        if stop_strings:
+            positions = [text.find(stop, max(0, emitted - len(stop))) for stop in stop_strings]
+            positions = [p for p in positions if p != -1]
+            if positions:
+                stats.stop_reason = 'stop_string'
+                yield token_id, text[emitted:min(positions)]
+                return
+
+        # a multi-byte character split over several tokens decodes to a replacement character for now
+        if text.endswith('\ufffd'):
+            yield token_id, ''
+            continue
+
+        end = len(text) - _held_back(text, stop_strings) if stop_strings else len(text)
+        yield token_id, text[emitted:end]
+        emitted = max(emitted, end)
+    else:
+        stats.stop_reason = 'length'
+
+    # whatever was held back for a possible stop string is final now
+    if tokenizer is not None and generated:
+        text = tokenizer.decode(generated)
+        if len(text) > emitted:
+            yield None, text[emitted:]
+
+
+class SpeculativeStats:
+
+    def __init__(self):
+        self.drafted = 0
+        self.accepted = 0
+        self.target_calls = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else None
+
+def _extend(model, idx, kv_caches, num_new, context_size):
+    # runs the last num_new tokens of idx on top of the cache and returns their logits, once the
+    # window would overflow the cache is rebuilt from the last context_size tokens like in generate
+    past_len = 0 if kv_caches is None else kv_caches[0][0].shape[2]
+    if past_len + num_new > context_size:
+        kv_caches, idx_cond = None, idx[:, -context_size:]
+    else:
+        idx_cond = idx[:, -num_new:]
+    logits, kv_caches = model(idx_cond, kv_caches=kv_caches, use_cache=True)
+    return logits[:, -num_new:], kv_caches
+
+def _truncate(kv_caches, num_tokens):
+    # forget the keys and values of the last num_tokens (rejected) tokens
+    if num_tokens == 0:
+        return kv_caches
+    return [(keys[:, :, :-num_tokens], values[:, :, :-num_tokens]) for keys, values in kv_caches]
+
+def speculative_generate(model, draft_model, idx, max_new_tokens, context_size, num_draft_tokens=4,
+                         top_k=None, temperature=0.0, eos_id=None, stats=None):
+    # The draft model proposes num_draft_tokens tokens one by one, the target model scores all of them
+    # in a single forward pass. A drafted token x is accepted with probability min(1, p(x) / q(x)),
+    # p and q being the target and draft distributions after top_k and temperature, the first rejected
+    # one is resampled from max(0, p - q). The output then follows exactly the distribution of
+    # generate with the target model alone (with temperature 0 both are one-hot, so this is greedy
+    # decoding of the target model). Both models have to share the vocabulary, idx is (1, num_tokens).
+    # Once the sequence outgrows context_size the drafted tokens are scored within the last
+    # context_size tokens, so the earlier ones see a slightly shorter context than in generate.
+    stats = stats if stats is not None else SpeculativeStats()
+    model.eval()
+    draft_model.eval()
+
+    target_caches, draft_caches = None, None
+    # trailing tokens of idx that are not in the caches yet
+    target_pending = draft_pending = idx.shape[1]
+    num_generated = 0
+
+    while num_generated < max_new_tokens:
+        k = min(num_draft_tokens, max_new_tokens - num_generated)
+
+        draft_idx, draft_probs = idx, []
+        with torch.no_grad():
+            for _ in range(k):
+                logits, draft_caches = _extend(draft_model, draft_idx, draft_caches, draft_pending, context_size)
+                probs = next_token_probs(logits[:, -1], top_k, temperature)
+                draft_idx = torch.cat((draft_idx, torch.multinomial(probs, num_samples=1)), dim=1)
+                draft_probs.append(probs[0])
+                draft_pending = 1
+
+            # the target logits at the last k + 1 positions score the k drafted tokens plus one more
+            logits, target_caches = _extend(model, draft_idx, target_caches, target_pending + k, context_size)
+        target_probs = next_token_probs(logits[0, -(k + 1):], top_k, temperature)
+        stats.drafted += k
+        stats.target_calls += 1
+
+        drafted = draft_idx[0, -k:].tolist()
+        new_tokens = []
+        for i, token in enumerate(drafted):
+            p, q = target_probs[i, token], draft_probs[i][token]
+            if torch.rand(()) < p / q:
+                new_tokens.append(token)
+                continue
+            residual = torch.clamp(target_probs[i] - draft_probs[i], min=0.0)
+            # with p and q (almost) equal rounding can reject a token although max(0, p - q) is all zero,
+            # p itself is the distribution to sample from then
+            total = residual.sum()
+            residual = residual / total if total > 0 else target_probs[i]
+            new_tokens.append(torch.multinomial(residual, num_samples=1).item())
+            break
+        else:
+            # every draft was accepted, the target distribution after them comes for free
+            new_tokens.append(torch.multinomial(target_probs[k], num_samples=1).item())
+        num_accepted = len(new_tokens) - 1
+        stats.accepted += num_accepted
+
+        # the caches hold the drafted tokens, drop the rejected ones
+        target_caches = _truncate(target_caches, k - num_accepted)
+        target_pending = 1
+        if num_accepted == k:
+            # the last draft was sampled but never fed to the draft model
+            draft_pending = 2
+        else:
+            draft_caches = _truncate(draft_caches, k - 1 - num_accepted)
+            draft_pending = 1
+
+        new_tokens = new_tokens[:max_new_tokens - num_generated]
+        stop = eos_id is not None and eos_id in new_tokens
+        if stop:
+            new_tokens = new_tokens[:new_tokens.index(eos_id) + 1]
+        idx = torch.cat((idx, torch.tensor([new_tokens], dtype=idx.dtype, device=idx.device)), dim=1)
+        num_generated += len(new_tokens)
+        if stop:
+            break
+
+    return idx
+
+def _pad_in_window(pad_lengths, idx_len, window_len):
+    # padding of every row that is still within the last window_len of idx_len tokens
+    if pad_lengths is None:
+        return None
+    return (pad_lengths - (idx_len - window_len)).clamp(min=0)
+
+def batch_generate(model, idx, max_new_tokens, context_size, top_k=None, temperature=0.0, eos_id=None,
+                   pad_lengths=None):
+    # several prompts decoded together, idx is (batch, num_tokens) with the shorter prompts left padded
+    # by pad_lengths (batch) tokens, None if they all have the same length; max_new_tokens can be one
+    # limit per row. A row is done at eos_id or its limit and leaves the batch, so the remaining steps
+    # only compute the rows still running. Returns the new token ids of every row
+    if isinstance(max_new_tokens, int):
+        max_new_tokens = [max_new_tokens] * idx.shape[0]
+    model.eval()
+    generated = [[] for _ in range(idx.shape[0])]
+    # original index of the rows that are still being decoded
+    active = [row for row, limit in enumerate(max_new_tokens) if limit > 0]
+    if not active:
+        return generated
+    keep = torch.tensor(active, device=idx.device)
+    idx = idx.index_select(0, keep)
+    pad_lengths = None if pad_lengths is None else pad_lengths.index_select(0, keep)
+
+    kv_caches = None
+    idx_cond = idx[:, -context_size:]
+    # the padding of the tokens in the cache, counted from its first token
+    window_pad = _pad_in_window(pad_lengths, idx.shape[1], idx_cond.shape[1])
+    while True:
+        with torch.no_grad():
+            logits, kv_caches = model(idx_cond, kv_caches=kv_caches, use_cache=True, pad_lengths=window_pad)
+        idx_next = sample_next_token(logits[:, -1, :], top_k, temperature)
+        running = []
+        for i, (row, token_id) in enumerate(zip(active, idx_next.squeeze(1).tolist())):
+            if token_id == eos_id:
+                continue
+            generated[row].append(token_id)
+            if len(generated[row]) < max_new_tokens[row]:
+                running.append(i)
+        if not running:
+            return generated
+        if len(running) < len(active):
+            # drop the finished rows from the batch and the caches
+            keep = torch.tensor(running, device=idx.device)
+            active = [active[i] for i in running]
+            idx, idx_next = idx.index_select(0, keep), idx_next.index_select(0, keep)
+            kv_caches = [(keys.index_select(0, keep), values.index_select(0, keep)) for keys, values in kv_caches]
+            if pad_lengths is not None:
+                pad_lengths, window_pad = pad_lengths.index_select(0, keep), window_pad.index_select(0, keep)
+        idx = torch.cat((idx, idx_next), dim=1)
+        idx_cond, kv_caches = next_cache_input(idx, idx_next, kv_caches, context_size)
+        if kv_caches is None:
+            window_pad = _pad_in_window(pad_lengths, idx.shape[1], idx_cond.shape[1])
@@ -4,17 +4,25 @@
 # Code: https://github.com/rasbt/LLMs-from-scratch
 
 
+import http.client
 import os
+import threading
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # import requests
 import json
 import numpy as np
-import tensorflow as tf
 from tqdm import tqdm
 
+import shared  # noqa: F401, makes the common package importable
+from common.store import file_sha256
 
-def download_and_load_gpt2(model_size, models_dir):
+
+def download_and_load_gpt2(model_size, models_dir,
+                           base_url="https://openaipublic.blob.core.windows.net/gpt-2/models",
+                           max_workers=4):
     # Validate model size
     allowed_sizes = ("124M", "355M", "774M", "1558M")
     if model_size not in allowed_sizes:
@@ -22,21 +30,23 @@ def download_and_load_gpt2(model_size, models_dir):
 
     # Define paths
     model_dir = os.path.join(models_dir, model_size)
-    base_url = "https://openaipublic.blob.core.windows.net/gpt-2/models"
     filenames = [
         "checkpoint", "encoder.json", "hparams.json",
         "model.ckpt.data-00000-of-00001", "model.ckpt.index",
         "model.ckpt.meta", "vocab.bpe"
     ]
 
-    # Download files
+    # Download files, all of them at the same time
     os.makedirs(model_dir, exist_ok=True)
-    for filename in filenames:
-        file_url = os.path.join(base_url, model_size, filename)
-        file_path = os.path.join(model_dir, filename)
-        download_file(file_url, file_path)
+    files = [
+        (os.path.join(base_url, model_size, filename), os.path.join(model_dir, filename))
+        for filename in filenames
+    ]
+    download_files(files, os.path.join(model_dir, "integrity_cache.json"), max_workers=max_workers)
 
-    # Load settings and params
+    # Load settings and params, TensorFlow is only imported here so that loading
+    # converted checkpoints (see gpt_weights.py) works without it
+    import tensorflow as tf
     tf_ckpt_path = tf.train.latest_checkpoint(model_dir)
     settings = json.load(open(os.path.join(model_dir, "hparams.json")))
     params = load_gpt2_params_from_tf_ckpt(tf_ckpt_path, settings)
@@ -44,42 +54,178 @@ def download_and_load_gpt2(model_size, models_dir):
     return settings, params
 
 
-def download_file(url, destination):
-    # Send a GET request to download the file
+# Size of the buffered reads and writes
+COPY_BUFFER_SIZE = 1024 * 1024  # 1 Megabyte
+# Files at least this large are fetched as several HTTP Range requests in parallel
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024  # 64 Megabytes
+PARALLEL_CHUNK_SIZE = 32 * 1024 * 1024  # 32 Megabytes
+
+
+def download_files(files, cache_path, max_workers=4):
+    # The integrity cache maps every file name to the size and sha256 it had when it was downloaded,
+    # so a file that is truncated or changed on disk later is noticed and fetched again. The hashes
+    # come from the first download itself: they are no protection against a download that was already
+    # corrupt or tampered with, only against what happens to the files afterwards
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_file, url, destination, cache.get(os.path.basename(destination))):
+            os.path.basename(destination)
+            for url, destination in files
+        }
+        for future in as_completed(futures):
+            entry = future.result()
+            if entry is None:
+                failed.append(futures[future])
+            else:
+                cache[futures[future]] = entry
 
+    with open(cache_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    if failed:
+        raise RuntimeError(f"Could not download {', '.join(sorted(failed))}")
+    return cache
+
+
+def download_file(url, destination, expected=None, max_workers=8):
+    # expected is the integrity cache entry {"size": ..., "sha256": ...} of the file, if there is one.
+    # Returns the entry of the downloaded (or already present) file, or None if the download failed
     try:
-        with urllib.request.urlopen(url) as response:
-            # Get the total file size from headers, defaulting to 0 if not present
-            file_size = int(response.headers.get("Content-Length", 0))
-
-            # Check if file exists and has the same size
-            if os.path.exists(destination):
-                file_size_local = os.path.getsize(destination)
-                if file_size == file_size_local:
+        # Check if file exists and matches the cache, without an entry only the size can be compared
+        remote_info = None
+        if os.path.exists(destination):
+            if expected is not None:
+                if (os.path.getsize(destination) == expected["size"]
+                        and file_sha256(destination) == expected["sha256"]):
+                    print(f"File already exists and is up-to-date: {destination}")
+                    return expected
+                print(f"File changed since it was downloaded, downloading again: {destination}")
+                os.remove(destination)
+            else:
+                remote_info = remote_file_info(url)
+                if remote_info[0] == os.path.getsize(destination):
                     print(f"File already exists and is up-to-date: {destination}")
-                    return
-
-            # Define the block size for reading the file
-            block_size = 1024  # 1 Kilobyte
-
-            # Initialize the progress bar with total file size
-            progress_bar_description = os.path.basename(url)  # Extract filename from URL
-            with tqdm(total=file_size, unit="iB", unit_scale=True, desc=progress_bar_description) as progress_bar:
-                # Open the destination file in binary write mode
-                with open(destination, "wb") as file:
-                    # Read the file in chunks and write to destination
-                    while True:
-                        chunk = response.read(block_size)
-                        if not chunk:
-                            break
-                        file.write(chunk)
-                        progress_bar.update(len(chunk))  # Update progress bar
-    except urllib.error.HTTPError:
+                    return {"size": remote_info[0], "sha256": file_sha256(destination)}
+
+        file_size, accepts_ranges = remote_info or remote_file_info(url)
+        part_path = destination + ".part"
+        if accepts_ranges and file_size >= PARALLEL_MIN_SIZE:
+            download_chunks(url, part_path, file_size, max_workers)
+        else:
+            download_stream(url, part_path, file_size, accepts_ranges)
+
+        if file_size and os.path.getsize(part_path) != file_size:
+            raise ValueError(f"Downloaded {os.path.getsize(part_path)} of {file_size} bytes: {url}")
+        entry = {"size": file_size, "sha256": file_sha256(part_path)}
+        if expected is not None and entry != expected:
+            os.remove(part_path)
+            raise ValueError(f"Downloaded file differs from the earlier download: {url}")
+        os.replace(part_path, destination)
+        return entry
+    except urllib.error.HTTPError as e:
         s = (
-            f"The specified URL ({url}) is incorrect, the internet connection cannot be established,"
-            "\nor the requested file is temporarily unavailable.\nPlease visit the following website"
+            f"Downloading {url} failed with HTTP {e.code} {e.reason}. The URL may be incorrect or the file"
+            "\ntemporarily unavailable. Please visit the following website"
             " for help: https://github.com/rasbt/LLMs-from-scratch/discussions/273")
         print(s)
+    except urllib.error.URLError as e:
+        print(f"Downloading {url} failed, the internet connection cannot be established: {e.reason}")
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        # a connection dropped during a read, a truncated or changed download, a full disk: only this
+        # file fails, the integrity cache entries of the others are still written
+        print(f"Downloading {url} failed: {e!r}")
+
+
+def remote_file_info(url):
+    # Size of the file and whether the server can send parts of it
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request) as response:
+        file_size = int(response.headers.get("Content-Length", 0))
+        accepts_ranges = response.headers.get("Accept-Ranges", "none").lower() == "bytes"
+    return file_size, accepts_ranges
+
+
+def copy_response(response, file, progress_bar):
+    # Copy with a large buffer instead of many small reads
+    while True:
+        chunk = response.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            break
+        file.write(chunk)
+        progress_bar.update(len(chunk))
+
+
+def download_stream(url, part_path, file_size, accepts_ranges):
+    # Continue a partial download if the server supports it, otherwise start from zero
+    downloaded = os.path.getsize(part_path) if accepts_ranges and os.path.exists(part_path) else 0
+    if downloaded > file_size:
+        downloaded = 0
+    if downloaded and downloaded == file_size:
+        # an earlier run got everything but stopped before the rename, a range request for the
+        # bytes after the end would be answered with 416
+        return
+    request = urllib.request.Request(url)
+    if downloaded:
+        request.add_header("Range", f"bytes={downloaded}-")
+
+    progress_bar_description = os.path.basename(url)  # Extract filename from URL
+    with tqdm(total=file_size, initial=downloaded, unit="iB", unit_scale=True,
+              desc=progress_bar_description) as progress_bar:
+        with urllib.request.urlopen(request) as response:
+            # A server that ignores the range sends the whole file again
+            if downloaded and response.status != 206:
+                downloaded = 0
+                progress_bar.reset()
+            with open(part_path, "ab" if downloaded else "wb") as file:
+                copy_response(response, file, progress_bar)
+
+
+def download_chunks(url, part_path, file_size, max_workers):
+    # Fetch fixed size byte ranges in parallel into a preallocated file. The finished chunks are
+    # recorded next to it so that an interrupted download only fetches the missing ones
+    num_chunks = (file_size + PARALLEL_CHUNK_SIZE - 1) // PARALLEL_CHUNK_SIZE
+    progress_path = part_path + ".json"
+    state = {"size": file_size, "chunk_size": PARALLEL_CHUNK_SIZE, "done": []}
+    if os.path.exists(part_path) and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            previous = json.load(f)
+        if previous["size"] == file_size and previous["chunk_size"] == PARALLEL_CHUNK_SIZE:
+            state = previous
+    if not state["done"]:
+        with open(part_path, "wb") as file:
+            file.truncate(file_size)
+
+    done = set(state["done"])
+    lock = threading.Lock()
+    progress_bar_description = os.path.basename(url)  # Extract filename from URL
+    initial = sum(min(PARALLEL_CHUNK_SIZE, file_size - i * PARALLEL_CHUNK_SIZE) for i in done)
+
+    def fetch(index):
+        start = index * PARALLEL_CHUNK_SIZE
+        end = min(start + PARALLEL_CHUNK_SIZE, file_size) - 1
+        request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+        with urllib.request.urlopen(request) as response, open(part_path, "r+b") as file:
+            if response.status != 206:
+                raise ValueError(f"Server did not return the requested range of {url}")
+            file.seek(start)
+            copy_response(response, file, progress_bar)
+        with lock:
+            done.add(index)
+            with open(progress_path, "w") as f:
+                json.dump({**state, "done": sorted(done)}, f)
+
+    with tqdm(total=file_size, initial=initial, unit="iB", unit_scale=True,
+              desc=progress_bar_description) as progress_bar:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            missing = [i for i in range(num_chunks) if i not in done]
+            for future in as_completed([executor.submit(fetch, i) for i in missing]):
+                future.result()
+    os.remove(progress_path)
 
 
 # Alternative way using `requests`
@@ -114,6 +260,8 @@ def download_file(url, destination):
 
 
 def load_gpt2_params_from_tf_ckpt(ckpt_path, settings):
+    import tensorflow as tf
+
     # Initialize parameters dictionary with empty blocks for each layer
     params = {"blocks": [{} for _ in range(settings["n_layer"])]}
 
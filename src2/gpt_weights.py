@@ -0,0 +1,170 @@
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+from model import GPTModel, MultiHeadAttention, causal_mask
+
+
+# safetensors dtype names of the arrays we write
+DTYPES = {"F32": np.float32, "F16": np.float16}
+DTYPE_NAMES = {np.dtype(dtype): name for name, dtype in DTYPES.items()}
+
+
+def params_to_state_dict(params):
+    # Map the nested TF parameter dictionary to GPTModel names, with the fused c_attn split into
+    # query/key/value and every matrix transposed to the (out_features, in_features) layout of nn.Linear
+    state_dict = {
+        "tok_emb.weight": params["wte"],
+        "pos_emb.weight": params["wpe"],
+        "final_norm.scale": params["g"],
+        "final_norm.shift": params["b"],
+    }
+    for b, block in enumerate(params["blocks"]):
+        prefix = f"trf_blocks.{b}"
+        q_w, k_w, v_w = np.split(block["attn"]["c_attn"]["w"], 3, axis=-1)
+        q_b, k_b, v_b = np.split(block["attn"]["c_attn"]["b"], 3, axis=-1)
+        state_dict.update({
+            f"{prefix}.att.W_query.weight": q_w.T,
+            f"{prefix}.att.W_key.weight": k_w.T,
+            f"{prefix}.att.W_value.weight": v_w.T,
+            f"{prefix}.att.W_query.bias": q_b,
+            f"{prefix}.att.W_key.bias": k_b,
+            f"{prefix}.att.W_value.bias": v_b,
+            f"{prefix}.att.out_proj.weight": block["attn"]["c_proj"]["w"].T,
+            f"{prefix}.att.out_proj.bias": block["attn"]["c_proj"]["b"],
+            f"{prefix}.ff.layers.0.weight": block["mlp"]["c_fc"]["w"].T,
+            f"{prefix}.ff.layers.0.bias": block["mlp"]["c_fc"]["b"],
+            f"{prefix}.ff.layers.2.weight": block["mlp"]["c_proj"]["w"].T,
+            f"{prefix}.ff.layers.2.bias": block["mlp"]["c_proj"]["b"],
+            f"{prefix}.norm1.scale": block["ln_1"]["g"],
+            f"{prefix}.norm1.shift": block["ln_1"]["b"],
+            f"{prefix}.norm2.scale": block["ln_2"]["g"],
+            f"{prefix}.norm2.shift": block["ln_2"]["b"],
+        })
+    # out_head.weight is tied to tok_emb.weight in GPT-2 and is not stored a second time
+    return state_dict
+
+
+def save_safetensors(arrays, path, metadata=None):
+    # safetensors layout: 8 byte little endian header size, JSON header, then the raw tensor bytes
+    header, offset = {}, 0
+    for name, array in arrays.items():
+        nbytes = array.size * array.itemsize
+        header[name] = {
+            "dtype": DTYPE_NAMES[array.dtype],
+            "shape": list(array.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    header_bytes = json.dumps(header).encode("utf-8")
+    # pad the header so that the data starts 8 byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    # Write to a temporary file and rename it so that an interrupted conversion never leaves a broken file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for array in arrays.values():
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_safetensors(path):
+    # Memory map the file and return tensors that are views into it, nothing is read until it is used.
+    # The copy-on-write mapping keeps the tensors writable without ever modifying the file.
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    header_size = int.from_bytes(data[:8].tobytes(), "little")
+    header = json.loads(data[8:8 + header_size].tobytes())
+    metadata = header.pop("__metadata__", {})
+    start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        array = data[start + begin:start + end].view(DTYPES[info["dtype"]]).reshape(info["shape"])
+        tensors[name] = torch.from_numpy(array)
+    return tensors, metadata
+
+
+def converted_path(model_size, models_dir):
+    return os.path.join(models_dir, model_size, f"gpt2-{model_size}.safetensors")
+
+
+def convert_gpt2_checkpoint(model_size, models_dir):
+    # The only step that needs TensorFlow, done once per model size
+    from gpt_download import download_and_load_gpt2
+
+    settings, params = download_and_load_gpt2(model_size=model_size, models_dir=models_dir)
+    state_dict = params_to_state_dict(params)
+    path = converted_path(model_size, models_dir)
+    save_safetensors(state_dict, path, metadata={"settings": json.dumps(settings)})
+    print(f"Converted checkpoint saved to {path}")
+    return path
+
+
+def load_gpt2_state_dict(model_size, models_dir):
+    path = converted_path(model_size, models_dir)
+    if not os.path.exists(path):
+        convert_gpt2_checkpoint(model_size, models_dir)
+
+    state_dict, metadata = load_safetensors(path)
+    settings = json.loads(metadata["settings"])
+    return settings, state_dict
+
+
+def build_causal_masks(gpt):
+    # A model created on the meta device has no data for its mask buffers, they are not part of
+    # the checkpoint and are built here instead
+    for module in gpt.modules():
+        if isinstance(module, MultiHeadAttention) and module.mask.is_meta:
+            module.mask = causal_mask(module.mask.shape[0])
+
+
+def peak_rss_mb():
+    # peak resident memory of the whole process so far, ru_maxrss is in kilobytes on Linux and in
+    # bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_gpt_model(cfg, state_dict):
+    # The model is created on the meta device, so no parameter memory is allocated or randomly
+    # initialized, and the parameters are then set to the (memory mapped) tensors of the state dict
+    start = time.perf_counter()
+    peak_before = peak_rss_mb()
+    with torch.device("meta"):
+        gpt = GPTModel(cfg)
+    # the converted GPT-2 checkpoints have no out_head.weight, the head is tied to the token embedding
+    load_state_dict_into_gpt(gpt, state_dict, assign=True, tie_out_head="out_head.weight" not in state_dict)
+    build_causal_masks(gpt)
+
+    remaining = [name for name, t in list(gpt.named_parameters()) + list(gpt.named_buffers()) if t.is_meta]
+    if remaining:
+        raise ValueError(f"Tensors not loaded from the state dict: {remaining}")
+    # the peak only grows, so its growth is what the load added on top of the earlier peak (0 when the
+    # load stayed below it), the process peak includes everything that ran before
+    peak_after = peak_rss_mb()
+    print(f"Model loaded in {time.perf_counter() - start:.2f}s, peak RSS grew by {peak_after - peak_before:.0f} MB "
+          f"(process peak {peak_after:.0f} MB)")
+    return gpt
+
+
+def load_state_dict_into_gpt(gpt, state_dict, assign=False, tie_out_head=False):
+    missing, unexpected = gpt.load_state_dict(state_dict, strict=False, assign=assign)
+    # the causal masks are buffers that the model builds itself
+    missing = [name for name in missing if not name.endswith(".att.mask")]
+    if tie_out_head:
+        # one Parameter for both, after loading since assign=True replaces the tok_emb Parameter
+        gpt.out_head.weight = gpt.tok_emb.weight
+        missing = [name for name in missing if name != "out_head.weight"]
+    if missing or unexpected:
+        raise ValueError(f"State dict does not match the model. Missing: {missing}, "
+                         f"unexpected: {unexpected}")
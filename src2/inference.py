@@ -0,0 +1,101 @@
+import time
+import warnings
+
+import torch
+
+import shared  # noqa: F401, makes the common package importable
+from common.compile import compile_or_none, mark_shapes, raise_recompile_limit
+
+
+# every padded classification length and batch size has its own graphs, and all GPTModel instances
+# (classifier and generator) share the limit of GPTModel.forward
+raise_recompile_limit(128)
+
+class CompiledGPT:
+
+    # Inference wrapper around a GPTModel that runs its forward pass through torch.compile. Full forward
+    # passes (classification, prompts) get one graph per input shape, so classify with pad_multiple only
+    # needs a handful of them; the KV cache steps grow by one position every token, that dimension is
+    # marked dynamic and two graphs per batch size cover all of them (the first step gets the cache in
+    # the layout of the prompt pass). If compiling fails, here or when a new shape is compiled on its
+    # first call, the eager model takes over. Works wherever the model is only called: generate,
+    # stream_generate, classify, ...
+    def __init__(self, model, backend="inductor", mode=None):
+        self.model = model.eval()
+        self.compiled = compile_or_none(model, backend=backend, mode=mode)
+
+    def __call__(self, in_idx, kv_caches=None, use_cache=False, pad_lengths=None):
+        if self.compiled is not None:
+            # a slice of a longer sequence has other strides, which would be another graph
+            in_idx = in_idx.contiguous()
+            mark_shapes(in_idx)
+            if pad_lengths is not None:
+                mark_shapes(pad_lengths)
+            for keys, values in kv_caches or ():
+                mark_shapes(keys, dynamic_dims=(2,))
+                mark_shapes(values, dynamic_dims=(2,))
+            try:
+                return self.compiled(in_idx, kv_caches=kv_caches, use_cache=use_cache, pad_lengths=pad_lengths)
+            except Exception as e:
+                warnings.warn(f"compiled forward pass failed, falling back to eager mode: {e}")
+                self.compiled = None
+        return self.model(in_idx, kv_caches=kv_caches, use_cache=use_cache, pad_lengths=pad_lengths)
+
+    def __getattr__(self, name):
+        # pos_emb, tok_emb, ... of the wrapped model
+        return getattr(self.model, name)
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def warmup(self, batch_sizes=(1,), lengths=(1,), decode_steps=0):
+        # compiles the graphs of the expected shapes at startup instead of on the first requests:
+        # one forward pass per batch size and length, with decode_steps > 0 a prompt of that length
+        # followed by as many KV cache steps
+        vocab_size = self.model.tok_emb.num_embeddings
+        device = self.model.tok_emb.weight.device
+        start = time.perf_counter()
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                for length in lengths:
+                    idx = torch.randint(0, vocab_size, (batch_size, length), device=device)
+                    if decode_steps == 0:
+                        self(idx)
+                        continue
+                    _, kv_caches = self(idx, use_cache=True)
+                    for _ in range(decode_steps):
+                        _, kv_caches = self(idx[:, -1:], kv_caches=kv_caches, use_cache=True)
+        print(f"Warmup done in {time.perf_counter() - start:.1f}s ({'eager' if self.compiled is None else 'compiled'})")
+
+def benchmark(fn, num_runs=10):
+    # mean seconds per call, the first call (compilation) is not timed
+    with torch.no_grad():
+        fn()
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            fn()
+    return (time.perf_counter() - start) / num_runs
+
+def benchmark_compiled(model, input_batch, decode_steps=16, num_runs=10):
+    # eager against compiled model on a full forward pass over input_batch (the classification shape)
+    # and on decode_steps KV cache steps after it (the generation shape)
+    compiled = CompiledGPT(model)
+
+    def decode(m):
+        with torch.no_grad():
+            _, kv_caches = m(input_batch, use_cache=True)
+            for _ in range(decode_steps):
+                _, kv_caches = m(input_batch[:, -1:], kv_caches=kv_caches, use_cache=True)
+
+    results = {}
+    for name, m in [("eager", model), ("compiled", compiled)]:
+        results[name] = (
+            benchmark(lambda: m(input_batch), num_runs),
+            benchmark(lambda: decode(m), num_runs) / (decode_steps + 1),
+        )
+    for i, shape in enumerate(["forward pass", "decode step"]):
+        eager_time, compiled_time = results["eager"][i], results["compiled"][i]
+        print(f"{shape} {tuple(input_batch.shape)}: eager {eager_time * 1000:.2f} ms, "
+              f"compiled {compiled_time * 1000:.2f} ms ({eager_time / compiled_time:.2f}x)")
+    return results
@@ -1,10 +1,16 @@
+import math
+
 import torch 
 import torch.nn as nn 
 import torch.nn.functional as F 
 from torch.utils.data import Dataset, DataLoader 
+from torch.utils.checkpoint import checkpoint
 
 import tiktoken
 
+import shared  # noqa: F401, makes the common package importable
+from common.activation import checkpointed
+
 class LayerNorm(nn.Module): 
     def __init__(self, emb_dim): 
         super().__init__()
@@ -13,18 +19,23 @@ class LayerNorm(nn.Module):
         self.shift = nn.Parameter(torch.zeros(emb_dim))
     
     def forward(self, x): 
-        mean = x.mean(dim=-1, keepdim=True)
-        var = x.var(dim=-1, keepdim=True, unbiased=False)
-        norm_x = (x - mean) / torch.sqrt(var + self.eps)
-        return self.scale * norm_x + self.shift
+        # normalize in float32 even for bfloat16 inputs (autocast or bf16 weights)
+        x_float = x.float()
+        mean = x_float.mean(dim=-1, keepdim=True)
+        var = x_float.var(dim=-1, keepdim=True, unbiased=False)
+        norm_x = (x_float - mean) / torch.sqrt(var + self.eps)
+        return (self.scale * norm_x + self.shift).to(x.dtype)
     
+# sqrt(2 / pi) as a python float, a tensor would be created on every call
+GELU_SCALE = math.sqrt(2.0 / math.pi)
+
 class GELU(nn.Module): 
     def __init__(self): 
         super().__init__() 
         
     def forward(self, x): 
         return 0.5 * x * (1 + torch.tanh(
-            torch.sqrt(torch.tensor(2.0 / torch.pi)) * 
+            GELU_SCALE * 
             (x + 0.044715 * torch.pow(x, 3))
         ))
 
@@ -40,9 +51,13 @@ class FeedForward(nn.Module):
     def forward(self, x): 
         return self.layers(x)
     
+def causal_mask(block_size, device=None): 
+    # True above the diagonal, i.e. for the future tokens that must not be attended to
+    return torch.triu(torch.ones(block_size, block_size, dtype=torch.bool, device=device), diagonal=1)
+
 class MultiHeadAttention(nn.Module): 
     def __init__(self, d_in, d_out, block_size, 
-                 dropout, num_heads, qkv_bias=False): 
+                 dropout, num_heads, qkv_bias=False, fused=False, cache_packed=False): 
         super().__init__()
         assert d_out % num_heads == 0, "output dimension must be divisible by the number of heads"
         self.d_out = d_out 
@@ -53,16 +68,38 @@ class MultiHeadAttention(nn.Module):
         self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
         self.out_proj = nn.Linear(d_out, d_out)
         self.dropout = nn.Dropout(dropout)
-        self.register_buffer(
-            'mask', 
-            torch.triu(torch.ones(block_size, block_size), diagonal=1)
-        )
+        # stored as bool so that forward doesn't convert it on every call
+        self.register_buffer('mask', causal_mask(block_size))
+        # fused: one packed qkv matmul and torch's scaled_dot_product_attention 
+        self.fused = fused 
+        # cache_packed: keep the packed qkv weights between inference calls instead of concatenating them
+        # every call, faster decoding for a second copy of the qkv weights in memory
+        self.cache_packed = cache_packed 
+        self.packed = None 
     
-    def forward(self, x): 
+    def packed_qkv(self, x): 
+        layers = [self.W_query, self.W_key, self.W_value]
+        if torch.is_grad_enabled() or not self.cache_packed: 
+            weight = torch.cat([layer.weight for layer in layers])
+            bias = None if layers[0].bias is None else torch.cat([layer.bias for layer in layers])
+        else: 
+            # the packed copy is kept until the weights change or move
+            params = [p for layer in layers for p in (layer.weight, layer.bias) if p is not None]
+            version = tuple((p.data_ptr(), p._version) for p in params)
+            if self.packed is None or self.packed[0] != version: 
+                bias = None if layers[0].bias is None else torch.cat([layer.bias for layer in layers])
+                self.packed = (version, torch.cat([layer.weight for layer in layers]), bias)
+            _, weight, bias = self.packed 
+        return F.linear(x, weight, bias).chunk(3, dim=-1)
+    
+    def forward(self, x, kv_cache=None, use_cache=False, pad_lengths=None): 
         b, num_tokens, d_in = x.shape
-        keys = self.W_key(x) 
-        queries = self.W_query(x)
-        values = self.W_value(x) 
+        if self.fused: 
+            queries, keys, values = self.packed_qkv(x)
+        else: 
+            keys = self.W_key(x) 
+            queries = self.W_query(x)
+            values = self.W_value(x) 
         
         keys = keys.view(b, num_tokens, self.num_heads, self.head_dim)
         values = values.view(b, num_tokens, self.num_heads, self.head_dim) 
@@ -72,19 +109,47 @@ class MultiHeadAttention(nn.Module):
         values = values.transpose(1, 2)
         queries = queries.transpose(1, 2)
         
-        attn_scores = queries @ keys.transpose(2, 3)
-        mask_bool = self.mask.bool()[:num_tokens, :num_tokens]
+        # prepend the keys and values of the tokens processed in earlier steps
+        past_len = 0 
+        if kv_cache is not None: 
+            past_keys, past_values = kv_cache 
+            past_len = past_keys.shape[2]
+            keys = torch.cat([past_keys, keys], dim=2)
+            values = torch.cat([past_values, values], dim=2)
         
-        attn_scores.masked_fill_(mask_bool, -torch.inf)
+        # the new queries sit at positions past_len..past_len + num_tokens - 1
+        mask_bool = self.mask[past_len:past_len + num_tokens, :past_len + num_tokens]
+        if pad_lengths is not None: 
+            # left padded rows: the real tokens do not attend to the padding, the padding tokens attend
+            # to the padding before them so that no row of the scores is masked completely
+            is_pad = torch.arange(past_len + num_tokens, device=x.device) < pad_lengths.unsqueeze(1)
+            mask_bool = mask_bool | (is_pad.unsqueeze(1) & ~is_pad[:, past_len:].unsqueeze(2))
+            mask_bool = mask_bool.unsqueeze(1) # (b, 1, num_tokens, past_len + num_tokens)
         
-        attn_weights = torch.softmax(
-            attn_scores / keys.shape[-1]**0.5, dim=-1
-        )
-        attn_weights = self.dropout(attn_weights)
-        
-        context_vec = (attn_weights @ values).transpose(1, 2) 
+        if self.fused: 
+            # a single new token may attend to everything, without a cache the kernel applies the causal mask
+            # itself and only the chunked prefill after a cache or a padded batch needs the mask
+            explicit_mask = pad_lengths is not None or (num_tokens > 1 and past_len > 0)
+            context_vec = F.scaled_dot_product_attention(
+                queries, keys, values, 
+                attn_mask=~mask_bool if explicit_mask else None, 
+                dropout_p=self.dropout.p if self.training else 0.0, 
+                is_causal=num_tokens > 1 and past_len == 0 and not explicit_mask, 
+            ).transpose(1, 2)
+        else: 
+            attn_scores = queries @ keys.transpose(2, 3)
+            attn_scores.masked_fill_(mask_bool, -torch.inf)
+            
+            attn_weights = torch.softmax(
+                attn_scores / keys.shape[-1]**0.5, dim=-1
+            )
+            attn_weights = self.dropout(attn_weights)
+            
+            context_vec = (attn_weights @ values).transpose(1, 2) 
         context_vec = context_vec.contiguous().view(b, num_tokens, self.d_out)
         context_vec = self.out_proj(context_vec)
+        if use_cache: 
+            return context_vec, (keys, values)
         return context_vec
     
 class TransformerBlock(nn.Module): 
@@ -97,16 +162,21 @@ class TransformerBlock(nn.Module):
             num_heads=cfg["n_heads"], 
             dropout=cfg["drop_rate"],
             qkv_bias=cfg["qkv_bias"], 
+            fused=cfg.get("fused_attn", False), 
+            cache_packed=cfg.get("cache_packed_qkv", False), 
         )
         self.ff = FeedForward(cfg)
         self.norm1 = LayerNorm(cfg["emb_dim"])
         self.norm2 = LayerNorm(cfg["emb_dim"])
         self.drop_resid = nn.Dropout(cfg["drop_rate"])
     
-    def forward(self, x): 
+    def forward(self, x, kv_cache=None, use_cache=False, pad_lengths=None): 
         shortcut = x
         x = self.norm1(x)
-        x = self.att(x)
+        if use_cache: 
+            x, new_kv_cache = self.att(x, kv_cache=kv_cache, use_cache=True, pad_lengths=pad_lengths)
+        else: 
+            x = self.att(x, pad_lengths=pad_lengths)
         x = self.drop_resid(x)
         x = x + shortcut 
         
@@ -115,6 +185,8 @@ class TransformerBlock(nn.Module):
         x = self.ff(x) 
         x = self.drop_resid(x)
         x = x + shortcut 
+        if use_cache: 
+            return x, new_kv_cache
         return x
 
 class GPTModel(nn.Module): 
@@ -129,15 +201,43 @@ class GPTModel(nn.Module):
         )
         self.final_norm = LayerNorm(cfg["emb_dim"])
         self.out_head = nn.Linear(cfg["emb_dim"], cfg["vocab_size"], bias=False)
+        # activation checkpointing of every checkpoint_every-th block while training, 0 is off
+        self.checkpoint_every = cfg.get("checkpoint_every", 0)
         
-    def forward(self, in_idx): 
+    def forward(self, in_idx, kv_caches=None, use_cache=False, pad_lengths=None): 
+        # pad_lengths (batch): number of padding tokens on the left of every row, for a batch of
+        # prompts of different lengths; the cache includes the padding
         batch_size, seq_len = in_idx.shape 
+        # with a cache the new tokens continue after the ones already processed
+        past_len = 0 if kv_caches is None else kv_caches[0][0].shape[2]
         tok_embeds = self.tok_emb(in_idx)
-        pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+        positions = torch.arange(past_len, past_len + seq_len, device=in_idx.device)
+        if pad_lengths is not None: 
+            # every row counts its positions from its first real token
+            positions = (positions - pad_lengths.unsqueeze(1)).clamp(min=0)
+        pos_embeds = self.pos_emb(positions)
         x = tok_embeds + pos_embeds
         x = self.drop_emb(x)
-        x  = self.trf_blocks(x)
+        if use_cache: 
+            new_kv_caches = []
+            for i, block in enumerate(self.trf_blocks): 
+                kv_cache = None if kv_caches is None else kv_caches[i]
+                x, kv_cache = block(x, kv_cache=kv_cache, use_cache=True, pad_lengths=pad_lengths)
+                new_kv_caches.append(kv_cache)
+        elif self.checkpoint_every: 
+            for i, block in enumerate(self.trf_blocks): 
+                if checkpointed(i, self.checkpoint_every): 
+                    # the RNG state is saved as well, so the recomputation uses the same dropout masks
+                    x = checkpoint(block, x, pad_lengths=pad_lengths, use_reentrant=False)
+                else: 
+                    x = block(x, pad_lengths=pad_lengths)
+        elif pad_lengths is not None: 
+            for block in self.trf_blocks: 
+                x = block(x, pad_lengths=pad_lengths)
+        else: 
+            x  = self.trf_blocks(x)
         x = self.final_norm(x)
         logits = self.out_head(x)
+        if use_cache: 
+            return logits, new_kv_caches
         return logits 
-    
\ No newline at end of file
@@ -0,0 +1,172 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+CHUNK_BYTES = 4 * 1024 * 1024
+
+_tokenizer = None
+_dtype = None
+
+
+def token_dtype(n_vocab):
+    # GPT-2 ids are below 2**16 and take two bytes on disk, larger vocabularies like cl100k_base
+    # or o200k_base would wrap around in uint16
+    return np.uint16 if n_vocab <= 2**16 else np.uint32
+
+def _init_worker(encoding_name):
+    global _tokenizer, _dtype
+    import tiktoken
+    _tokenizer = tiktoken.get_encoding(encoding_name)
+    _dtype = token_dtype(_tokenizer.n_vocab)
+
+def _encode_chunk(task):
+    # reads its own byte range so that only the token ids travel back to the main process
+    path, start, end, last = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8', errors='replace')
+    ids = _tokenizer.encode_ordinary(text)
+    if last:
+        # documents are separated by <|endoftext|> like in the GPT-2 training data
+        ids.append(_tokenizer.eot_token)
+    return np.asarray(ids, dtype=_dtype), end - start
+
+def input_files(inputs, pattern):
+    files = []
+    for path in map(Path, inputs):
+        files.extend(sorted(p for p in path.rglob(pattern) if p.is_file()) if path.is_dir() else [path])
+    return files
+
+def chunk_tasks(files, chunk_bytes=CHUNK_BYTES):
+    # Every file is one document, split into byte ranges that end on a newline so that no character
+    # and (almost) no BPE merge is cut. Yields (path, start, end, last chunk of the document).
+    for path in files:
+        size = path.stat().st_size
+        start = 0
+        with open(path, 'rb') as f:
+            while start < size:
+                f.seek(min(start + chunk_bytes, size))
+                f.readline()
+                end = min(f.tell(), size)
+                yield str(path), start, end, end == size
+                start = end
+        if size == 0:
+            yield str(path), 0, 0, True
+
+class ShardWriter:
+
+    # fixed size shards of shard_size tokens, the last one holds the rest
+    def __init__(self, output_dir, shard_size, dtype=np.uint16):
+        self.output_dir = Path(output_dir)
+        self.shard_size = shard_size
+        self.shards = []
+        self.buffer = np.empty(shard_size, dtype=dtype)
+        self.filled = 0
+
+    def write(self, ids):
+        while len(ids):
+            n = min(len(ids), self.shard_size - self.filled)
+            self.buffer[self.filled:self.filled + n] = ids[:n]
+            self.filled += n
+            ids = ids[n:]
+            if self.filled == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if self.filled == 0:
+            return
+        name = f'shard_{len(self.shards):05d}.bin'
+        tmp_path = self.output_dir / (name + '.tmp')
+        self.buffer[:self.filled].tofile(tmp_path)
+        os.replace(tmp_path, self.output_dir / name)
+        self.shards.append({'file': name, 'num_tokens': int(self.filled)})
+        self.filled = 0
+
+def prepare_corpus(inputs, output_dir, shard_size=100_000_000, num_workers=None, pattern='*.txt',
+                   encoding_name='gpt2', chunk_bytes=CHUNK_BYTES, report_every=10.0):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # an index only exists for a complete run, it is written last
+    index_path = output_dir / 'index.json'
+    for stale in [index_path] + list(output_dir.glob('shard_*.bin')):
+        stale.unlink(missing_ok=True)
+
+    import tiktoken
+    encoding = tiktoken.get_encoding(encoding_name)
+    dtype = token_dtype(encoding.n_vocab)
+
+    files = input_files(inputs, pattern)
+    tasks = list(chunk_tasks(files, chunk_bytes))
+    total_bytes = sum(path.stat().st_size for path in files)
+    num_workers = num_workers or os.cpu_count()
+    print(f'Tokenizing {len(files)} files ({total_bytes / 1e6:.1f} MB) with {num_workers} workers')
+
+    writer = ShardWriter(output_dir, shard_size, dtype)
+    # global token offset at which every document starts
+    doc_starts = [0]
+    num_tokens, num_bytes = 0, 0
+    start_time = last_report = time.perf_counter()
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(encoding_name,)) as pool:
+        # imap keeps the input order, so the shards are the same for any number of workers
+        for task, (ids, chunk_size) in zip(tasks, pool.imap(_encode_chunk, tasks)):
+            writer.write(ids)
+            num_tokens += len(ids)
+            num_bytes += chunk_size
+            if task[3]:
+                doc_starts.append(num_tokens)
+
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                elapsed = now - start_time
+                print(f'{num_tokens:,} tokens, {num_tokens / elapsed:,.0f} tokens/sec, '
+                      f'{num_bytes / elapsed / 1e6:.1f} MB/sec, {100 * num_bytes / max(total_bytes, 1):.1f}% done')
+                last_report = now
+    writer.flush()
+
+    # document i is the token range [documents[i], documents[i + 1]) of the concatenated shards
+    np.save(output_dir / 'documents.npy', np.asarray(doc_starts, dtype=np.int64))
+    index = {
+        'dtype': np.dtype(dtype).name,
+        'encoding': encoding_name,
+        'n_vocab': encoding.n_vocab,
+        'eot_token': encoding.eot_token,
+        'shard_size': shard_size,
+        'num_tokens': num_tokens,
+        'num_documents': len(doc_starts) - 1,
+        'shards': writer.shards,
+        'sources': [str(path) for path in files],
+    }
+    tmp_path = index_path.with_suffix('.json.tmp')
+    tmp_path.write_text(json.dumps(index, indent=2))
+    os.replace(tmp_path, index_path)
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Wrote {num_tokens:,} tokens in {len(writer.shards)} shards to {output_dir} in {elapsed:.1f}s '
+          f'({num_tokens / max(elapsed, 1e-9):,.0f} tokens/sec)')
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description='Tokenize text files into GPT-2 token shards for pretraining')
+    parser.add_argument('inputs', nargs='+', help='text files or directories to search for them')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--shard-size', type=int, default=100_000_000, help='tokens per shard')
+    parser.add_argument('--workers', type=int, default=None, help='tokenizer processes, all cores by default')
+    parser.add_argument('--pattern', default='*.txt', help='file pattern inside input directories')
+    parser.add_argument('--encoding', default='gpt2', help='tiktoken encoding')
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / (1024 * 1024),
+                        help='size of the pieces the files are split into for the workers')
+    args = parser.parse_args()
+
+    prepare_corpus(args.inputs, args.output_dir, shard_size=args.shard_size, num_workers=args.workers,
+                   pattern=args.pattern, encoding_name=args.encoding,
+                   chunk_bytes=int(args.chunk_mb * 1024 * 1024))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+
+def shard_dtype(shards, default=np.uint16):
+    # the token dtype written into index.json by prepare_corpus.py, uint32 for vocabularies above 2**16
+    if isinstance(shards, (str, Path)) and (Path(shards) / 'index.json').exists():
+        return np.dtype(json.loads((Path(shards) / 'index.json').read_text())['dtype'])
+    return np.dtype(default)
+
+def shard_paths(shards):
+    # a directory stands for the shards listed in its index.json (see prepare_corpus.py),
+    # or else all the .bin files in it, in name order
+    if isinstance(shards, (str, Path)):
+        shards = [shards]
+    paths = []
+    for shard in map(Path, shards):
+        if (shard / 'index.json').exists():
+            index = json.loads((shard / 'index.json').read_text())
+            paths.extend(shard / info['file'] for info in index['shards'])
+        else:
+            paths.extend(sorted(shard.glob('*.bin')) if shard.is_dir() else [shard])
+    return paths
+
+class SlidingWindowDataset(Dataset):
+
+    # The input/target windows of GPTDatasetV1 over flat token id files that are read through np.memmap,
+    # so only the windows that are actually used are ever loaded. Windows never cross a shard boundary,
+    # so the end of a shard that does not fill one more window is dropped. The shards are the
+    # concatenated token ids of the corpus as written by e.g. prepare_corpus.py.
+    def __init__(self, shards, max_length, stride, dtype=None):
+        self.paths = shard_paths(shards)
+        self.max_length = max_length
+        self.stride = stride
+        self.dtype = shard_dtype(shards) if dtype is None else np.dtype(dtype)
+
+        num_tokens = np.array([path.stat().st_size // self.dtype.itemsize for path in self.paths])
+        # the same starts as range(0, num_tokens - max_length, stride)
+        num_windows = np.maximum(0, (num_tokens - max_length + stride - 1) // stride)
+        self.num_tokens = int(num_tokens.sum())
+        # global index of the first window of every shard
+        self.window_offsets = np.concatenate([[0], np.cumsum(num_windows)])
+        self._shards = None
+
+    def _open(self):
+        # opened on first use in every DataLoader worker, __getstate__ leaves the maps out of the pickle
+        if self._shards is None:
+            self._shards = [np.memmap(path, dtype=self.dtype, mode='r') for path in self.paths]
+        return self._shards
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __len__(self):
+        return int(self.window_offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.window_offsets, idx, side='right')) - 1
+        start = (idx - int(self.window_offsets[shard])) * self.stride
+        # max_length + 1 tokens are read once, input and target are overlapping views of them
+        chunk = torch.from_numpy(self._open()[shard][start:start + self.max_length + 1].astype(np.int64))
+        return chunk[:-1], chunk[1:]
+
+class ShuffledSampler(Sampler):
+
+    # a new permutation of the windows every epoch that only depends on the seed and the epoch,
+    # so a run can be repeated or resumed with the same order
+    def __init__(self, num_samples, seed=0):
+        super().__init__()
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        order = np.random.default_rng(self.seed + self.epoch).permutation(self.num_samples)
+        return iter(order.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+def create_pretrain_dataloader(shards, batch_size=4, max_length=256, stride=128, shuffle=True,
+                               drop_last=True, dtype=None, seed=123, num_workers=0):
+    # Replacement for create_dataloader_v1 over pre-tokenized shards (see prepare_corpus.py), with two
+    # differences the training loop has to know about:
+    # - the shuffled order only changes when the loop calls loader.sampler.set_epoch(epoch) before
+    #   every epoch, like with a DistributedSampler; without it every epoch sees the same order
+    # - windows never cross a shard boundary, the tokens at the end of a shard that do not fill one
+    #   more window are silently left out
+    dataset = SlidingWindowDataset(shards, max_length, stride, dtype)
+    sampler = ShuffledSampler(len(dataset), seed) if shuffle else None
+    return DataLoader(
+        dataset, batch_size=batch_size, sampler=sampler, drop_last=drop_last, num_workers=num_workers
+    )
+
+def create_text_file_dataloader(text_file, tokenizer, **kwargs):
+    # a single text file like data/the-verdict.txt, tokenized once into the int32 token cache
+    from tokenized import cached_tokenize_file
+
+    tokens = cached_tokenize_file(text_file, tokenizer)
+    return create_pretrain_dataloader(tokens.path('ids'), dtype=np.int32, **kwargs)
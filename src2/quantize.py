@@ -0,0 +1,39 @@
+import io
+import time
+
+import torch
+import torch.nn as nn
+
+
+def quantize_gpt(model, inplace=False):
+    # Every nn.Linear (the attention projections, the feed forward layers and out_head) gets int8
+    # weights with one scale per output channel, the activations are quantized on the fly per batch.
+    # The quantized kernels only run on the CPU.
+    from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+
+    quantized = quantize_dynamic(
+        model, {nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=inplace
+    )
+    # the fused attention path concatenates the float weights, which no longer exist
+    for module in quantized.modules():
+        if hasattr(module, "fused"):
+            module.fused = False
+    return quantized
+
+
+def model_size_mb(model):
+    # size of the serialized state dict, which also covers the packed int8 weights
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / (1024 * 1024)
+
+
+def benchmark_latency(model, input_batch, num_runs=10):
+    # mean seconds per forward pass after one warm up run
+    model.eval()
+    with torch.no_grad():
+        model(input_batch)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            model(input_batch)
+    return (time.perf_counter() - start) / num_runs
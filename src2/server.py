@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from classify import classify_ids
+from generation import batch_generate
+
+
+class PendingRequest:
+
+    def __init__(self, ids, params, num_tokens):
+        self.ids = ids
+        self.params = params
+        # padded tokens this request adds to a batch, prompt plus new tokens for generation
+        self.num_tokens = num_tokens
+        self.arrival = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+class Metrics:
+
+    # counters of one batcher, the latencies and batch sizes of the last window requests / batches
+    def __init__(self, window=10_000):
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        # the batches the model actually ran, a batch of requests with different settings takes several
+        self.model_batches = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.batch_tokens = collections.deque(maxlen=window)
+
+    def snapshot(self, queue_depth):
+        latencies = list(self.latencies)
+        return {
+            "queue_depth": queue_depth,
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "model_batches": self.model_batches,
+            "last_batch_size": self.batch_sizes[-1] if self.batch_sizes else None,
+            "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+            "mean_batch_tokens": sum(self.batch_tokens) / len(self.batch_tokens) if self.batch_tokens else None,
+            "p50_latency_ms": None if not latencies else percentile(latencies, 50) * 1000,
+            "p99_latency_ms": None if not latencies else percentile(latencies, 99) * 1000,
+        }
+
+class MicroBatcher:
+
+    # Queues single requests and hands them to run_batch in batches: a batch is closed when it has
+    # max_batch_size requests, when the next request would take it over max_batch_tokens padded tokens,
+    # or max_wait_ms after its first request arrived. run_batch runs in the model executor and returns
+    # one result per request, or the exception that request failed with; the requests arriving in the
+    # meantime wait in the queue for the next batch.
+    def __init__(self, run_batch, executor, max_batch_size=32, max_batch_tokens=8192, max_wait_ms=5.0):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.metrics = Metrics()
+        # a request that did not fit into the previous batch starts the next one
+        self._carry = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() + (self._carry is not None)
+
+    async def submit(self, ids, params, num_tokens):
+        request = PendingRequest(ids, params, num_tokens)
+        await self.queue.put(request)
+        return await request.future
+
+    async def _next_batch(self):
+        first = self._carry if self._carry is not None else await self.queue.get()
+        self._carry = None
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            # padding: every row of the batch is as long as its longest request
+            padded = (len(batch) + 1) * max(request.num_tokens, max(r.num_tokens for r in batch))
+            if padded > self.max_batch_tokens:
+                self._carry = request
+                break
+            batch.append(request)
+        return batch
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            batch = [request for request in batch if not request.future.cancelled()]
+            if not batch:
+                continue
+            self.metrics.batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.batch_tokens.append(len(batch) * max(r.num_tokens for r in batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                self.metrics.errors += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.metrics.errors += 1
+                    if not request.future.done():
+                        request.future.set_exception(result)
+                    continue
+                self.metrics.requests += 1
+                self.metrics.latencies.append(now - request.arrival)
+                if not request.future.done():
+                    request.future.set_result(result)
+
+class InferenceServer:
+
+    # HTTP/1.1 JSON service on asyncio streams:
+    #   POST /classify {"text": ...} -> {"label": ..., "probs": {...}}
+    #   POST /generate {"prompt": ..., "max_new_tokens": 50, "temperature": 0.0, "top_k": null} -> {"text": ...}
+    #   GET /metrics, GET /health
+    # Both models run on a single executor thread, so batches never compete for the intra-op threads.
+    def __init__(self, tokenizer, device, classifier=None, generator=None, class_names=("not spam", "spam"),
+                 max_batch_size=32, max_batch_tokens=8192, max_wait_ms=5.0, num_threads=None,
+                 max_length=None, max_new_tokens_limit=256, pad_token_id=50256, eos_id=50256, pad_multiple=None):
+        self.tokenizer = tokenizer
+        self.device = device
+        self.classifier = classifier
+        self.generator = generator
+        self.class_names = class_names
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        # the classifier batches are padded to a multiple of this, a compiled classifier then needs few graphs
+        self.pad_multiple = pad_multiple
+        self.max_new_tokens_limit = max_new_tokens_limit
+        self.pad_token_id = pad_token_id
+        self.eos_id = eos_id
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, initializer=torch.set_num_threads if num_threads else None,
+            initargs=(num_threads,) if num_threads else ()
+        )
+        batch_kwargs = dict(max_batch_size=max_batch_size, max_batch_tokens=max_batch_tokens, max_wait_ms=max_wait_ms)
+        self.batchers = {}
+        if classifier is not None:
+            self.batchers["classify"] = MicroBatcher(self._classify_batch, self.executor, **batch_kwargs)
+        if generator is not None:
+            self.batchers["generate"] = MicroBatcher(self._generate_batch, self.executor, **batch_kwargs)
+        self.start_time = time.time()
+
+    def _classify_batch(self, batch):
+        probs = classify_ids([r.ids for r in batch], self.classifier, self.device, self.pad_token_id, self.pad_multiple)
+        self.batchers["classify"].metrics.model_batches += 1
+        return [
+            {"label": self.class_names[int(p.argmax())],
+             "probs": {name: float(v) for name, v in zip(self.class_names, p.tolist())}}
+            for p in probs
+        ]
+
+    def _generate_batch(self, batch):
+        # the prompts are left padded to the longest one and decoded together, only requests with
+        # different sampling settings are split into separate groups
+        groups = collections.defaultdict(list)
+        for i, r in enumerate(batch):
+            groups[(r.params["top_k"], r.params["temperature"])].append(i)
+        results = [None] * len(batch)
+        context_size = self.generator.pos_emb.weight.shape[0]
+        for (top_k, temperature), rows in groups.items():
+            # a group that fails only fails its own requests
+            try:
+                lengths = [len(batch[i].ids) for i in rows]
+                idx = torch.full((len(rows), max(lengths)), self.pad_token_id, dtype=torch.long)
+                for row, (i, length) in enumerate(zip(rows, lengths)):
+                    idx[row, idx.shape[1] - length:] = torch.tensor(batch[i].ids)
+                pad_lengths = None
+                if min(lengths) < max(lengths):
+                    pad_lengths = torch.tensor([idx.shape[1] - length for length in lengths], device=self.device)
+                generated = batch_generate(
+                    self.generator, idx.to(self.device), [batch[i].params["max_new_tokens"] for i in rows],
+                    context_size, top_k=top_k, temperature=temperature, eos_id=self.eos_id, pad_lengths=pad_lengths
+                )
+                for i, ids in zip(rows, generated):
+                    results[i] = {"text": self.tokenizer.decode(ids), "num_tokens": len(ids)}
+            except Exception as e:
+                for i in rows:
+                    results[i] = e
+            self.batchers["generate"].metrics.model_batches += 1
+        return results
+
+    def warmup(self, prompt_length=16, decode_steps=4):
+        # compiles the graphs of CompiledGPT models before the first request: the classifier for the
+        # smallest and the largest batch at every padded length, the generator for a prompt and a few
+        # KV cache steps, whose graph has dynamic shapes
+        if self.classifier is not None:
+            context_length = self.classifier.pos_emb.weight.shape[0]
+            max_length = min(self.max_length or context_length, context_length)
+            step = self.pad_multiple or max_length
+            lengths = sorted({min(length, max_length) for length in range(step, max_length + step, step)})
+            self.classifier.warmup(batch_sizes=sorted({1, self.max_batch_size}), lengths=lengths)
+        if self.generator is not None:
+            self.generator.warmup(batch_sizes=(1, 2), lengths=(prompt_length,), decode_steps=decode_steps)
+
+    async def classify(self, body):
+        context_length = self.classifier.pos_emb.weight.shape[0]
+        max_length = min(self.max_length or context_length, context_length)
+        ids = self.tokenizer.encode(str(body["text"]))[:max_length] or [self.pad_token_id]
+        return await self.batchers["classify"].submit(ids, {}, len(ids))
+
+    async def generate(self, body):
+        context_length = self.generator.pos_emb.weight.shape[0]
+        ids = self.tokenizer.encode(str(body["prompt"]), allowed_special={"<|endoftext|>"})[-context_length:]
+        if not ids:
+            raise ValueError("empty prompt")
+        params = {
+            "max_new_tokens": max(0, min(int(body.get("max_new_tokens", 50)), self.max_new_tokens_limit)),
+            "temperature": float(body.get("temperature", 0.0)),
+            "top_k": None if body.get("top_k") is None else int(body["top_k"]),
+        }
+        # rejected here with a 400, in the batch they would only fail inside torch.topk / multinomial
+        vocab_size = self.generator.tok_emb.num_embeddings
+        if params["top_k"] is not None and not 1 <= params["top_k"] <= vocab_size:
+            raise ValueError(f"top_k must be between 1 and {vocab_size}, got {params['top_k']}")
+        if not params["temperature"] >= 0.0:
+            raise ValueError(f"temperature must not be negative, got {params['temperature']}")
+        return await self.batchers["generate"].submit(ids, params, len(ids) + params["max_new_tokens"])
+
+    def metrics(self):
+        return {
+            "uptime_s": time.time() - self.start_time,
+            **{name: b.metrics.snapshot(b.queue_depth) for name, b in self.batchers.items()},
+        }
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "POST" and path in ("/classify", "/generate"):
+            name = path[1:]
+            if name not in self.batchers:
+                return 404, {"error": f"no model loaded for {name}"}
+            try:
+                request = json.loads(body or b"{}")
+                return 200, await getattr(self, name)(request)
+            except (KeyError, TypeError, ValueError) as e:
+                return 400, {"error": f"bad request: {e!r}"}
+        return 404, {"error": f"not found: {method} {path}"}
+
+    async def handle_connection(self, reader, writer):
+        # keep-alive connections, one request after the other
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, response = await self.route(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, response = 500, {"error": repr(e)}
+                payload = json.dumps(response).encode()
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        for batcher in self.batchers.values():
+            batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {', '.join(self.batchers)} on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for batcher in self.batchers.values():
+                await batcher.stop()
+            self.executor.shutdown()
+
+def load_models(model_size, models_dir, classifier_path, generator, num_classes=2):
+    from gpt_weights import build_causal_masks, load_gpt2_state_dict, load_gpt_model, load_state_dict_into_gpt
+    from model import GPTModel
+
+    cfg = {"vocab_size": 50257, "context_length": 1024, "drop_rate": 0.0, "qkv_bias": True}
+    cfg.update({
+        "124M": {"emb_dim": 768, "n_layers": 12, "n_heads": 12},
+        "355M": {"emb_dim": 1024, "n_layers": 24, "n_heads": 16},
+        "774M": {"emb_dim": 1280, "n_layers": 36, "n_heads": 20},
+        "1558M": {"emb_dim": 1600, "n_layers": 48, "n_heads": 25},
+    }[model_size])
+
+    classifier = None
+    if classifier_path:
+        # the fine-tuned state dict (e.g. review_classifier.pth from ch5&6.py) holds every weight,
+        # the model is created on the meta device and takes its tensors over
+        with torch.device("meta"):
+            classifier = GPTModel(cfg)
+            classifier.out_head = torch.nn.Linear(cfg["emb_dim"], num_classes)
+        state_dict = torch.load(classifier_path, map_location="cpu", weights_only=True)
+        load_state_dict_into_gpt(classifier, state_dict, assign=True)
+        build_causal_masks(classifier)
+        classifier.eval()
+
+    gpt = None
+    if generator:
+        _, state_dict = load_gpt2_state_dict(model_size=model_size, models_dir=models_dir)
+        gpt = load_gpt_model(cfg, state_dict).eval()
+    return classifier, gpt
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP server for the spam classifier and GPT-2")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--classifier", default="review_classifier.pth",
+                        help="fine-tuned classifier weights, empty to serve no classifier")
+    parser.add_argument("--no-generator", action="store_true", help="do not load the pretrained GPT-2 for /generate")
+    parser.add_argument("--model-size", default="124M", choices=["124M", "355M", "774M", "1558M"])
+    parser.add_argument("--models-dir", default="gpt2")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-batch-tokens", type=int, default=8192, help="padded tokens per batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="how long the first request of a batch waits for others")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads of the model thread")
+    parser.add_argument("--max-length", type=int, default=None, help="tokens of a text the classifier sees")
+    parser.add_argument("--compile", action="store_true",
+                        help="run the models through torch.compile, the graphs are compiled at startup")
+    parser.add_argument("--pad-multiple", type=int, default=32,
+                        help="with --compile the classifier batches are padded to a multiple of this")
+    args = parser.parse_args()
+
+    import tiktoken
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    classifier, generator = load_models(args.model_size, args.models_dir, args.classifier, not args.no_generator)
+    models = [None if m is None else m.to(device) for m in (classifier, generator)]
+    if args.compile:
+        from inference import CompiledGPT
+        models = [None if m is None else CompiledGPT(m) for m in models]
+    classifier, generator = models
+
+    server = InferenceServer(
+        tiktoken.get_encoding("gpt2"), device, classifier=classifier, generator=generator,
+        max_batch_size=args.max_batch_size, max_batch_tokens=args.max_batch_tokens,
+        max_wait_ms=args.max_wait_ms, num_threads=args.threads, max_length=args.max_length,
+        pad_multiple=args.pad_multiple if args.compile else None,
+    )
+    if args.compile:
+        server.warmup()
+    asyncio.run(server.serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the code that src/ and src2/ have in common lives in the common package at the root of the repository
+ROOT = str(Path(__file__).resolve().parent.parent)
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
@@ -0,0 +1,70 @@
+import pytest
+import torch
+
+from model import GPTModel, MultiHeadAttention
+
+
+CFG = {"vocab_size": 100, "context_length": 16, "emb_dim": 32, "n_heads": 4, "n_layers": 2,
+       "drop_rate": 0.0, "qkv_bias": True}
+
+def attention_pair(cache_packed=False, qkv_bias=True):
+    torch.manual_seed(0)
+    eager = MultiHeadAttention(32, 32, 16, dropout=0.0, num_heads=4, qkv_bias=qkv_bias)
+    fused = MultiHeadAttention(32, 32, 16, dropout=0.0, num_heads=4, qkv_bias=qkv_bias, fused=True,
+                               cache_packed=cache_packed)
+    fused.load_state_dict(eager.state_dict())
+    return eager.eval(), fused.eval()
+
+@pytest.mark.parametrize("qkv_bias", [False, True])
+@pytest.mark.parametrize("cache_packed", [False, True])
+def test_uncached_matches_eager(cache_packed, qkv_bias):
+    eager, fused = attention_pair(cache_packed, qkv_bias)
+    x = torch.randn(2, 9, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(fused(x), eager(x), atol=1e-5, rtol=1e-5)
+
+@pytest.mark.parametrize("cache_packed", [False, True])
+@pytest.mark.parametrize("chunks", [[5, 1, 1, 1], [3, 4, 2]])
+def test_cached_matches_eager(cache_packed, chunks):
+    # a prompt, then single tokens (mask free) or chunks after a cache (offset causal mask)
+    eager, fused = attention_pair(cache_packed)
+    x = torch.randn(2, sum(chunks), 32)
+    with torch.no_grad():
+        outputs = {}
+        for name, attention in (("eager", eager), ("fused", fused)):
+            kv_cache, steps, start = None, [], 0
+            for size in chunks:
+                out, kv_cache = attention(x[:, start:start + size], kv_cache=kv_cache, use_cache=True)
+                steps.append(out)
+                start += size
+            outputs[name] = torch.cat(steps, dim=1)
+        torch.testing.assert_close(outputs["fused"], outputs["eager"], atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(outputs["fused"], eager(x), atol=1e-5, rtol=1e-5)
+
+def test_training_gradients_match_eager():
+    eager, fused = attention_pair()
+    x = torch.randn(2, 6, 32)
+    eager(x).square().sum().backward()
+    fused(x).square().sum().backward()
+    for p_eager, p_fused in zip(eager.parameters(), fused.parameters()):
+        torch.testing.assert_close(p_fused.grad, p_eager.grad, atol=1e-4, rtol=1e-4)
+
+def test_model_logits_match_eager():
+    torch.manual_seed(0)
+    eager = GPTModel(CFG).eval()
+    fused = GPTModel({**CFG, "fused_attn": True}).eval()
+    fused.load_state_dict(eager.state_dict())
+    idx = torch.randint(0, 100, (2, 10))
+    with torch.no_grad():
+        torch.testing.assert_close(fused(idx), eager(idx), atol=1e-5, rtol=1e-5)
+        logits, kv_caches = fused(idx[:, :7], use_cache=True)
+        for i in range(7, 10):
+            logits, kv_caches = fused(idx[:, i:i + 1], kv_caches=kv_caches, use_cache=True)
+        torch.testing.assert_close(logits[:, -1], eager(idx)[:, -1], atol=1e-5, rtol=1e-5)
+
+def test_packed_weights_are_only_cached_when_asked():
+    for cache_packed in (False, True):
+        _, fused = attention_pair(cache_packed)
+        with torch.no_grad():
+            fused(torch.randn(1, 3, 32))
+        assert (fused.packed is not None) == cache_packed
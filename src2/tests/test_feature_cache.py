@@ -0,0 +1,62 @@
+import torch
+from torch.utils.data import DataLoader
+
+from classify import last_token_logits
+from feature_cache import FrozenTrunkTail, build_feature_cache, num_frozen_blocks, pad_features, train_classifier_cached
+from model import GPTModel
+
+
+CFG = {"vocab_size": 50, "context_length": 16, "emb_dim": 32, "n_heads": 4, "n_layers": 3,
+       "drop_rate": 0.0, "qkv_bias": False}
+PAD_ID = 0
+
+def classifier(num_frozen):
+    torch.manual_seed(0)
+    model = GPTModel(CFG)
+    model.out_head = torch.nn.Linear(CFG["emb_dim"], 2)
+    frozen = [model.tok_emb, model.pos_emb] + list(model.trf_blocks[:num_frozen])
+    for param in (p for module in frozen for p in module.parameters()):
+        param.requires_grad = False
+    return model
+
+def right_padded_texts(lengths):
+    # (input_ids, label) pairs like SpamDataset, padded to the longest text
+    dataset = []
+    for i, length in enumerate(lengths):
+        input_ids = torch.full((max(lengths),), PAD_ID)
+        input_ids[:length] = torch.randint(1, CFG["vocab_size"], (length,))
+        dataset.append((input_ids, torch.tensor(i % 2)))
+    return dataset
+
+def test_cached_tail_gives_the_logits_of_the_full_model(tmp_path):
+    model = classifier(num_frozen=2)
+    dataset = right_padded_texts([5, 12, 1, 8])
+    num_frozen = num_frozen_blocks(model)
+    cache = build_feature_cache(model, dataset, tmp_path, num_frozen, torch.device("cpu"), batch_size=3,
+                                pad_token_id=PAD_ID)
+    assert num_frozen == 2
+
+    hidden, lengths, labels = next(iter(DataLoader(cache, batch_size=4, collate_fn=pad_features)))
+    input_batch = torch.stack([input_ids for input_ids, _ in dataset])
+    model.eval()
+    with torch.no_grad():
+        expected = last_token_logits(model, input_batch, pad_token_id=PAD_ID)
+        torch.testing.assert_close(FrozenTrunkTail(model, num_frozen)(hidden, lengths), expected,
+                                   atol=1e-5, rtol=1e-5)
+    assert labels.tolist() == [0, 1, 0, 1]
+
+def test_bf16_training_of_the_tail_leaves_the_frozen_blocks_alone(tmp_path):
+    model = classifier(num_frozen=1)
+    cache = build_feature_cache(model, right_padded_texts([5, 12, 1, 8, 3, 7]), tmp_path, 1,
+                                torch.device("cpu"), pad_token_id=PAD_ID)
+    frozen = [p.clone() for p in model.trf_blocks[0].parameters()]
+    trained = [p.clone() for p in model.trf_blocks[1].parameters()]
+    tail = FrozenTrunkTail(model, 1)
+    optimizer = torch.optim.AdamW([p for p in tail.parameters() if p.requires_grad], lr=1e-3)
+    loader = DataLoader(cache, batch_size=2, shuffle=True, collate_fn=pad_features)
+
+    train_losses, *_ = train_classifier_cached(tail, loader, loader, optimizer, torch.device("cpu"),
+                                               num_epochs=1, eval_freq=1, eval_iter=1, use_bf16=True)
+    assert all(torch.isfinite(torch.tensor(train_losses)))
+    assert all(torch.equal(a, b) for a, b in zip(frozen, model.trf_blocks[0].parameters()))
+    assert not all(torch.equal(a, b) for a, b in zip(trained, model.trf_blocks[1].parameters()))
@@ -0,0 +1,188 @@
+import pytest
+import torch
+
+import generation
+from generation import GenerationStats, SpeculativeStats, batch_generate, speculative_generate, stream_generate
+from model import GPTModel
+
+
+CFG = {"vocab_size": 50, "context_length": 32, "emb_dim": 32, "n_heads": 4, "n_layers": 2,
+       "drop_rate": 0.0, "qkv_bias": False}
+
+def tiny_gpt(seed):
+    torch.manual_seed(seed)
+    return GPTModel(CFG).eval()
+
+def greedy(model, idx, max_new_tokens, context_size):
+    # the uncached greedy loop of generate(..., top_k=None, temperature=0.0)
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            logits = model(idx[:, -context_size:])
+            idx = torch.cat((idx, logits[:, -1].argmax(dim=-1, keepdim=True)), dim=1)
+    return idx
+
+@pytest.fixture
+def checked_caches(monkeypatch):
+    # every time a model continues from a cache, the cache holds exactly the tokens of idx before the
+    # new ones, with the keys and values a forward pass over them from scratch computes
+    extend = generation._extend
+
+    def checked_extend(model, idx, kv_caches, num_new, context_size):
+        if kv_caches is not None:
+            past_len = kv_caches[0][0].shape[2]
+            assert past_len + num_new == idx.shape[1]
+            with torch.no_grad():
+                _, expected = model(idx[:, :past_len], use_cache=True)
+            for (keys, values), (expected_keys, expected_values) in zip(kv_caches, expected):
+                torch.testing.assert_close(keys, expected_keys, atol=1e-5, rtol=1e-5)
+                torch.testing.assert_close(values, expected_values, atol=1e-5, rtol=1e-5)
+        return extend(model, idx, kv_caches, num_new, context_size)
+    monkeypatch.setattr(generation, "_extend", checked_extend)
+
+@pytest.mark.parametrize("draft_seed", [0, 1])
+def test_greedy_speculative_matches_target_with_consistent_caches(draft_seed, checked_caches):
+    # the same model as draft accepts every token, another one only some of them
+    target, draft = tiny_gpt(0), tiny_gpt(draft_seed)
+    idx = torch.randint(0, CFG["vocab_size"], (1, 5))
+    stats = SpeculativeStats()
+    out = speculative_generate(target, draft, idx, 20, CFG["context_length"], num_draft_tokens=3, stats=stats)
+
+    assert out.tolist() == greedy(target, idx, 20, CFG["context_length"]).tolist()
+    if draft_seed == 0:
+        assert stats.accepted == stats.drafted
+    else:
+        assert 0 < stats.accepted < stats.drafted
+
+def test_rejection_of_equal_distributions_samples_the_target(monkeypatch):
+    # p == q can still be rejected by rounding, max(0, p - q) is all zero then
+    monkeypatch.setattr(torch, "rand", lambda *size: torch.ones(()))
+    target = tiny_gpt(0)
+    idx = torch.randint(0, CFG["vocab_size"], (1, 4))
+    out = speculative_generate(target, target, idx, 8, CFG["context_length"], num_draft_tokens=2)
+    assert out.tolist() == greedy(target, idx, 8, CFG["context_length"]).tolist()
+
+def test_speculative_stops_at_eos():
+    target, draft = tiny_gpt(0), tiny_gpt(1)
+    idx = torch.randint(0, CFG["vocab_size"], (1, 5))
+    expected = greedy(target, idx, 12, CFG["context_length"])[0, 5:].tolist()
+    eos_id = expected[6]
+    out = speculative_generate(target, draft, idx, 12, CFG["context_length"], num_draft_tokens=4, eos_id=eos_id)
+    new_tokens = out[0, 5:].tolist()
+    assert new_tokens == expected[:expected.index(eos_id) + 1]
+
+def test_speculative_continues_past_the_context_window():
+    # the caches are rebuilt from the last context_size tokens once the sequence outgrows them
+    target, draft = tiny_gpt(0), tiny_gpt(1)
+    idx = torch.randint(0, CFG["vocab_size"], (1, 10))
+    context_size = 16
+    out = speculative_generate(target, draft, idx, 20, context_size, num_draft_tokens=3)
+    assert out.shape == (1, 30)
+    # up to the window the tokens are the greedy ones of the target
+    assert out[0, :context_size].tolist() == greedy(target, idx, context_size - 10, context_size)[0].tolist()
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_left_padded_rows_match_unpadded(fused):
+    torch.manual_seed(0)
+    model = GPTModel({**CFG, "fused_attn": fused}).eval()
+    prompts = [torch.randint(0, CFG["vocab_size"], (length,)) for length in (7, 3, 5)]
+    idx = torch.zeros(3, 7, dtype=torch.long)
+    for row, prompt in enumerate(prompts):
+        idx[row, 7 - len(prompt):] = prompt
+    pad_lengths = torch.tensor([0, 4, 2])
+    next_tokens = torch.randint(0, CFG["vocab_size"], (3, 1))
+    with torch.no_grad():
+        logits, kv_caches = model(idx, use_cache=True, pad_lengths=pad_lengths)
+        step_logits, _ = model(next_tokens, kv_caches=kv_caches, use_cache=True, pad_lengths=pad_lengths)
+        for row, prompt in enumerate(prompts):
+            expected = model(torch.cat((prompt, next_tokens[row]))[None])
+            torch.testing.assert_close(logits[row, 7 - len(prompt):], expected[0, :-1], atol=1e-5, rtol=1e-5)
+            torch.testing.assert_close(step_logits[row, -1], expected[0, -1], atol=1e-5, rtol=1e-5)
+
+def test_batch_generate_with_mixed_lengths_matches_single_rows():
+    model = tiny_gpt(0)
+    prompts = [torch.randint(0, CFG["vocab_size"], (length,)) for length in (6, 2, 4, 6)]
+    limits = [5, 9, 0, 9]
+    singles = [greedy(model, prompt[None], 9, CFG["context_length"])[0, len(prompt):].tolist() for prompt in prompts]
+    # a row stops at its eos, the others go on without it
+    eos_id = singles[0][2]
+
+    idx = torch.zeros(4, 6, dtype=torch.long)
+    for row, prompt in enumerate(prompts):
+        idx[row, 6 - len(prompt):] = prompt
+    generated = batch_generate(model, idx, limits, CFG["context_length"], eos_id=eos_id,
+                               pad_lengths=torch.tensor([6 - len(prompt) for prompt in prompts]))
+
+    for tokens, single, limit in zip(generated, singles, limits):
+        single = single[:limit]
+        assert tokens == (single[:single.index(eos_id)] if eos_id in single else single)
+
+# byte level pieces like the ones of GPT-2, "\xc3\xa9" is an é split over two tokens
+PIECES = [b"Hel", b"lo", b" wor", b"ld", b"?", b"ok E", b"ND more", b"caf", b"\xc3", b"\xa9!",
+          b"E", b"N", b"D", b"END", b"x", b" ", b"\xf0\x9f", b"\x98\x80", b"D\xc3"]
+STOP_ID = len(PIECES)
+
+class ByteTokenizer:
+    def decode(self, ids):
+        return b"".join(PIECES[i] for i in ids).decode("utf-8", errors="replace")
+
+class ScriptedModel:
+    # returns logits that make the greedy choice the next token of the script, with a dummy cache
+    def __init__(self, tokens):
+        self.tokens = iter(tokens)
+
+    def eval(self):
+        return self
+
+    def __call__(self, idx, kv_caches=None, use_cache=False):
+        past_len = 0 if kv_caches is None else kv_caches[0][0].shape[2]
+        logits = torch.zeros(1, idx.shape[1], STOP_ID + 1)
+        logits[0, -1, next(self.tokens)] = 1.0
+        cache = torch.zeros(1, 1, past_len + idx.shape[1], 1)
+        return logits, [(cache, cache)]
+
+def stream(tokens, stop_strings=(), max_new_tokens=None):
+    stats = GenerationStats()
+    chunks = list(stream_generate(ScriptedModel(tokens), torch.zeros(1, 1, dtype=torch.long),
+                                  max_new_tokens or len(tokens), 64, tokenizer=ByteTokenizer(),
+                                  stop_token_ids=(STOP_ID,), stop_strings=stop_strings, stats=stats))
+    return chunks, stats
+
+def test_possible_start_of_a_stop_string_is_held_back():
+    chunks, stats = stream([0, 1, 2, 3, 4], stop_strings=("world!",))
+    # "wor" and "world" could still become "world!", they are released once "?" rules that out
+    assert chunks == [(0, "Hel"), (1, "lo"), (2, " "), (3, ""), (4, "world?")]
+    assert stats.stop_reason == "length"
+
+    # at a stop token the held back text comes last, without a token id
+    chunks, stats = stream([0, 1, 2, STOP_ID], stop_strings=("world!",))
+    assert chunks == [(0, "Hel"), (1, "lo"), (2, " "), (None, "wor")]
+    assert stats.stop_reason == "stop_token"
+
+def test_stop_string_spanning_two_tokens():
+    chunks, stats = stream([5, 6], stop_strings=("END",))
+    assert chunks == [(5, "ok "), (6, "")]
+    assert stats.stop_reason == "stop_string"
+
+def test_character_split_over_tokens_is_yielded_once_complete():
+    chunks, _ = stream([7, 8, 9, 16, 17])
+    assert chunks == [(7, "caf"), (8, ""), (9, "\u00e9!"), (16, ""), (17, "\U0001F600")]
+
+    # the stop string is found even when the text ends in an incomplete character
+    chunks, stats = stream([7, 10, 11, 18], stop_strings=("END",))
+    assert chunks == [(7, "caf"), (10, ""), (11, ""), (18, "")]
+    assert stats.stop_reason == "stop_string"
+
+@pytest.mark.parametrize("seed", range(20))
+def test_streamed_text_is_the_decoded_text_up_to_the_first_stop_string(seed):
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(7, STOP_ID, (30,), generator=generator).tolist()
+    stop_strings = ("END", "x x")
+    full = ByteTokenizer().decode(tokens)
+
+    for strings in ((), stop_strings):
+        chunks, stats = stream(tokens, stop_strings=strings)
+        streamed = "".join(text for _, text in chunks)
+        positions = [p for p in (full.find(stop) for stop in strings) if p != -1]
+        # nothing after the start of the first stop string, not even a part of it, is ever yielded
+        assert streamed == full[:min(positions)] if positions else streamed == full
+        assert stats.stop_reason == ("stop_string" if positions else "length")
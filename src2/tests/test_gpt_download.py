@@ -0,0 +1,126 @@
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import gpt_download
+
+
+FILES = {"small.txt": b"hello gpt-2\n" * 100, "large.bin": os.urandom(10_000), "truncated.bin": b"t" * 100}
+# announced with more bytes than are sent, the connection closes in the middle of the body
+TRUNCATED_BY = {"truncated.bin": 1_000}
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    # serves FILES with HEAD and (ranged) GET like the blob storage the weights come from
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def do_GET(self):
+        self.send_file(head=False)
+
+    def send_file(self, head):
+        name = self.path.lstrip("/")
+        RangeHandler.requests.append((self.command, name, self.headers.get("Range")))
+        if name not in FILES:
+            self.send_error(404)
+            return
+        data = FILES[name]
+        start, end, status = 0, len(data) - 1, 200
+        if self.headers.get("Range"):
+            first, _, last = self.headers["Range"].removeprefix("bytes=").partition("-")
+            start, end, status = int(first), int(last) if last else len(data) - 1, 206
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1 + TRUNCATED_BY.get(name, 0)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not head:
+            self.wfile.write(data[start:end + 1])
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # large.bin goes through the parallel range download
+    monkeypatch.setattr(gpt_download, "PARALLEL_MIN_SIZE", 5_000)
+    monkeypatch.setattr(gpt_download, "PARALLEL_CHUNK_SIZE", 3_000)
+    RangeHandler.requests.clear()
+
+def download(base_url, folder, names=("small.txt", "large.bin")):
+    files = [(f"{base_url}/{name}", str(folder / name)) for name in names]
+    return gpt_download.download_files(files, str(folder / "integrity_cache.json"), max_workers=2)
+
+def test_downloads_and_records_the_files(base_url, tmp_path):
+    cache = download(base_url, tmp_path)
+    assert sorted(cache) == ["large.bin", "small.txt"]
+    for name in cache:
+        assert (tmp_path / name).read_bytes() == FILES[name]
+        assert cache[name]["size"] == len(FILES[name])
+    assert json.loads((tmp_path / "integrity_cache.json").read_text()) == cache
+    assert not list(tmp_path.glob("*.part*"))
+
+def test_complete_part_file_is_finalized_without_a_request(base_url, tmp_path):
+    (tmp_path / "small.txt.part").write_bytes(FILES["small.txt"])
+    download(base_url, tmp_path, ["small.txt"])
+    assert (tmp_path / "small.txt").read_bytes() == FILES["small.txt"]
+    assert [r for r in RangeHandler.requests if r[0] == "GET"] == []
+
+def test_partial_part_file_is_resumed(base_url, tmp_path):
+    (tmp_path / "small.txt.part").write_bytes(FILES["small.txt"][:500])
+    download(base_url, tmp_path, ["small.txt"])
+    assert (tmp_path / "small.txt").read_bytes() == FILES["small.txt"]
+    assert ("GET", "small.txt", "bytes=500-") in RangeHandler.requests
+
+@pytest.mark.parametrize("changed, unchanged", [("large.bin", "small.txt"), ("small.txt", "large.bin")])
+def test_changed_file_is_downloaded_again(base_url, tmp_path, changed, unchanged):
+    download(base_url, tmp_path)
+    (tmp_path / changed).write_bytes(b"x" * len(FILES[changed]))
+    RangeHandler.requests.clear()
+    download(base_url, tmp_path)
+    assert (tmp_path / changed).read_bytes() == FILES[changed]
+    # the unchanged file is only hashed, not fetched
+    assert not any(name == unchanged for _, name, _ in RangeHandler.requests)
+
+def test_download_that_differs_from_the_cache_fails(base_url, tmp_path, monkeypatch):
+    cache = download(base_url, tmp_path)
+    (tmp_path / "small.txt").write_bytes(b"x")
+    # the server now sends other bytes than the first download recorded
+    monkeypatch.setitem(FILES, "small.txt", b"changed on the server\n" * 50)
+    with pytest.raises(RuntimeError, match="small.txt"):
+        download(base_url, tmp_path)
+    # the entries stay those of the first download, nothing is left behind
+    assert json.loads((tmp_path / "integrity_cache.json").read_text()) == cache
+    assert not (tmp_path / "small.txt").exists() and not list(tmp_path.glob("*.part*"))
+
+def test_failed_file_does_not_lose_the_others(base_url, tmp_path):
+    with pytest.raises(RuntimeError, match="truncated.bin"):
+        download(base_url, tmp_path, ["small.txt", "large.bin", "truncated.bin"])
+    cache = json.loads((tmp_path / "integrity_cache.json").read_text())
+    assert sorted(cache) == ["large.bin", "small.txt"]
+
+def test_existing_file_without_cache_entry_asks_the_server_once(base_url, tmp_path):
+    (tmp_path / "small.txt").write_bytes(FILES["small.txt"][:10])
+    download(base_url, tmp_path, ["small.txt"])
+    assert (tmp_path / "small.txt").read_bytes() == FILES["small.txt"]
+    assert [r for r in RangeHandler.requests if r[0] == "HEAD"] == [("HEAD", "small.txt", None)]
+
+def test_missing_file_raises(base_url, tmp_path):
+    with pytest.raises(RuntimeError, match="missing.bin"):
+        download(base_url, tmp_path, ["missing.bin"])
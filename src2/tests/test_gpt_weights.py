@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import torch
+
+from gpt_weights import converted_path, load_gpt2_state_dict, load_gpt_model, params_to_state_dict, save_safetensors
+from model import GPTModel
+
+
+CFG = {"vocab_size": 40, "context_length": 16, "emb_dim": 8, "n_heads": 2, "n_layers": 2,
+       "drop_rate": 0.0, "qkv_bias": True}
+
+def tf_params(seed=0):
+    # the nested dictionary load_gpt2_params_from_tf_ckpt returns, with the TF (in, out) layout
+    rng = np.random.default_rng(seed)
+    emb = CFG["emb_dim"]
+
+    def array(*shape):
+        return rng.standard_normal(shape).astype(np.float32)
+
+    blocks = [{
+        "attn": {"c_attn": {"w": array(emb, 3 * emb), "b": array(3 * emb)},
+                 "c_proj": {"w": array(emb, emb), "b": array(emb)}},
+        "mlp": {"c_fc": {"w": array(emb, 4 * emb), "b": array(4 * emb)},
+                "c_proj": {"w": array(4 * emb, emb), "b": array(emb)}},
+        "ln_1": {"g": array(emb), "b": array(emb)},
+        "ln_2": {"g": array(emb), "b": array(emb)},
+    } for _ in range(CFG["n_layers"])]
+    return {"wte": array(CFG["vocab_size"], emb), "wpe": array(CFG["context_length"], emb),
+            "g": array(emb), "b": array(emb), "blocks": blocks}
+
+def load_weights_into_gpt(gpt, params):
+    # the parameter by parameter loading of the TF dictionary the safetensors conversion replaced
+    def assign(left, right):
+        assert left.shape == right.shape
+        return torch.nn.Parameter(torch.tensor(right))
+
+    gpt.pos_emb.weight = assign(gpt.pos_emb.weight, params["wpe"])
+    gpt.tok_emb.weight = assign(gpt.tok_emb.weight, params["wte"])
+    for block, p in zip(gpt.trf_blocks, params["blocks"]):
+        q_w, k_w, v_w = np.split(p["attn"]["c_attn"]["w"], 3, axis=-1)
+        q_b, k_b, v_b = np.split(p["attn"]["c_attn"]["b"], 3, axis=-1)
+        block.att.W_query.weight = assign(block.att.W_query.weight, q_w.T)
+        block.att.W_key.weight = assign(block.att.W_key.weight, k_w.T)
+        block.att.W_value.weight = assign(block.att.W_value.weight, v_w.T)
+        block.att.W_query.bias = assign(block.att.W_query.bias, q_b)
+        block.att.W_key.bias = assign(block.att.W_key.bias, k_b)
+        block.att.W_value.bias = assign(block.att.W_value.bias, v_b)
+        block.att.out_proj.weight = assign(block.att.out_proj.weight, p["attn"]["c_proj"]["w"].T)
+        block.att.out_proj.bias = assign(block.att.out_proj.bias, p["attn"]["c_proj"]["b"])
+        block.ff.layers[0].weight = assign(block.ff.layers[0].weight, p["mlp"]["c_fc"]["w"].T)
+        block.ff.layers[0].bias = assign(block.ff.layers[0].bias, p["mlp"]["c_fc"]["b"])
+        block.ff.layers[2].weight = assign(block.ff.layers[2].weight, p["mlp"]["c_proj"]["w"].T)
+        block.ff.layers[2].bias = assign(block.ff.layers[2].bias, p["mlp"]["c_proj"]["b"])
+        block.norm1.scale = assign(block.norm1.scale, p["ln_1"]["g"])
+        block.norm1.shift = assign(block.norm1.shift, p["ln_1"]["b"])
+        block.norm2.scale = assign(block.norm2.scale, p["ln_2"]["g"])
+        block.norm2.shift = assign(block.norm2.shift, p["ln_2"]["b"])
+    gpt.final_norm.scale = assign(gpt.final_norm.scale, params["g"])
+    gpt.final_norm.shift = assign(gpt.final_norm.shift, params["b"])
+    gpt.out_head.weight = assign(gpt.out_head.weight, params["wte"])
+
+def test_converted_checkpoint_gives_the_logits_of_the_tf_params(tmp_path):
+    params = tf_params()
+    (tmp_path / "tiny").mkdir()
+    save_safetensors(params_to_state_dict(params), converted_path("tiny", str(tmp_path)),
+                     metadata={"settings": json.dumps({"n_layer": CFG["n_layers"]})})
+    settings, state_dict = load_gpt2_state_dict("tiny", str(tmp_path))
+    gpt = load_gpt_model(CFG, state_dict).eval()
+
+    reference = GPTModel(CFG).eval()
+    load_weights_into_gpt(reference, params)
+    idx = torch.randint(0, CFG["vocab_size"], (2, CFG["context_length"]))
+    with torch.no_grad():
+        torch.testing.assert_close(gpt(idx), reference(idx), atol=1e-5, rtol=1e-5)
+    assert settings == {"n_layer": CFG["n_layers"]}
+
+def test_output_head_is_tied_to_the_token_embedding(tmp_path):
+    (tmp_path / "tiny").mkdir()
+    save_safetensors(params_to_state_dict(tf_params()), converted_path("tiny", str(tmp_path)),
+                     metadata={"settings": "{}"})
+    _, state_dict = load_gpt2_state_dict("tiny", str(tmp_path))
+    gpt = load_gpt_model(CFG, state_dict)
+
+    # one Parameter, so the optimizer sees and updates it once
+    assert gpt.out_head.weight is gpt.tok_emb.weight
+    assert "out_head.weight" not in dict(gpt.named_parameters())
+    with torch.no_grad():
+        gpt.tok_emb.weight.add_(1.0)
+    torch.testing.assert_close(gpt.out_head.weight, gpt.tok_emb.weight)
@@ -0,0 +1,42 @@
+import torch
+from torch._dynamo.utils import counters
+
+from generation import batch_generate
+from inference import CompiledGPT
+from model import GPTModel
+
+
+CFG = {"vocab_size": 50, "context_length": 32, "emb_dim": 32, "n_heads": 4, "n_layers": 2,
+       "drop_rate": 0.0, "qkv_bias": False}
+
+def num_graphs():
+    return counters["stats"]["unique_graphs"]
+
+def test_full_passes_are_specialized_and_cache_steps_share_graphs():
+    # the eager backend goes through dynamo (graph capture and guards) without the slow inductor codegen
+    torch._dynamo.reset()
+    torch.manual_seed(0)
+    model = GPTModel(CFG).eval()
+    compiled = CompiledGPT(model, backend="eager")
+
+    start = num_graphs()
+    compiled.warmup(batch_sizes=(2,), lengths=(4, 7), decode_steps=5)
+    # a prompt graph per length, the cache steps of both prompts share two graphs
+    assert num_graphs() - start == 4
+
+    idx = torch.randint(0, CFG["vocab_size"], (2, 10))
+    assert batch_generate(compiled, idx, 8, CFG["context_length"]) == batch_generate(model, idx, 8, CFG["context_length"])
+    # only the new prompt length needs a graph, its cache steps reuse the warmed up ones
+    assert num_graphs() - start == 5
+    # left padded rows run the masked attention, which has graphs of its own
+    pad_lengths = torch.tensor([0, 3])
+    assert batch_generate(compiled, idx, 8, CFG["context_length"], pad_lengths=pad_lengths) == \
+        batch_generate(model, idx, 8, CFG["context_length"], pad_lengths=pad_lengths)
+    assert num_graphs() - start == 8
+
+    with torch.no_grad():
+        for length in (8, 16, 8):
+            idx = torch.randint(0, CFG["vocab_size"], (3, length))
+            torch.testing.assert_close(compiled(idx), model(idx))
+    # full forward passes keep a graph per shape instead of turning dynamic
+    assert num_graphs() - start == 10
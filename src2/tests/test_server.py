@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+import torch
+
+import server
+from generation import batch_generate
+from model import GPTModel
+from server import InferenceServer
+
+
+CFG = {"vocab_size": 100, "context_length": 64, "emb_dim": 32, "n_heads": 4, "n_layers": 2,
+       "drop_rate": 0.0, "qkv_bias": False}
+
+class CharTokenizer:
+    # one token per printable character, the part of a tiktoken encoding the server uses
+    def encode(self, text, allowed_special=()):
+        return [ord(c) - 32 for c in text]
+
+    def decode(self, ids):
+        return "".join(chr(i + 32) for i in ids)
+
+def tiny_models():
+    torch.manual_seed(0)
+    classifier = GPTModel(CFG)
+    classifier.out_head = torch.nn.Linear(CFG["emb_dim"], 2)
+    return classifier.eval(), GPTModel(CFG).eval()
+
+def make_server(**kwargs):
+    classifier, generator = tiny_models()
+    kwargs = {"max_wait_ms": 50, "pad_token_id": 0, "eos_id": None, **kwargs}
+    return InferenceServer(CharTokenizer(), torch.device("cpu"), classifier=classifier, generator=generator, **kwargs)
+
+def run(inference_server, coroutine):
+    # the batchers need the event loop that runs the requests
+    async def main():
+        for batcher in inference_server.batchers.values():
+            batcher.start()
+        try:
+            return await coroutine()
+        finally:
+            for batcher in inference_server.batchers.values():
+                await batcher.stop()
+    return asyncio.run(main())
+
+def post(inference_server, path, body):
+    return inference_server.route("POST", path, json.dumps(body).encode())
+
+def test_concurrent_requests_share_a_batch():
+    s = make_server()
+    prompts = ["abcd", "ef", "ghijkl"]
+
+    async def requests():
+        return await asyncio.gather(*[post(s, "/generate", {"prompt": p, "max_new_tokens": 5}) for p in prompts],
+                                    post(s, "/classify", {"text": "hello"}))
+    *generated, classified = run(s, requests)
+
+    assert all(status == 200 for status, _ in generated) and classified[0] == 200
+    assert classified[1]["label"] in ("not spam", "spam")
+    metrics = s.metrics()
+    assert metrics["generate"]["batches"] == 1 and metrics["generate"]["last_batch_size"] == 3
+    # the prompts of different lengths are left padded and decoded together
+    assert metrics["generate"]["model_batches"] == 1
+    # greedy decoding of a prompt gives the same tokens in a batch as alone
+    for prompt, (_, response) in zip(prompts, generated):
+        ids = batch_generate(s.generator, torch.tensor([CharTokenizer().encode(prompt)]), 5, CFG["context_length"])[0]
+        assert response == {"text": CharTokenizer().decode(ids), "num_tokens": 5}
+
+def test_batch_is_closed_at_the_deadline():
+    s = make_server(max_wait_ms=20)
+
+    async def requests():
+        first = asyncio.create_task(post(s, "/generate", {"prompt": "abcd", "max_new_tokens": 2}))
+        await asyncio.sleep(0.3)
+        return await asyncio.gather(first, post(s, "/generate", {"prompt": "efgh", "max_new_tokens": 2}))
+    responses = run(s, requests)
+
+    assert [status for status, _ in responses] == [200, 200]
+    assert s.metrics()["generate"]["batches"] == 2
+
+def test_batch_is_closed_at_the_token_limit():
+    # every request is 4 prompt + 4 new tokens, two of them already exceed the limit
+    s = make_server(max_batch_tokens=12)
+
+    async def requests():
+        return await asyncio.gather(*[post(s, "/generate", {"prompt": p, "max_new_tokens": 4})
+                                      for p in ("abcd", "efgh", "ijkl")])
+    responses = run(s, requests)
+
+    assert all(status == 200 for status, _ in responses)
+    metrics = s.metrics()["generate"]
+    assert metrics["batches"] == 3 and metrics["mean_batch_tokens"] == 8
+    # the request for more tokens than the server allows is cut to its limit
+    s = make_server(max_new_tokens_limit=3)
+    status, response = run(s, lambda: post(s, "/generate", {"prompt": "abcd", "max_new_tokens": 50}))
+    assert status == 200 and response["num_tokens"] == 3
+
+def test_bad_sampling_settings_are_rejected_before_queueing():
+    s = make_server()
+    bad = [{"top_k": 0}, {"top_k": CFG["vocab_size"] + 1}, {"temperature": -1.0}, {"top_k": "many"}, {}]
+
+    async def requests():
+        return await asyncio.gather(
+            post(s, "/generate", {"prompt": "abcd", "top_k": 5, "temperature": 1.0, "max_new_tokens": 3}),
+            *[post(s, "/generate", {"prompt": "abcd", **body} if body else {"max_new_tokens": 3}) for body in bad]
+        )
+    (status, _), *rejected = run(s, requests)
+
+    assert status == 200
+    assert [status for status, _ in rejected] == [400] * len(bad)
+    metrics = s.metrics()["generate"]
+    assert metrics["requests"] == 1 and metrics["errors"] == 0 and metrics["batches"] == 1
+
+def test_failing_group_only_fails_its_own_requests(monkeypatch):
+    def generate_or_fail(model, idx, *args, temperature=0.0, **kwargs):
+        if temperature > 0.0:
+            raise RuntimeError("sampling failed")
+        return batch_generate(model, idx, *args, temperature=temperature, **kwargs)
+    monkeypatch.setattr(server, "batch_generate", generate_or_fail)
+    s = make_server()
+
+    async def requests():
+        # over HTTP, the exception of the failed group is a 500 response
+        listener = await asyncio.start_server(s.handle_connection, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def http_post(body):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            payload = json.dumps(body).encode()
+            writer.write(f"POST /generate HTTP/1.1\r\nContent-Length: {len(payload)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + payload)
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b"\r\n\r\n")
+            return int(head.split()[1]), json.loads(body)
+
+        async with listener:
+            return await asyncio.gather(*[http_post({"prompt": "abcd", "max_new_tokens": 3, "temperature": t})
+                                          for t in (0.0, 1.0, 0.0)])
+    responses = run(s, requests)
+
+    assert [status for status, _ in responses] == [200, 500, 200]
+    assert "sampling failed" in responses[1][1]["error"]
+    metrics = s.metrics()["generate"]
+    assert metrics["batches"] == 1 and metrics["requests"] == 2 and metrics["errors"] == 1
+    # one group per temperature
+    assert metrics["model_batches"] == 2
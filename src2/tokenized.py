@@ -0,0 +1,61 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+import shared  # noqa: F401, makes the common package importable
+from common.store import RaggedArrays, RaggedArraysWriter, file_sha256
+
+
+class TokenizedTexts(RaggedArrays):
+
+    # token ids of many texts as int32 RaggedArrays with a single array 'ids': get(i) are the ids of text i
+    def get(self, idx):
+        return super().get('ids', idx)
+
+    def lengths(self):
+        return super().lengths('ids')
+
+def encode_texts(texts, tokenizer, num_threads=8, chunk_size=10_000):
+    # yields the ids of every text, tiktoken encodes a batch on several threads at once
+    # special tokens in the texts are encoded as plain text, tokenizer.encode would reject them
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start:start + chunk_size]
+        if hasattr(tokenizer, 'encode_ordinary_batch'):
+            yield from tokenizer.encode_ordinary_batch(chunk, num_threads=num_threads)
+        else:
+            yield from (tokenizer.encode(text) for text in chunk)
+
+def tokenizer_name(tokenizer):
+    return getattr(tokenizer, 'name', type(tokenizer).__name__)
+
+def tokenize_texts(texts, tokenizer, folder, num_threads=8):
+    with RaggedArraysWriter(folder, {'ids': np.int32}) as writer:
+        for ids in encode_texts(texts, tokenizer, num_threads):
+            writer.append('ids', ids)
+        writer.close()
+    return TokenizedTexts(folder)
+
+def cached_tokenize_csv(csv_file, tokenizer, column='text', cache_dir='token_cache', num_threads=8):
+    # the ids only have to be computed again when the file or the tokenizer changes
+    key = hashlib.sha256(f'{file_sha256(csv_file)}-{tokenizer_name(tokenizer)}-{column}'.encode())
+    folder = Path(cache_dir) / f'{Path(csv_file).stem}-{key.hexdigest()[:16]}'
+    if RaggedArrays.exists(folder):
+        return TokenizedTexts(folder)
+
+    import pandas as pd
+    print(f'Tokenizing {csv_file} into {folder}')
+    texts = pd.read_csv(csv_file)[column].fillna('').astype(str).tolist()
+    return tokenize_texts(texts, tokenizer, folder, num_threads)
+
+def cached_tokenize_file(text_file, tokenizer, cache_dir='token_cache', num_threads=8):
+    # a whole text file as a single document, its ids are get(0)
+    key = hashlib.sha256(f'{file_sha256(text_file)}-{tokenizer_name(tokenizer)}'.encode())
+    folder = Path(cache_dir) / f'{Path(text_file).stem}-{key.hexdigest()[:16]}'
+    if RaggedArrays.exists(folder):
+        return TokenizedTexts(folder)
+
+    print(f'Tokenizing {text_file} into {folder}')
+    with open(text_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return tokenize_texts([text], tokenizer, folder, num_threads)